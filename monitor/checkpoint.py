@@ -0,0 +1,37 @@
+import json
+import os
+
+
+CHECKPOINT_FILE = "checkpoint.json"
+
+
+def load_checkpoint(outdir):
+    """
+    Return the last fully processed block number recorded in outdir, or None
+    """
+    return load_state(outdir).get("block")
+
+
+def load_state(outdir):
+    """
+    Return the full checkpoint record in outdir, or an empty dict
+    """
+    path = os.path.join(outdir, CHECKPOINT_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_checkpoint(outdir, block, **state):
+    """
+    Atomically record the last fully processed block number in outdir, along
+    with any additional state to resume from
+    """
+    path = os.path.join(outdir, CHECKPOINT_FILE)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(dict(state, block=block), f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
@@ -0,0 +1,97 @@
+import functools
+import re
+from hexbytes import HexBytes
+from web3 import Web3
+from web3.datastructures import AttributeDict
+
+
+@functools.lru_cache(maxsize=4096)
+def checksum(address):
+    """
+    Cached checksum encoding of a 0x-prefixed hex address
+    """
+    return Web3.toChecksumAddress(address)
+
+
+def _uint(word):
+    return int.from_bytes(word, "big")
+
+
+def _int(word):
+    return int.from_bytes(word, "big", signed=True)
+
+
+def _address(word):
+    return checksum("0x" + word[12:].hex())
+
+
+def _bool(word):
+    return word[-1] != 0
+
+
+def static_decoder(abi_type):
+    """
+    Return a decoder for a single 32-byte ABI word of a static type, or None
+    if the minimal codec does not support the type
+    """
+    if re.fullmatch(r"uint\d*", abi_type):
+        return _uint
+    if re.fullmatch(r"int\d*", abi_type):
+        return _int
+    if abi_type == "address":
+        return _address
+    if abi_type == "bool":
+        return _bool
+    match = re.fullmatch(r"bytes(\d+)", abi_type)
+    if match:
+        size = int(match.group(1))
+        return lambda word: word[:size]
+    return None
+
+
+def event_decoder(abi):
+    """
+    Build a decoder turning a raw JSON-RPC log of the given event into the
+    same structure as ContractEvent.processLog, or return None if any input
+    type is outside the minimal codec (static types, string and bytes)
+    """
+    topic_fields = []
+    data_fields = []
+    for item in abi["inputs"]:
+        dynamic = item["type"] in ("string", "bytes")
+        decoder = static_decoder(item["type"])
+        if decoder is None and not dynamic:
+            return None
+        if item["indexed"]:
+            # Indexed dynamic values are only available as their hash
+            topic_fields.append((item["name"], decoder or HexBytes))
+        else:
+            data_fields.append((item["name"], item["type"], decoder))
+    name = abi["name"]
+
+    def decode(log):
+        args = {}
+        for (field, decoder), topic in zip(topic_fields, log["topics"][1:]):
+            args[field] = decoder(bytes.fromhex(topic[2:]))
+        data = bytes.fromhex(log["data"][2:])
+        for position, (field, abi_type, decoder) in enumerate(data_fields):
+            word = data[32 * position:32 * position + 32]
+            if decoder is not None:
+                args[field] = decoder(word)
+                continue
+            offset = int.from_bytes(word, "big")
+            length = int.from_bytes(data[offset:offset + 32], "big")
+            value = data[offset + 32:offset + 32 + length]
+            args[field] = value.decode("utf-8") if abi_type == "string" else value
+        return AttributeDict({
+            "args": AttributeDict(args),
+            "event": name,
+            "logIndex": int(log["logIndex"], 16),
+            "transactionIndex": int(log["transactionIndex"], 16),
+            "transactionHash": HexBytes(log["transactionHash"]),
+            "address": checksum(log["address"]),
+            "blockHash": HexBytes(log["blockHash"]),
+            "blockNumber": int(log["blockNumber"], 16),
+        })
+
+    return decode
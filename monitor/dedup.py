@@ -0,0 +1,152 @@
+import array
+import collections
+import hashlib
+import os
+
+
+DEDUP_FILE = "dedup.bin"
+
+# Keys are stored as 63-bit digests; the top bit marks a removal in the file
+REMOVED = 1 << 63
+
+
+def digest(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little") & (REMOVED - 1)
+
+
+def event_key(event):
+    """
+    Deduplication key of a contract event: its transaction hash and log index
+    """
+    tx_hash = event["transactionHash"]
+    if not isinstance(tx_hash, str):
+        tx_hash = tx_hash.hex()
+    return "{}:{}".format(tx_hash.lower(), event["logIndex"])
+
+
+def pending_key(tx):
+    """
+    Deduplication key of a pending transaction: its hash
+    """
+    return tx["hash"].lower()
+
+
+class Deduplicator:
+    """
+    Bounded LRU set of the keys of recently written records, persisted as an
+    append-only file of 8-byte key digests that is compacted once it holds
+    twice the set size. Lookups are O(1) and memory stays bounded by the set
+    size; keys older than the window are forgotten.
+
+    Parameters
+    ----------
+    max_size : int
+        number of most recent keys remembered
+    path : str
+        path to the persistent key file (None to keep keys in memory only)
+
+    """
+
+    def __init__(self, max_size=100000, path=None):
+        self.max_size = max_size
+        self.path = path
+        self.keys = collections.OrderedDict()
+        self.duplicates = 0
+        # Digests added (or removed, flagged) since the last flush, and the
+        # block number of the record each keys (None if not in a block)
+        self._changes = array.array("Q")
+        self._blocks = []
+        self._entries = 0
+        if path is not None and os.path.exists(path):
+            self._load()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _load(self):
+        entries = array.array("Q")
+        with open(self.path, "rb") as f:
+            data = f.read()
+        # Ignore a digest partially written before a crash
+        entries.frombytes(data[:len(data) - len(data) % entries.itemsize])
+        for entry in entries:
+            if entry & REMOVED:
+                self.keys.pop(entry & ~REMOVED, None)
+            else:
+                self._remember(entry)
+        self._entries = len(entries)
+
+    def _remember(self, value):
+        self.keys[value] = None
+        self.keys.move_to_end(value)
+        while len(self.keys) > self.max_size:
+            self.keys.popitem(last=False)
+
+    def add(self, key, block=None):
+        """
+        Remember a key, of a record in block if given, returning False if it
+        was already remembered
+        """
+        value = digest(key)
+        if value in self.keys:
+            self.keys.move_to_end(value)
+            self.duplicates += 1
+            return False
+        self._remember(value)
+        self._changes.append(value)
+        self._blocks.append(block)
+        return True
+
+    def discard(self, key, block=None):
+        """
+        Forget a key (e.g. of a retracted event in block), returning False if
+        it was not remembered
+        """
+        value = digest(key)
+        if self.keys.pop(value, False) is False:
+            return False
+        self._changes.append(value | REMOVED)
+        self._blocks.append(block)
+        return True
+
+    def mark(self):
+        """
+        Return a mark of the changes so far, to flush only those later (e.g.
+        once the records they key have been written)
+        """
+        return len(self._changes)
+
+    def flush(self, mark=None, block=None):
+        """
+        Persist the changes since the last flush, only those made before mark
+        and of records up to block if given, compacting the file to the
+        remembered keys once it has grown to twice the set size. The other
+        changes are kept for a later flush.
+        """
+        if self.path is None or not self._changes:
+            return
+        if mark is None:
+            mark = len(self._changes)
+        changes, held = array.array("Q"), array.array("Q")
+        blocks = []
+        for index, (value, number) in enumerate(zip(self._changes, self._blocks)):
+            if index < mark and (block is None or number is None or number <= block):
+                changes.append(value)
+            else:
+                held.append(value)
+                blocks.append(number)
+        self._changes, self._blocks = held, blocks
+        if not changes:
+            return
+        if self._entries + len(changes) > 2 * self.max_size:
+            # Keys added by held changes are left out until flushed
+            later = {value for value in held if not value & REMOVED}
+            tmp = self.path + ".tmp"
+            with open(tmp, "wb") as f:
+                array.array("Q", (value for value in self.keys if value not in later)).tofile(f)
+            os.replace(tmp, self.path)
+            self._entries = len(self.keys) - len(later.intersection(self.keys))
+        else:
+            with open(self.path, "ab") as f:
+                changes.tofile(f)
+            self._entries += len(changes)
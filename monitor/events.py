@@ -0,0 +1,125 @@
+import asyncio
+import functools
+from web3 import Web3
+
+from codec import event_decoder
+from rpc import RPCError, format_log
+
+
+def build_topic_map(contract):
+    """
+    Map the topic0 signature hash of each contract event to a decoder for its
+    raw logs, precomputed once per contract. Events whose inputs the minimal
+    codec supports are decoded directly from the log data; any others fall
+    back to web3's ContractEvent.processLog.
+    """
+    topics = {}
+    for abi in contract.abi:
+        if abi.get("type") != "event" or abi.get("anonymous"):
+            continue
+        decoder = event_decoder(abi) or web3_decoder(contract.events[abi["name"]])
+        topics[event_topic(abi)] = decoder
+    return topics
+
+
+def event_topic(abi):
+    """
+    Topic0 signature hash of an event ABI entry
+    """
+    signature = "{}({})".format(
+        abi["name"],
+        ",".join(item["type"] for item in abi["inputs"])
+    )
+    return Web3.keccak(text=signature).hex()
+
+
+def web3_decoder(event):
+    """
+    Fallback decoder formatting a raw log and decoding it with web3
+    """
+    return lambda log: event().processLog(format_log(log))
+
+
+def decode_log(log, topics):
+    """
+    Decode a raw contract log using the decoder matching its topic0
+    """
+    if not log["topics"]:
+        return None
+    decoder = topics.get(log["topics"][0])
+    if decoder is None:
+        return None
+    return decoder(log)
+
+
+@functools.lru_cache(maxsize=None)
+def bloom_mask(value):
+    """
+    Bits set in a block logsBloom by a log address or topic (hex string):
+    three 11-bit indexes taken from its keccak hash
+    """
+    digest = Web3.keccak(hexstr=value)
+    mask = 0
+    for i in (0, 2, 4):
+        mask |= 1 << (((digest[i] << 8) | digest[i + 1]) & 2047)
+    return mask
+
+
+def may_contain(header, addresses, topics):
+    """
+    Test a block header's logsBloom for any log of the watched addresses with
+    a watched topic0. False means no such log is in the block; True may be a
+    false positive. Headers without a bloom always match.
+    """
+    if header.get("logsBloom") is None:
+        return True
+    bloom = int(header["logsBloom"], 16)
+    return any(bloom & bloom_mask(address) == bloom_mask(address) for address in addresses) \
+        and any(bloom & bloom_mask(topic) == bloom_mask(topic) for topic in topics)
+
+
+async def fetch_logs(rpc, addresses, topics, from_block, to_block):
+    """
+    Fetch all logs of the given contract addresses over a block range with a
+    single address-list, topic-OR query
+    """
+    return await rpc.request("eth_getLogs", [{
+        "address": list(addresses),
+        "fromBlock": hex(from_block),
+        "toBlock": hex(to_block),
+        "topics": [list(topics)],
+    }])
+
+
+async def fetch_log_chunks(
+        rpc,
+        addresses,
+        topics,
+        from_block,
+        to_block,
+        chunk_size=1000,
+        max_chunk_size=100000,
+        target_logs=2000
+):
+    """
+    Fetch contract logs over a block range in consecutive chunks, yielding
+    (last block of chunk, logs) in block order. The chunk size halves when
+    the node rejects or times out on a range, which also caps later growth,
+    and doubles while responses stay well under target_logs entries.
+    """
+    start = from_block
+    while start <= to_block:
+        end = min(start + chunk_size - 1, to_block)
+        try:
+            logs = await fetch_logs(rpc, addresses, topics, start, end)
+        except (RPCError, asyncio.TimeoutError):
+            if chunk_size == 1:
+                raise
+            chunk_size = max_chunk_size = max(chunk_size // 2, 1)
+            continue
+        yield end, logs
+        start = end + 1
+        if len(logs) > target_logs:
+            chunk_size = max(chunk_size // 2, 1)
+        elif len(logs) < target_logs // 4:
+            chunk_size = min(chunk_size * 2, max_chunk_size)
@@ -0,0 +1,206 @@
+import argparse
+import collections
+import json
+import time
+
+
+class InclusionTracker:
+    """
+    Bounded map of pending transaction hashes to the time they were first
+    seen, joined with the blocks that mine them to measure how long each
+    transaction waited to be included
+
+    Parameters
+    ----------
+    max_size : int
+        maximum number of pending transactions remembered; the oldest are
+        forgotten first
+
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.pending = collections.OrderedDict()
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def seen(self, tx, timestamp=None):
+        """
+        Record a pending transaction, keeping the time it was first seen
+        """
+        if tx.get("blockNumber") is not None or tx["hash"] in self.pending:
+            return
+        self.pending[tx["hash"]] = (timestamp or time.time(), tx["to"])
+        while len(self.pending) > self.max_size:
+            self.pending.popitem(last=False)
+            self.evicted += 1
+
+    def mined(self, block, timestamp=None):
+        """
+        Join the transaction hashes of a block with the pending transactions
+        they include, returning one inclusion latency record per transaction
+        """
+        observed = timestamp or time.time()
+        mined = int(block["timestamp"], 16)
+        records = []
+        for tx_hash in block.get("transactions", []):
+            entry = self.pending.pop(tx_hash, None)
+            if entry is None:
+                continue
+            seen, to = entry
+            records.append({
+                "hash": tx_hash,
+                "to": to,
+                "blockNumber": int(block["number"], 16),
+                "blockHash": block["hash"],
+                "seen": seen,
+                "mined": mined,
+                "observed": observed,
+                # Block timestamps have one second resolution
+                "latency": mined - seen,
+                "observedLatency": observed - seen,
+            })
+        return records
+
+
+def percentile(values, q):
+    """
+    Nearest-rank percentile of a sorted list of values
+    """
+    if not values:
+        return None
+    rank = max(int(-(-q * len(values) // 100)), 1)
+    return values[min(rank, len(values)) - 1]
+
+
+def load_latencies(paths, since=None, until=None, field="latency"):
+    """
+    Read inclusion latencies from latency log files, keeping transactions
+    first seen within [since, until]
+    """
+    latencies = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if since is not None and record["seen"] < since:
+                    continue
+                if until is not None and record["seen"] > until:
+                    continue
+                latencies.append(record[field])
+    return sorted(latencies)
+
+
+def print_report(latencies, buckets=10, width=40):
+    """
+    Print percentiles and a histogram of inclusion latencies
+    """
+    if not latencies:
+        print("No transactions in window")
+        return
+    print("transactions: {}".format(len(latencies)))
+    print("min {:.2f}s  mean {:.2f}s  max {:.2f}s".format(
+        latencies[0], sum(latencies) / len(latencies), latencies[-1]
+    ))
+    print("p50 {:.2f}s  p90 {:.2f}s  p99 {:.2f}s".format(
+        percentile(latencies, 50), percentile(latencies, 90), percentile(latencies, 99)
+    ))
+    low, high = latencies[0], latencies[-1]
+    step = (high - low) / buckets or 1
+    counts = [0] * buckets
+    for value in latencies:
+        counts[min(int((value - low) / step), buckets - 1)] += 1
+    for index, count in enumerate(counts):
+        print("{:>8.2f}s - {:>8.2f}s | {:<{width}} {}".format(
+            low + index * step,
+            low + (index + 1) * step,
+            "#" * round(width * count / max(counts)),
+            count,
+            width=width
+        ))
+
+
+if __name__ == "__main__":
+    """
+    Script to report pending-to-mined inclusion latency of transactions from
+    the "latency.log" files written by the monitor, printing p50/p90/p99
+    percentiles and a histogram over a time window.
+
+    Usage:
+
+        latency.py [-h] [--window WINDOW] [--since SINCE] [--until UNTIL] [--observed]
+                   [--buckets BUCKETS] logs [logs ...]
+
+    Required Arguments:
+
+        logs                    path(s) to latency.log files
+
+    Optional Arguments:
+
+        -h, --help              show this help message and exit
+        --window WINDOW         only include transactions first seen in the last WINDOW seconds
+                                (before UNTIL if given)
+        --since SINCE           only include transactions first seen at or after this unix time
+        --until UNTIL           only include transactions first seen at or before this unix time
+        --observed              report the time until the monitor saw the mining block, rather than
+                                until the block timestamp
+        --buckets BUCKETS       number of histogram buckets (default: 10)
+
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "logs",
+        help="path(s) to latency.log files",
+        type=str,
+        nargs="+"
+    )
+    parser.add_argument(
+        "--window",
+        help="only include transactions first seen in the last WINDOW seconds (before UNTIL if given)",
+        type=float,
+        required=False
+    )
+    parser.add_argument(
+        "--since",
+        help="only include transactions first seen at or after this unix time",
+        type=float,
+        required=False
+    )
+    parser.add_argument(
+        "--until",
+        help="only include transactions first seen at or before this unix time",
+        type=float,
+        required=False
+    )
+    parser.add_argument(
+        "--observed",
+        help="report the time until the monitor saw the mining block, rather than until the block timestamp",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--buckets",
+        help="number of histogram buckets (default: 10)",
+        type=int,
+        required=False,
+        default=10
+    )
+
+    args = parser.parse_args()
+
+    since = args.since
+    if args.window is not None:
+        since = (args.until or time.time()) - args.window
+    print_report(
+        load_latencies(
+            args.logs,
+            since,
+            args.until,
+            "observedLatency" if args.observed else "latency"
+        ),
+        args.buckets
+    )
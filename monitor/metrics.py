@@ -0,0 +1,159 @@
+import asyncio
+import bisect
+import contextlib
+import os
+import time
+from aiohttp import web
+
+
+# Latency histogram bucket upper bounds in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Exported metrics: name -> (type, help)
+METRICS = {
+    "monitor_rpc_requests_total": ("counter", "JSON-RPC calls sent to the node, by method"),
+    "monitor_rpc_errors_total": ("counter", "JSON-RPC requests that failed, by method"),
+    "monitor_rpc_seconds": ("histogram", "JSON-RPC request round trip time, by method"),
+    "monitor_loop_seconds": ("histogram", "Time spent in one iteration of a monitor loop, by loop"),
+    "monitor_events_total": ("counter", "Contract events written, by event"),
+    "monitor_duplicates_total": ("counter", "Events and pending transactions dropped as already written, by kind"),
+    "monitor_events_per_second": ("gauge", "Contract events written per second over the last sample interval, by event"),
+    "monitor_head_lag_blocks": ("gauge", "Blocks between the node head and the last processed block"),
+    "monitor_head_lag_seconds": ("gauge", "Seconds since the timestamp of the last processed block"),
+    "monitor_writer_queue_depth": ("gauge", "Records queued for an output file writer, by file"),
+    "monitor_block_interval_seconds": ("gauge", "Observed and expected seconds between blocks, by kind"),
+    "monitor_polls_total": ("counter", "Node polls by a poll loop, by loop and outcome"),
+    "monitor_bloom_blocks_total": ("counter", "New blocks whose logs were fetched or skipped by the logsBloom prefilter, by outcome"),
+    "monitor_stage_queue_depth": ("gauge", "Items queued between pipeline stages, in memory and spilled, by queue"),
+    "monitor_stage_wait_seconds": ("histogram", "Time a pipeline stage waited on a queue, by queue and side"),
+    "monitor_stage_dropped_total": ("counter", "Items dropped from a full pipeline queue, by queue"),
+    "monitor_stage_spilled_total": ("counter", "Items spilled to disk from a full pipeline queue, by queue"),
+}
+
+# Recorded values keyed by metric name, then by tuple of (label, value) pairs
+values = {name: {} for name in METRICS}
+
+# Callables refreshing gauges sampled from other components on each render
+collectors = []
+
+
+def inc(name, value=1, **labels):
+    """
+    Increment a counter
+    """
+    samples = values[name]
+    key = tuple(sorted(labels.items()))
+    samples[key] = samples.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    """
+    Set a gauge to a value
+    """
+    values[name][tuple(sorted(labels.items()))] = value
+
+
+def observe(name, value, **labels):
+    """
+    Record a value in a histogram
+    """
+    samples = values[name]
+    key = tuple(sorted(labels.items()))
+    histogram = samples.get(key)
+    if histogram is None:
+        # Per-bucket counts (the last for values above all bounds), sum
+        histogram = samples[key] = [[0] * (len(BUCKETS) + 1), 0.0]
+    histogram[0][bisect.bisect_left(BUCKETS, value)] += 1
+    histogram[1] += value
+
+
+@contextlib.contextmanager
+def timer(name, **labels):
+    """
+    Context manager recording the time spent in its body in a histogram
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+
+def _labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(label, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for label, value in pairs
+    ) + "}"
+
+
+def render():
+    """
+    Render all metrics in the Prometheus text exposition format
+    """
+    for collector in collectors:
+        collector()
+    lines = []
+    for name, (kind, description) in METRICS.items():
+        lines.append("# HELP {} {}".format(name, description))
+        lines.append("# TYPE {} {}".format(name, kind))
+        for key, value in sorted(values[name].items()):
+            if kind != "histogram":
+                lines.append("{}{} {}".format(name, _labels(key), value))
+                continue
+            counts, total = value
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(name, _labels(key, [("le", bound)]), cumulative))
+            lines.append("{}_sum{} {}".format(name, _labels(key), total))
+            lines.append("{}_count{} {}".format(name, _labels(key), cumulative))
+    return "\n".join(lines) + "\n"
+
+
+def dump(path):
+    """
+    Atomically write the rendered metrics to a file
+    """
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(render())
+    os.replace(tmp, path)
+
+
+async def serve(host="127.0.0.1", port=9100):
+    """
+    Serve the rendered metrics at http://host:port/metrics, returning the
+    runner to clean up on shutdown
+    """
+
+    async def handle(request):
+        return web.Response(
+            body=render().encode(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+        )
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+async def sample_loop(interval=5, path=None):
+    """
+    Periodically update event rates from the event counters, and dump the
+    metrics to path if given
+    """
+    last = dict(values["monitor_events_total"])
+    while True:
+        await asyncio.sleep(interval)
+        current = dict(values["monitor_events_total"])
+        for key, count in current.items():
+            values["monitor_events_per_second"][key] = (count - last.get(key, 0)) / interval
+        last = current
+        if path is not None:
+            dump(path)
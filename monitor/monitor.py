@@ -1,34 +1,70 @@
 import argparse
 import asyncio
+import functools
 import json
 import os
+import signal
+import sys
+import time
+import aiohttp
 from web3 import Web3
 from web3.logs import STRICT, IGNORE, DISCARD, WARN
 from web3.middleware import geth_poa_middleware
 
+import metrics
+from checkpoint import load_checkpoint, save_checkpoint
+from dedup import DEDUP_FILE, Deduplicator, event_key, pending_key
+from events import build_topic_map, decode_log, fetch_log_chunks, fetch_logs, may_contain
+from latency import InclusionTracker
+from pipeline import POLICIES, close_queues, open_queue, queues, stage
+from reorg import ReorgTracker
+from rpc import AsyncRPC, RPCError, WSRPC, format_transaction
+from scheduler import PollScheduler
+from state import GameState, serve as serve_state
+from store import open_database
+from writer import DURABILITY, close_writers, open_writer, sync_writers, writers
+
 
 global web3
 
+# Live game state, updated from every contract event handled
+game_state = GameState()
+
+# SQLite database writer, when output is also written to a database
+database = None
+
+# Keys of recently written events and pending transactions, to drop repeats
+dedup = None
 
-def handler_pending(event, contract):
+
+async def handler_pending(rpc, events, contracts, batch_size=100):
     """
-    Pending block handler that filters on contract address
+    Pending block handler that resolves all new pending hashes with batched
+    lookups and filters on the watched contract addresses
     """
-    tx = web3.eth.get_transaction(event)
-    if (tx["to"] == contract.address):
-        return web3.eth.get_transaction(event)
+    txs = await rpc.batch(
+        "eth_getTransactionByHash",
+        [[event] for event in events],
+        batch_size
+    )
+    return tuple(
+        format_transaction(tx) for tx in txs
+        if tx is not None and (tx["to"] or "").lower() in contracts
+    )
 
 
 def handler_event(event, contract):
     """
-    Event handler for the contract events; simply returns event for writing
+    Event handler for the contract events; folds the event into the live
+    game state and returns it for writing
     """
+    game_state.apply(event)
     return event
 
 
 def record_log(data, outfile, verbose=False):
     """
-    Dump output to file, one JSON object per line
+    Queue output for the file's writer, one JSON object per line
     """
 
     # TODO: File contents should ideally be a single JSON object
@@ -36,107 +72,848 @@ def record_log(data, outfile, verbose=False):
     if verbose:
         print(web3.toJSON(data))
 
-    with open(outfile, "a+") as f:
-        f.write(web3.toJSON(data) + "\n")
+    writers[outfile].write(data)
+
+
+def record_pending(txs, sinks, verbose=False, inclusion=None):
+    """
+    Route pending transactions to the pending sink file of their contract,
+    remembering when each was first seen
+    """
+    for tx in txs:
+        if dedup is not None and not dedup.add(pending_key(tx)):
+            metrics.inc("monitor_duplicates_total", kind="pending")
+            continue
+        if inclusion is not None:
+            inclusion.seen(tx)
+        record_log(tx, sinks[tx["to"].lower()]["pending"], verbose)
+        if database is not None:
+            database.write_transaction(tx)
+
+
+def record_inclusion(blocks, inclusion, sinks, verbose=False):
+    """
+    Join blocks with the pending transactions they mine, routing inclusion
+    latency records to the latency sink file of their contract
+    """
+    for block in blocks:
+        for record in inclusion.mined(block):
+            record_log(record, sinks[record["to"].lower()]["latency"], verbose)
+
+
+async def pending_pipeline(
+        rpc=None,
+        fetched=None,
+        handler=None,
+        contracts=None,
+        sinks=None,
+        verbose=False,
+        inclusion=None,
+        queue_options=None
+):
+    """
+    Decode and sink stages of the pending transaction pipeline: batches of
+    pending hashes taken from the fetched queue are resolved by the handler,
+    and the transactions it returns are queued for writing to file
+    """
+    decoded = open_queue("pending_decoded", **(queue_options or {}))
+
+    async def decode(events):
+        try:
+            return await handler(rpc, events, contracts)
+        except (RPCError, aiohttp.ClientError, ConnectionError, asyncio.TimeoutError) as e:
+            print("[WARN] Dropping {} pending transactions ({})".format(len(events), e))
+
+    async def sink(txs):
+        record_pending(txs, sinks, verbose, inclusion)
+
+    await asyncio.gather(
+        stage("pending_decode", fetched, decoded, decode),
+        stage("pending_sink", decoded, None, sink)
+    )
 
 
 async def log_loop(
-        event_filter=None,
+        rpc=None,
+        filter_method=None,
         handler=None,
-        contract=None,
-        outfile=None,
-        poll_interval=5,
-        verbose=False
+        contracts=None,
+        sinks=None,
+        scheduler=None,
+        verbose=False,
+        inclusion=None,
+        queue_options=None
+):
+    """
+    Continuously monitor a node filter, queueing each batch of new entries
+    for the handler and writing the transactions it returns to file in
+    separate stages, so slow handling or output never delays the next poll.
+    Polls back off while the filter stays empty or the node errors.
+    """
+    fetched = open_queue("pending_fetched", **(queue_options or {}))
+
+    async def fetch():
+        filter_id = None
+        while True:
+            with metrics.timer("monitor_loop_seconds", loop="pending"):
+                try:
+                    if filter_id is not None:
+                        try:
+                            events = await rpc.request("eth_getFilterChanges", [filter_id])
+                        except RPCError:
+                            # Filters expire on the node when not polled; recreate and resume
+                            filter_id = None
+                    if filter_id is None:
+                        filter_id = await rpc.request(filter_method)
+                        events = []
+                except (RPCError, aiohttp.ClientError, asyncio.TimeoutError):
+                    scheduler.error()
+                    events = None
+            if events:
+                scheduler.active()
+                await fetched.put(events)
+            elif events is not None:
+                scheduler.idle()
+            await asyncio.sleep(scheduler.delay())
+
+    await asyncio.gather(
+        fetch(),
+        pending_pipeline(rpc, fetched, handler, contracts, sinks, verbose, inclusion, queue_options)
+    )
+
+
+def decode_logs(logs, topics):
+    """
+    Decode raw contract logs by topic0, skipping logs of unknown events
+    """
+    events = []
+    for log in logs:
+        event = decode_log(log, topics)
+        if event is not None:
+            events.append(event)
+    return events
+
+
+def emit_events(events, contracts, sinks, verbose=False):
+    """
+    Pass events to the event handler of their contract and route each result
+    to the contract's sink file for the event, dropping events already
+    written and retractions of events that were not
+    """
+    for event in events:
+        if dedup is not None and not (
+                dedup.discard(event_key(event), event["blockNumber"]) if event.get("removed")
+                else dedup.add(event_key(event), event["blockNumber"])
+        ):
+            metrics.inc("monitor_duplicates_total", kind="event")
+            continue
+        address = event["address"].lower()
+        metrics.inc("monitor_events_total", event=event["event"])
+        event = handler_event(event, contracts[address])
+        record_log(event, sinks[address][event["event"]], verbose)
+        if database is not None:
+            database.write_event(event)
+
+
+def process_logs(logs, topics, contracts, sinks, verbose=False):
+    """
+    Decode raw contract logs by topic0 and route each event to its sink file
+    """
+    emit_events(decode_logs(logs, topics), contracts, sinks, verbose)
+
+
+async def commit_block(outdir, block):
+    """
+    Checkpoint a block once all events queued for it have been written,
+    snapshotting the game state as of the block when due
+    """
+    # Only keys of records already written, and of events up to the block,
+    # are persisted; those keyed while the writers sync, or of later blocks
+    # (e.g. logs streamed ahead of their head), wait for a later checkpoint
+    mark = dedup.mark() if dedup is not None else None
+    await sync_writers()
+    if dedup is not None:
+        dedup.flush(mark, block)
+    if game_state.due():
+        game_state.save_snapshot(outdir, block)
+    save_checkpoint(outdir, block)
+
+
+async def replay_state(rpc, contracts, from_block, to_block):
+    """
+    Rebuild the game state over a block range whose events have already
+    been written, without writing them again
+    """
+    topics = build_topic_map(next(iter(contracts.values())))
+    async for _, logs in fetch_log_chunks(rpc, contracts, topics, from_block, to_block):
+        for event in decode_logs(logs, topics):
+            game_state.apply(event)
+
+
+async def catch_up(rpc, contracts, topics, sinks, outdir, from_block, to_block, verbose=False):
+    """
+    Process all contract logs over a block range in adaptively sized chunks,
+    checkpointing after each chunk
+    """
+    async for end, logs in fetch_log_chunks(rpc, contracts, topics, from_block, to_block):
+        process_logs(logs, topics, contracts, sinks, verbose)
+        await commit_block(outdir, end)
+
+
+async def attach(rpc, tracker, segment):
+    """
+    Extend a chain segment back through its parents until it attaches to a
+    tracked block, or the tracked blocks are exhausted
+    """
+    while tracker.blocks \
+            and segment[0]["parentHash"] not in tracker.index \
+            and int(segment[0]["number"], 16) > tracker.oldest:
+        segment.insert(0, await rpc.request(
+            "eth_getBlockByHash", [segment[0]["parentHash"], False]
+        ))
+    return segment
+
+
+async def advance(rpc, contracts, topics, sinks, tracker, last_block, header, verbose=False, inclusion=None):
+    """
+    Extend the tracked chain from last_block to a new head header, retracting
+    events of blocks orphaned by a reorg, emitting confirmed events and
+    joining new blocks with the pending transactions they mine. Returns the
+    new last block, which is unchanged if the chain moved while headers were
+    being fetched.
+    """
+    head = int(header["number"], 16)
+    segment = await rpc.batch(
+        "eth_getBlockByNumber",
+        [[hex(number), False] for number in range(last_block + 1, head)]
+    ) + [header]
+    if None in segment or any(
+        child["parentHash"] != parent["hash"]
+        for parent, child in zip(segment, segment[1:])
+    ):
+        return last_block
+    segment = await attach(rpc, tracker, segment)
+    first = int(segment[0]["number"], 16)
+
+    emit_events(tracker.rollback(first - 1), contracts, sinks, verbose)
+    for block in segment:
+        tracker.add_block(block)
+    if inclusion is not None:
+        record_inclusion(segment, inclusion, sinks, verbose)
+
+    # Only query logs over the blocks whose bloom may hold contract activity
+    hashes = {block["hash"] for block in segment if may_contain(block, contracts, topics)}
+    metrics.inc("monitor_bloom_blocks_total", len(hashes), outcome="fetched")
+    metrics.inc("monitor_bloom_blocks_total", len(segment) - len(hashes), outcome="skipped")
+    if hashes:
+        numbers = [int(block["number"], 16) for block in segment if block["hash"] in hashes]
+        logs = await fetch_logs(rpc, contracts, topics, min(numbers), max(numbers))
+        for event in decode_logs([log for log in logs if log["blockHash"] in hashes], topics):
+            emit_events(tracker.add_event(event), contracts, sinks, verbose)
+    emit_events(tracker.confirm(head), contracts, sinks, verbose)
+    return head
+
+
+async def release(rpc, contracts, sinks, tracker, verbose=False):
+    """
+    Retract the events of tracked blocks orphaned while the monitor fell
+    further behind than the reorg buffer, then empty the tracker so new
+    blocks are not attached to it one parent at a time. Returns the first
+    block whose events are still to be emitted, or None if the tracked
+    blocks could not be checked.
+    """
+    canonical = await rpc.batch(
+        "eth_getBlockByNumber",
+        [[hex(block["number"]), False] for block in tracker.blocks]
+    )
+    if None in canonical:
+        return None
+    ancestor = tracker.oldest - 1
+    for block, current in zip(tracker.blocks, canonical):
+        if current["hash"] != block["hash"]:
+            break
+        ancestor = block["number"]
+    emit_events(tracker.rollback(ancestor), contracts, sinks, verbose)
+    held = [block["number"] for block in tracker.blocks if not block["emitted"]]
+    tracker.reset()
+    return held[0] if held else ancestor + 1
+
+
+async def sync_to(rpc, contracts, topics, sinks, outdir, tracker, last_block, header, verbose=False, inclusion=None):
+    """
+    Bring the monitor from last_block up to a new head header. Blocks deeper
+    than the reorg buffer are final and backfilled in bulk, along with the
+    events still held by the tracker, which is then emptied; the rest go
+    through the reorg tracker.
+    """
+    head = int(header["number"], 16)
+    if head - last_block > tracker.depth:
+        from_block = last_block + 1
+        if tracker.blocks:
+            first = await release(rpc, contracts, sinks, tracker, verbose)
+            if first is None:
+                return last_block
+            from_block = min(from_block, first)
+        await catch_up(rpc, contracts, topics, sinks, outdir, from_block, head - tracker.depth, verbose)
+        last_block = head - tracker.depth
+    return await advance(rpc, contracts, topics, sinks, tracker, last_block, header, verbose, inclusion)
+
+
+async def block_loop(
+        rpc=None,
+        contracts=None,
+        sinks=None,
+        outdir=None,
+        tracker=None,
+        scheduler=None,
+        verbose=False,
+        inclusion=None
 ):
     """
-    Continuously monitor filters and pass results for writing to file
+    Fetch the logs of all watched contracts once per new head with a single
+    address-list, topic-OR query, decode them by topic0 and route each event
+    to its sink file. Resumes from the last checkpointed block, backfilling
+    any blocks missed while the monitor was down, and tracks recent blocks
+    to handle reorgs. The head is polled just after each block is expected.
     """
+    topics = build_topic_map(next(iter(contracts.values())))
+    header = await rpc.request("eth_getBlockByNumber", ["latest", False])
+    last_block = load_checkpoint(outdir)
+    if last_block is None:
+        last_block = int(header["number"], 16)
+        scheduler.observe(last_block, int(header["timestamp"], 16))
+        tracker.add_block(header, emitted=True)
+        await commit_block(outdir, last_block)
+    committed = last_block
+    # Timestamp of the last processed block, once caught up with the head
+    processed = None
     while True:
-        for event in event_filter.get_new_entries():
-            result = handler(event, contract)
-            if isinstance(result, tuple):
-                for item in result:
-                    record_log(item, outfile, verbose)
+        with metrics.timer("monitor_loop_seconds", loop="blocks"):
+            try:
+                if header is None:
+                    scheduler.error()
+                elif tracker.tip is None or header["hash"] != tracker.tip["hash"] \
+                        or int(header["number"], 16) > last_block:
+                    scheduler.observe(int(header["number"], 16), int(header["timestamp"], 16))
+                    if verbose:
+                        print_timing(scheduler.stats())
+                    last_block = await sync_to(
+                        rpc, contracts, topics, sinks, outdir, tracker, last_block, header, verbose, inclusion
+                    )
+                    if last_block == int(header["number"], 16):
+                        processed = int(header["timestamp"], 16)
+                    if last_block - tracker.confirmations > committed:
+                        committed = last_block - tracker.confirmations
+                        await commit_block(outdir, committed)
+                else:
+                    scheduler.idle()
+            except (RPCError, aiohttp.ClientError, asyncio.TimeoutError):
+                # A failed backfill or log fetch is retried from last_block
+                # at the next poll
+                scheduler.error()
+            if header is not None:
+                metrics.set_gauge("monitor_head_lag_blocks", int(header["number"], 16) - last_block)
+            if processed is not None:
+                metrics.set_gauge("monitor_head_lag_seconds", max(time.time() - processed, 0))
+        await asyncio.sleep(scheduler.delay())
+        try:
+            header = await rpc.request("eth_getBlockByNumber", ["latest", False])
+        except (RPCError, aiohttp.ClientError, asyncio.TimeoutError):
+            header = None
+
+
+def print_timing(stats):
+    """
+    Print observed against expected block timing of the head poll loop
+    """
+    if stats["observed_interval"] is None:
+        return
+    print("[poll] {} blocks: observed {:.1f}s, expected {:.1f}s, noticed {:.1f}s after block "
+          "(mean {:.1f}s), {:.1f} polls/block, {} empty, {} errors".format(
+              stats["blocks"],
+              stats["observed_interval"],
+              stats["expected_interval"],
+              stats["detection_lag"],
+              stats["mean_detection_lag"],
+              stats["polls_per_block"],
+              stats["empty"],
+              stats["errors"]
+          ))
+
+
+async def ws_loop(
+        ws=None,
+        contracts=None,
+        sinks=None,
+        outdir=None,
+        tracker=None,
+        batch_size=100,
+        reconnect_delay=1,
+        verbose=False,
+        inclusion=None,
+        queue_options=None
+):
+    """
+    Subscribe to new heads, contract logs and pending transactions over a
+    WebSocket connection, pushing notifications straight into the handlers
+    (pending transactions through the same queued stages as log_loop).
+    On (re)connect all streams are subscribed and blocks missed since the
+    last checkpoint are backfilled before resuming.
+    """
+    fetched = open_queue("pending_fetched", **(queue_options or {}))
+    topics = build_topic_map(next(iter(contracts.values())))
+    last_block = load_checkpoint(outdir)
+    committed = last_block
+
+    async def commit(block):
+        nonlocal committed
+        if block > committed:
+            committed = block
+            await commit_block(outdir, block)
+
+    async def head_stream(queue):
+        nonlocal last_block
+        while True:
+            header = await queue.get()
+            if header is None:
+                raise ConnectionError("newHeads subscription lost")
+            # Skip repeated or late headers of blocks already tracked, and
+            # headers older than the buffer that no longer can be attached
+            if header["hash"] in tracker.index or (
+                    tracker.blocks and int(header["number"], 16) < tracker.oldest):
+                continue
+            if tracker.tip is not None and header["parentHash"] != tracker.tip["hash"]:
+                # Reorg: retract events above the common ancestor; logs of the
+                # new branch are delivered by the logs subscription
+                segment = await attach(ws, tracker, [header])
+                first = int(segment[0]["number"], 16)
+                emit_events(tracker.rollback(first - 1), contracts, sinks, verbose)
+                for block in segment[:-1]:
+                    tracker.add_block(block)
+            tracker.add_block(header)
+            if inclusion is not None and len(inclusion):
+                # newHeads notifications carry no transaction hashes
+                block = header if "transactions" in header else await ws.request(
+                    "eth_getBlockByHash", [header["hash"], False]
+                )
+                record_inclusion([block], inclusion, sinks, verbose)
+            number = int(header["number"], 16)
+            emit_events(tracker.confirm(number), contracts, sinks, verbose)
+            last_block = max(last_block, number)
+            metrics.set_gauge("monitor_head_lag_blocks", 0)
+            metrics.set_gauge("monitor_head_lag_seconds", max(time.time() - int(header["timestamp"], 16), 0))
+            # Logs of the new head may still be in flight; checkpoint its parent
+            await commit(number - 1 - tracker.confirmations)
+
+    def handle_log(log):
+        for event in decode_logs([log], topics):
+            if log.get("removed"):
+                emit_events(tracker.retract(event), contracts, sinks, verbose)
             else:
-                record_log(result, outfile, verbose)
-        await asyncio.sleep(poll_interval)
+                emit_events(tracker.add_event(event), contracts, sinks, verbose)
+
+    async def log_stream(queue):
+        while True:
+            log = await queue.get()
+            if log is None:
+                raise ConnectionError("logs subscription lost")
+            handle_log(log)
+
+    async def settle(queue):
+        # On shutdown, handle the logs already delivered and fetch those of
+        # the head, so the checkpoint no longer trails it and covers every
+        # event written
+        while not queue.empty():
+            log = queue.get_nowait()
+            if log is None:
+                return
+            handle_log(log)
+        tip = tracker.tip
+        if tip is None:
+            return
+        try:
+            logs = await fetch_logs(ws, contracts, topics, tip["number"], tip["number"])
+        except (RPCError, aiohttp.ClientError, ConnectionError, asyncio.TimeoutError):
+            return
+        for event in decode_logs([log for log in logs if log["blockHash"] == tip["hash"]], topics):
+            emit_events(tracker.add_event(event), contracts, sinks, verbose)
+        emit_events(tracker.confirm(tip["number"]), contracts, sinks, verbose)
+        await commit(tip["number"] - tracker.confirmations)
+
+    async def pending_stream(queue):
+        while True:
+            events = [await queue.get()]
+            while not queue.empty() and len(events) < batch_size:
+                events.append(queue.get_nowait())
+            if None in events:
+                raise ConnectionError("newPendingTransactions subscription lost")
+            await fetched.put(events)
+
+    # The pending stages outlive connections; lookups fail until reconnected
+    pipeline = asyncio.ensure_future(pending_pipeline(
+        ws,
+        fetched,
+        functools.partial(handler_pending, batch_size=batch_size),
+        contracts,
+        sinks,
+        verbose,
+        inclusion,
+        queue_options
+    ))
+    try:
+        while True:
+            try:
+                await ws.open()
+                heads = await ws.subscribe(["newHeads"])
+                logs = await ws.subscribe(["logs", {
+                    "address": list(contracts),
+                    "topics": [list(topics)],
+                }])
+                pending = await ws.subscribe(["newPendingTransactions"])
+
+                header = await ws.request("eth_getBlockByNumber", ["latest", False])
+                head = int(header["number"], 16)
+                if last_block is None:
+                    tracker.add_block(header, emitted=True)
+                    await commit_block(outdir, head)
+                    committed = last_block = head
+                elif header["hash"] != (tracker.tip or {}).get("hash"):
+                    last_block = await sync_to(
+                        ws, contracts, topics, sinks, outdir, tracker, last_block, header, verbose, inclusion
+                    )
+                    await commit(last_block - tracker.confirmations)
+
+                try:
+                    await asyncio.gather(
+                        head_stream(heads),
+                        log_stream(logs),
+                        pending_stream(pending)
+                    )
+                except asyncio.CancelledError:
+                    await settle(logs)
+                    raise
+            except (aiohttp.ClientError, ConnectionError, asyncio.TimeoutError) as e:
+                print("[WARN] WebSocket connection lost ({}), reconnecting".format(e))
+            finally:
+                await ws.close()
+            await asyncio.sleep(reconnect_delay)
+    finally:
+        pipeline.cancel()
+
+
+def build_sinks(contracts, outdir):
+    """
+    Map each watched contract to its event and pending output files, written
+    to the output folder for a single contract and to a subfolder per
+    contract address otherwise
+    """
+    sinks = {}
+    for address, contract in contracts.items():
+        contract_dir = outdir
+        if len(contracts) > 1:
+            contract_dir = os.path.join(outdir, contract.address)
+            os.makedirs(contract_dir, exist_ok=True)
+        # All contract events are currently routed to the same output file
+        event_log = os.path.join(contract_dir, "event.log")
+        sinks[address] = {
+            abi["name"]: event_log
+            for abi in contract.abi if abi.get("type") == "event"
+        }
+        sinks[address]["pending"] = os.path.join(contract_dir, "pending.log")
+        sinks[address]["latency"] = os.path.join(contract_dir, "latency.log")
+    return sinks
 
 
-def start_monitor(contract=None, outdir=None, verbose=False):
+async def main(
+        rpc,
+        contracts,
+        outdir,
+        verbose,
+        batch_size,
+        ws=None,
+        writer_options=None,
+        tracker=None,
+        poll_options=None,
+        metrics_options=None,
+        inclusion=None,
+        state_options=None,
+        queue_options=None,
+        database_path=None,
+        dedup_size=100000
+):
     """
-    Create filters and start asynchronous monitoring
+    Run the block and pending loops concurrently on a shared RPC session, or
+    the subscription loop when a WebSocket client is given. Contracts are
+    keyed by lowercase address and must share the same ABI.
     """
-    pending_filter = web3.eth.filter("pending")
-    pool_exhausted_filter = contract.events.PoolExhausted.createFilter(fromBlock="latest")
-    pool_balance_filter = contract.events.PoolBalance.createFilter(fromBlock="latest")
-    result_filter = contract.events.Result.createFilter(fromBlock="latest")
+    global database, dedup
+    writer_options = writer_options or {}
+    sinks = build_sinks(contracts, outdir)
+    for outfile in {path for sink in sinks.values() for path in sink.values()}:
+        open_writer(outfile, **writer_options)
+    if database_path is not None:
+        database = open_database(database_path, **{
+            key: value for key, value in writer_options.items() if not key.startswith("segment_")
+        })
+    if dedup_size:
+        dedup = Deduplicator(dedup_size, os.path.join(outdir, DEDUP_FILE))
+    if tracker is None:
+        tracker = ReorgTracker()
+    if inclusion is None:
+        inclusion = InclusionTracker()
+    poll_options = poll_options or {}
+    block_scheduler = PollScheduler(**poll_options)
+    # Pending transactions have no cadence to learn
+    pending_scheduler = PollScheduler(**dict(poll_options, block_time=None))
+    # Queues between pipeline stages spill to a folder in the output folder
+    queue_options = dict({"spill_dir": os.path.join(outdir, "spill")}, **(queue_options or {}))
+
+    def collect():
+        for outfile, writer in writers.items():
+            metrics.set_gauge("monitor_writer_queue_depth", writer.qsize(), file=outfile)
+        for name, queue in queues.items():
+            metrics.set_gauge("monitor_stage_queue_depth", queue.qsize(), queue=name)
+        for name, scheduler in (("blocks", block_scheduler), ("pending", pending_scheduler)):
+            stats = scheduler.stats()
+            for outcome in ("polls", "empty", "errors"):
+                metrics.set_gauge("monitor_polls_total", stats[outcome], loop=name, outcome=outcome)
+        stats = block_scheduler.stats()
+        for kind in ("expected", "observed"):
+            if stats[kind + "_interval"] is not None:
+                metrics.set_gauge("monitor_block_interval_seconds", stats[kind + "_interval"], kind=kind)
+
+    # Metrics are always recorded; serve and dump them if requested
+    metrics_options = metrics_options or {}
+    metrics.collectors.append(collect)
+    sampler = asyncio.ensure_future(metrics.sample_loop(
+        metrics_options.get("interval", 5),
+        metrics_options.get("path")
+    ))
+    runner = None
+    if metrics_options.get("port") is not None:
+        runner = await metrics.serve(port=metrics_options["port"])
+
+    # Reload the game state, replaying any checkpointed blocks it misses (the
+    # whole chain if the snapshot is lost, as the first checkpoint has one)
+    state_options = state_options or {}
+    game_state.snapshot_interval = state_options.get("interval", 60)
+    snapshot = game_state.load_snapshot(outdir)
+    checkpoint = load_checkpoint(outdir)
+    if checkpoint is not None and (snapshot is None or snapshot < checkpoint):
+        async with rpc:
+            await replay_state(rpc, contracts, 0 if snapshot is None else snapshot + 1, checkpoint)
+    state_runner = None
+    if state_options.get("port") is not None:
+        state_runner = await serve_state(game_state, port=state_options["port"])
+
+    # Stop on SIGINT/SIGTERM by cancelling the loops, draining writers below
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, asyncio.current_task().cancel)
 
-    loop = asyncio.get_event_loop()
     try:
-        loop.run_until_complete(
-            asyncio.gather(
-                log_loop(
-                    pool_balance_filter,
-                    handler_event,
-                    contract,
-                    os.path.join(outdir, "event.log"),
-                    2,
-                    verbose
-                ),
-                log_loop(
-                    pending_filter,
-                    handler_pending,
-                    contract,
-                    os.path.join(outdir, "pending.log"),
-                    2.5,
-                    verbose
-                ),
-                log_loop(
-                    result_filter,
-                    handler_event,
-                    contract,
-                    os.path.join(outdir, "event.log"),
-                    3,
-                    verbose
-                ),
-                log_loop(
-                    pool_exhausted_filter,
-                    handler_event,
-                    contract,
-                    os.path.join(outdir, "event.log"),
-                    3.5
-                ),
+        if ws is not None:
+            await ws_loop(
+                ws,
+                contracts,
+                sinks,
+                outdir,
+                tracker,
+                batch_size,
+                1,
+                verbose,
+                inclusion,
+                queue_options
             )
-        )
+        else:
+            async with rpc:
+                await asyncio.gather(
+                    block_loop(
+                        rpc,
+                        contracts,
+                        sinks,
+                        outdir,
+                        tracker,
+                        block_scheduler,
+                        verbose,
+                        inclusion
+                    ),
+                    log_loop(
+                        rpc,
+                        "eth_newPendingTransactionFilter",
+                        functools.partial(handler_pending, batch_size=batch_size),
+                        contracts,
+                        sinks,
+                        pending_scheduler,
+                        verbose,
+                        inclusion,
+                        queue_options
+                    ),
+                )
+    finally:
+        await close_writers()
+        # Events past the checkpoint (only after a failed shutdown) are
+        # fetched again on restart, and may be discarded by the supervisor,
+        # so their keys are not kept
+        if dedup is not None:
+            checkpoint = load_checkpoint(outdir)
+            dedup.flush(block=checkpoint if checkpoint is not None else -1)
+        close_queues()
+        if load_checkpoint(outdir) is not None:
+            game_state.save_snapshot(outdir, load_checkpoint(outdir))
+        sampler.cancel()
+        if runner is not None:
+            await runner.cleanup()
+        if state_runner is not None:
+            await state_runner.cleanup()
+        if metrics_options.get("path") is not None:
+            metrics.dump(metrics_options["path"])
+        metrics.collectors.remove(collect)
+
+
+def start_monitor(
+        contracts=None,
+        outdir=None,
+        verbose=False,
+        batch_size=100,
+        max_concurrency=8,
+        ws_uri=None,
+        writer_options=None,
+        confirmations=0,
+        reorg_depth=64,
+        poll_options=None,
+        metrics_options=None,
+        state_options=None,
+        queue_options=None,
+        database_path=None,
+        dedup_size=100000
+):
+    """
+    Create the asynchronous RPC session and start monitoring a list of
+    contracts, subscribing over WebSocket instead of polling when ws_uri is
+    given
+    """
+    rpc = AsyncRPC(web3.provider.endpoint_uri, max_concurrency)
+    ws = WSRPC(ws_uri) if ws_uri else None
+    tracker = ReorgTracker(reorg_depth, confirmations)
+    try:
+        asyncio.run(main(
+            rpc,
+            {contract.address.lower(): contract for contract in contracts},
+            outdir,
+            verbose,
+            batch_size,
+            ws,
+            writer_options,
+            tracker,
+            poll_options,
+            metrics_options,
+            None,
+            state_options,
+            queue_options,
+            database_path,
+            dedup_size
+        ))
+    except asyncio.CancelledError:
+        pass
     except Exception as e:
+        # Exit non-zero, so a supervisor does not take it for a clean exit
         print(e)
-    finally:
-        loop.close()
+        sys.exit(1)
 
 
 if __name__ == "__main__":
     """
     Script to asynchronously monitor for contract activity in pending and
     latest blocks of local private network node, writing filter events to
-    "pending.log" and "event.log" output files.
+    "pending.log" and "event.log" output files, and the time each pending
+    transaction waited to be mined to "latency.log". Any number of deployments of
+    the contract can be watched by one monitor, with the logs of all of them
+    fetched by a single query per block and output written to a subfolder
+    per contract address. The last fully processed block is checkpointed to
+    "checkpoint.json" in the output folder, and on restart any blocks mined
+    since are backfilled before monitoring resumes. Bet, win, payout and
+    pool totals per contract and account are kept live from the events,
+    snapshotted to "state.json" and optionally served as JSON.
 
     Usage:
     
-        monitor.py [-h] -a ADDRESS --abi ABI --config CONFIG [-o OUTPUT]
+        monitor.py [-h] [-c CONTRACT [CONTRACT ...]] [--contract-file CONTRACT_FILE] --abi ABI --config CONFIG
+                   [-o OUTPUT] [-v] [--batch-size BATCH_SIZE]
+                   [--max-concurrency MAX_CONCURRENCY] [--ws]
+                   [--flush-batch FLUSH_BATCH] [--flush-interval FLUSH_INTERVAL]
+                   [--durability {none,flush,fsync}] [--segment-size SEGMENT_SIZE]
+                   [--segment-interval SEGMENT_INTERVAL] [--confirmations CONFIRMATIONS]
+                   [--reorg-depth REORG_DEPTH] [--block-time BLOCK_TIME]
+                   [--min-poll-interval MIN_POLL_INTERVAL] [--max-poll-interval MAX_POLL_INTERVAL]
+                   [--metrics-port METRICS_PORT] [--metrics-file METRICS_FILE]
+                   [--metrics-interval METRICS_INTERVAL] [--state-port STATE_PORT]
+                   [--snapshot-interval SNAPSHOT_INTERVAL] [--queue-size QUEUE_SIZE]
+                   [--queue-policy {block,drop-oldest,spill}] [--db DB] [--dedup-size DEDUP_SIZE]
 
     Required Arguments:
 
-        -c CONTRACT, --contract CONTRACT
-                                contract address to monitor
         --abi ABI               contract ABI or full path to ABI file
         --config CONFIG         path to network provider RPC server config.json
 
     Optional Arguments:
 
         -h, --help              show this help message and exit
+        -c CONTRACT [CONTRACT ...], --contract CONTRACT [CONTRACT ...]
+                                contract address(es) to monitor
+        --contract-file CONTRACT_FILE
+                                path to file listing contract addresses to monitor, one per line
         -o OUTPUT, --output OUTPUT
                                 path to folder for storing output logs (default: ./output/)
         -v, --verbose           additionally log to command line
+        --batch-size BATCH_SIZE
+                                maximum pending transaction lookups per JSON-RPC batch request (default: 100)
+        --max-concurrency MAX_CONCURRENCY
+                                maximum number of in-flight RPC requests to the node (default: 8)
+        --ws                    subscribe over the provider WebSocket endpoint (ws_url/ws_port in config.json)
+                                instead of polling HTTP filters
+        --flush-batch FLUSH_BATCH
+                                maximum records written to an output file per batch (default: 256)
+        --flush-interval FLUSH_INTERVAL
+                                maximum seconds a record is buffered before being written (default: 1)
+        --durability {none,flush,fsync}
+                                per-batch output durability policy (default: flush)
+        --segment-size SEGMENT_SIZE
+                                write each output file as compressed segments of this many megabytes in a
+                                "<file>.segments" folder (default: disabled)
+        --segment-interval SEGMENT_INTERVAL
+                                write each output file as compressed segments spanning this many seconds
+                                (default: disabled)
+        --confirmations CONFIRMATIONS
+                                only log events once their block has this many confirmations (default: 0)
+        --reorg-depth REORG_DEPTH
+                                number of recent blocks tracked to detect reorgs and retract events (default: 64)
+        --block-time BLOCK_TIME
+                                expected seconds between blocks until learned from head timestamps (default: none)
+        --min-poll-interval MIN_POLL_INTERVAL
+                                shortest delay between node polls (default: 0.5)
+        --max-poll-interval MAX_POLL_INTERVAL
+                                longest delay between node polls when idle or backing off (default: 15)
+        --metrics-port METRICS_PORT
+                                serve Prometheus metrics at http://127.0.0.1:METRICS_PORT/metrics (default: disabled)
+        --metrics-file METRICS_FILE
+                                periodically write Prometheus metrics to this file (default: disabled)
+        --metrics-interval METRICS_INTERVAL
+                                seconds between metrics file dumps and event rate updates (default: 5)
+        --state-port STATE_PORT
+                                serve live game state queries at http://127.0.0.1:STATE_PORT/state/ (default: disabled)
+        --snapshot-interval SNAPSHOT_INTERVAL
+                                minimum seconds between game state snapshots to "state.json" (default: 60)
+        --queue-size QUEUE_SIZE
+                                maximum batches held in memory between pending transaction stages (default: 1000)
+        --queue-policy {block,drop-oldest,spill}
+                                when a stage queue is full, wait, drop the oldest batch or spill to disk under
+                                "spill/" (default: block)
+        --db DB                 also write events and pending transactions to this SQLite database, queried
+                                with store.py (default: disabled)
+        --dedup-size DEDUP_SIZE
+                                number of recent event and pending transaction keys remembered across restarts
+                                in "dedup.bin" to drop repeated records, 0 to disable (default: 100000)
 
     """
 
@@ -148,9 +925,17 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "-c", "--contract",
-        help="contract address to monitor",
+        help="contract address(es) to monitor",
         type=str,
-        required=True
+        nargs="+",
+        required=False,
+        default=[]
+    )
+    parser.add_argument(
+        "--contract-file",
+        help="path to file listing contract addresses to monitor, one per line",
+        type=str,
+        required=False
     )
     parser.add_argument(
         "-o", "--output",
@@ -176,9 +961,161 @@ if __name__ == "__main__":
         help="additionally log to command line",
         action="store_true"
     )
+    parser.add_argument(
+        "--batch-size",
+        help="maximum pending transaction lookups per JSON-RPC batch request (default: 100)",
+        type=int,
+        required=False,
+        default=100
+    )
+    parser.add_argument(
+        "--max-concurrency",
+        help="maximum number of in-flight RPC requests to the node (default: 8)",
+        type=int,
+        required=False,
+        default=8
+    )
+    parser.add_argument(
+        "--ws",
+        help="subscribe over the provider WebSocket endpoint (ws_url/ws_port in config.json) instead of polling HTTP filters",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--flush-batch",
+        help="maximum records written to an output file per batch (default: 256)",
+        type=int,
+        required=False,
+        default=256
+    )
+    parser.add_argument(
+        "--flush-interval",
+        help="maximum seconds a record is buffered before being written (default: 1)",
+        type=float,
+        required=False,
+        default=1.0
+    )
+    parser.add_argument(
+        "--durability",
+        help="per-batch output durability policy (default: flush)",
+        choices=DURABILITY,
+        required=False,
+        default="flush"
+    )
+    parser.add_argument(
+        "--segment-size",
+        help="write each output file as compressed segments of this many megabytes in a \"<file>.segments\" folder (default: disabled)",
+        type=float,
+        required=False
+    )
+    parser.add_argument(
+        "--segment-interval",
+        help="write each output file as compressed segments spanning this many seconds (default: disabled)",
+        type=float,
+        required=False
+    )
+    parser.add_argument(
+        "--confirmations",
+        help="only log events once their block has this many confirmations (default: 0)",
+        type=int,
+        required=False,
+        default=0
+    )
+    parser.add_argument(
+        "--reorg-depth",
+        help="number of recent blocks tracked to detect reorgs and retract events (default: 64)",
+        type=int,
+        required=False,
+        default=64
+    )
+    parser.add_argument(
+        "--block-time",
+        help="expected seconds between blocks until learned from head timestamps (default: none)",
+        type=float,
+        required=False
+    )
+    parser.add_argument(
+        "--min-poll-interval",
+        help="shortest delay between node polls (default: 0.5)",
+        type=float,
+        required=False,
+        default=0.5
+    )
+    parser.add_argument(
+        "--max-poll-interval",
+        help="longest delay between node polls when idle or backing off (default: 15)",
+        type=float,
+        required=False,
+        default=15.0
+    )
+    parser.add_argument(
+        "--metrics-port",
+        help="serve Prometheus metrics at http://127.0.0.1:METRICS_PORT/metrics (default: disabled)",
+        type=int,
+        required=False
+    )
+    parser.add_argument(
+        "--metrics-file",
+        help="periodically write Prometheus metrics to this file (default: disabled)",
+        type=str,
+        required=False
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        help="seconds between metrics file dumps and event rate updates (default: 5)",
+        type=float,
+        required=False,
+        default=5.0
+    )
+    parser.add_argument(
+        "--state-port",
+        help="serve live game state queries at http://127.0.0.1:STATE_PORT/state/ (default: disabled)",
+        type=int,
+        required=False
+    )
+    parser.add_argument(
+        "--snapshot-interval",
+        help="minimum seconds between game state snapshots to \"state.json\" (default: 60)",
+        type=float,
+        required=False,
+        default=60.0
+    )
+    parser.add_argument(
+        "--queue-size",
+        help="maximum batches held in memory between pending transaction stages (default: 1000)",
+        type=int,
+        required=False,
+        default=1000
+    )
+    parser.add_argument(
+        "--queue-policy",
+        help="when a stage queue is full, wait, drop the oldest batch or spill to disk under \"spill/\" (default: block)",
+        choices=POLICIES,
+        required=False,
+        default="block"
+    )
+    parser.add_argument(
+        "--db",
+        help="also write events and pending transactions to this SQLite database, queried with store.py (default: disabled)",
+        type=str,
+        required=False
+    )
+    parser.add_argument(
+        "--dedup-size",
+        help="number of recent event and pending transaction keys remembered across restarts in \"dedup.bin\" to drop repeated records, 0 to disable (default: 100000)",
+        type=int,
+        required=False,
+        default=100000
+    )
 
     args = parser.parse_args()
 
+    addresses = list(args.contract)
+    if args.contract_file is not None:
+        with open(os.path.normpath(args.contract_file)) as f:
+            addresses.extend(line.strip() for line in f if line.strip())
+    if not addresses:
+        parser.error("at least one contract address is required (-c or --contract-file)")
+
     # Load provider config.json
     if os.path.exists(os.path.normpath(args.config)):
         with open(os.path.normpath(args.config)) as f:
@@ -187,13 +1124,21 @@ if __name__ == "__main__":
         raise FileNotFoundError()
     web3 = Web3(Web3.HTTPProvider(provider["url"] + ":" + str(provider["port"])))
     web3.middleware_onion.inject(geth_poa_middleware, layer=0)
+    ws_uri = None
+    if args.ws:
+        ws_uri = provider.get("ws_url", provider["url"].replace("http", "ws", 1)) \
+            + ":" + str(provider.get("ws_port", 8546))
 
-    # Load contract
+    # Load contracts, all sharing the same ABI
     if os.path.exists(os.path.normpath(args.abi)):
         with open(os.path.normpath(args.abi)) as f:
-            contract = web3.eth.contract(address=args.contract, abi=f.read())
+            abi = f.read()
     else:
-        contract = web3.eth.contract(address=args.contract, abi=args.abi)
+        abi = args.abi
+    contracts = [
+        web3.eth.contract(address=Web3.toChecksumAddress(address), abi=abi)
+        for address in addresses
+    ]
 
     # Create output path if required
     if not os.path.isdir(args.output):
@@ -206,4 +1151,40 @@ if __name__ == "__main__":
     #         os.remove(os.path.join(args.output, "pending.log"))
 
     #  Start the monitor
-    start_monitor(contract, args.output, args.verbose)
+    start_monitor(
+        contracts,
+        args.output,
+        args.verbose,
+        args.batch_size,
+        args.max_concurrency,
+        ws_uri,
+        {
+            "batch_size": args.flush_batch,
+            "flush_interval": args.flush_interval,
+            "durability": args.durability,
+            "segment_size": None if args.segment_size is None else int(args.segment_size * 1024 * 1024),
+            "segment_interval": args.segment_interval,
+        },
+        args.confirmations,
+        args.reorg_depth,
+        {
+            "block_time": args.block_time,
+            "min_interval": args.min_poll_interval,
+            "max_interval": args.max_poll_interval,
+        },
+        {
+            "port": args.metrics_port,
+            "path": args.metrics_file,
+            "interval": args.metrics_interval,
+        },
+        {
+            "port": args.state_port,
+            "interval": args.snapshot_interval,
+        },
+        {
+            "maxsize": args.queue_size,
+            "policy": args.queue_policy,
+        },
+        args.db,
+        args.dedup_size
+    )
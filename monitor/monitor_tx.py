@@ -1,14 +1,20 @@
 import asyncio
 import json
 import os
+import threading
 from web3 import Web3
 from web3.logs import STRICT, IGNORE, DISCARD, WARN
 from web3.middleware import geth_poa_middleware
 
+from receipts import ReceiptTracker
+from rpc import AsyncRPC
+from store import open_database
+from writer import close_writers, open_writer, writers
+
 
 def record_log(web3, data, outfile, verbose=False):
     """
-    Dump output to file, one JSON object per line
+    Queue output for the file's writer, one JSON object per line
     """
 
     # TODO: File contents should ideally be a single JSON object
@@ -16,46 +22,230 @@ def record_log(web3, data, outfile, verbose=False):
     if verbose:
         print(web3.toJSON(data))
 
-    with open(outfile, "a+") as f:
-        f.write(web3.toJSON(data) + "\n")
+    writers[outfile].write(data)
 
 
-async def handler_tx(web3, address, outfile, verbose):
+async def handler_tx(
+        web3,
+        rpc,
+        address,
+        outfile,
+        verbose,
+        database=None,
+        tracker=None,
+        timeout=120,
+        sender=None,
+        nonce=None
+):
     """
-    Transaction handler that waits for transaction receipt and write results
+    Transaction handler that waits for transaction receipt from the shared
+    block-scoped receipt tracker and write results, also to the database
+    writer if given
     """
-    while True:
-        receipt = web3.eth.wait_for_transaction_receipt(address)
-        record_log(web3, receipt, outfile, verbose)
-        return receipt
+    receipt = await tracker.wait(address, timeout, sender, nonce)
+    record_log(web3, receipt, outfile, verbose)
+    if database is not None:
+        database.write_receipt(receipt)
+    return receipt
 
 
-async def main(web3, addresses, handler, outfile, verbose):
+class TxWatcher:
     """
-    Set up the async tasks to monitor
+    Long-running transaction watcher that other code, in any thread, can feed
+    hashes to at any time. It runs its own event loop in a background thread,
+    where one receipt tracker resolves every watched hash; each receipt is
+    written to "transaction.log" (and the database) before its future is
+    resolved, so a continuous flow of bets is tracked without restarting.
+
+    Parameters
+    ----------
+    web3 : Web3
+        connected instance with an HTTP provider
+    outdir : str
+        output folder for "transaction.log"
+    verbose : bool
+        print receipts as they are written
+    timeout : float
+        default seconds to wait for a hash before failing with TimeoutError
+    recheck_interval : float
+        seconds between checks that watched transactions not yet mined were
+        not dropped from the node's pool
+    max_concurrency : int
+        maximum number of in-flight RPC requests
+    writer_options : dict
+        transaction log writer options (batch_size, flush_interval,
+        durability, segment_size, segment_interval)
+    database_path : str
+        path to a SQLite database also written with receipts (None to skip)
+
     """
-    tasks = []
-    for address in addresses:
-        tasks.append(handler(web3, address, outfile, verbose))
 
-    await asyncio.gather(*tasks)
+    def __init__(
+            self,
+            web3,
+            outdir,
+            verbose=False,
+            timeout=120,
+            recheck_interval=15,
+            max_concurrency=8,
+            writer_options=None,
+            database_path=None
+    ):
+        self.web3 = web3
+        self.outdir = outdir
+        self.outfile = os.path.join(outdir, "transaction.log")
+        self.verbose = verbose
+        self.timeout = timeout
+        self.recheck_interval = recheck_interval
+        self.writer_options = writer_options or {}
+        self.database_path = database_path
+        self.rpc = AsyncRPC(web3.provider.endpoint_uri, max_concurrency)
+        self.tracker = None
+        self.database = None
+        # Watched hashes -> futures of their handlers, until done
+        self.watched = {}
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        self._poller = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        """
+        Start the watcher thread, opening the output and RPC client
+        """
+        # Create output path if required
+        if not os.path.isdir(self.outdir):
+            os.makedirs(self.outdir)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="TxWatcher", daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._open(), self._loop).result()
+
+    def stop(self):
+        """
+        Cancel any hashes still watched, flush the output and stop the
+        watcher thread
+        """
+        asyncio.run_coroutine_threadsafe(self._close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
 
+    async def _open(self):
+        open_writer(self.outfile, **self.writer_options)
+        if self.database_path is not None:
+            self.database = open_database(self.database_path, **{
+                key: value for key, value in self.writer_options.items() if not key.startswith("segment_")
+            })
+        await self.rpc.open()
+        # One tracker resolves every hash as the blocks mining them arrive
+        self.tracker = ReceiptTracker(self.rpc, timeout=self.timeout, recheck_interval=self.recheck_interval)
+        self._poller = asyncio.ensure_future(self.tracker.run())
+        self._poller.add_done_callback(self._poller_done)
 
-def start_monitor(web3=None, addresses=[], outdir=None, verbose=False):
+    async def _close(self):
+        self._poller.cancel()
+        with self._lock:
+            futures = list(self.watched.values())
+        for future in futures:
+            future.cancel()
+        await self.rpc.close()
+        await close_writers()
+
+    def _poller_done(self, poller):
+        # Without the poller no watched hash would ever resolve
+        if not poller.cancelled() and poller.exception() is not None:
+            print("[WARN] Receipt poller failed ({})".format(poller.exception()))
+            self.tracker.abort(poller.exception())
+
+    def _done(self, tx_hash, future):
+        with self._lock:
+            if self.watched.get(tx_hash) is future:
+                del self.watched[tx_hash]
+
+    def watch(self, tx_hash, timeout=None, callback=None, sender=None, nonce=None):
+        """
+        Watch a transaction hash, returning a concurrent.futures.Future
+        resolved with its receipt once written, or failed with
+        TransactionReplaced or TransactionDropped, or TimeoutError after
+        timeout seconds (default: the watcher timeout). The callback,
+        if given, is called with the future in the watcher thread when it is
+        done. Give the sender and nonce of the transaction if known (e.g. by
+        the code that sent it), so that it fails as replaced as soon as
+        another transaction with its nonce is mined. Await the future from
+        another event loop with asyncio.wrap_future.
+        """
+        tx_hash = tx_hash.lower()
+        with self._lock:
+            future = self.watched.get(tx_hash)
+            if future is None:
+                future = asyncio.run_coroutine_threadsafe(handler_tx(
+                    self.web3,
+                    self.rpc,
+                    tx_hash,
+                    self.outfile,
+                    self.verbose,
+                    self.database,
+                    self.tracker,
+                    self.timeout if timeout is None else timeout,
+                    sender,
+                    nonce
+                ), self._loop)
+                self.watched[tx_hash] = future
+                future.add_done_callback(lambda done: self._done(tx_hash, done))
+        if callback is not None:
+            future.add_done_callback(callback)
+        return future
+
+    def wait(self, tx_hashes, timeout=None, nonces=None):
+        """
+        Watch a set of transaction hashes and wait for all of them, returning
+        their receipts in order (or the exception each failed with). nonces
+        optionally gives the (sender, nonce) of each hash, as for watch.
+        """
+        nonces = nonces or [(None, None)] * len(tx_hashes)
+        futures = [
+            self.watch(tx_hash, timeout, sender=sender, nonce=nonce)
+            for tx_hash, (sender, nonce) in zip(tx_hashes, nonces)
+        ]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+
+def start_monitor(
+        web3=None,
+        addresses=[],
+        outdir=None,
+        verbose=False,
+        max_concurrency=8,
+        writer_options=None,
+        database_path=None
+):
     """
-    Start asynchronous monitoring for a set of transaction hashes
+    Monitor a set of transaction hashes until each has a receipt or times
+    out, writing receipts to "transaction.log" (and the database at
+    database_path) and printing failures
     """
-    # Create output path if required
-    if not os.path.isdir(outdir):
-        os.makedirs(outdir)
-
-    try:
-        asyncio.run(main(
-            web3,
-            addresses,
-            handler_tx,
-            os.path.join(outdir, "transaction.log"),
-            verbose
-        ))
-    except Exception as e:
-        print(e)
+    with TxWatcher(
+        web3,
+        outdir,
+        verbose,
+        max_concurrency=max_concurrency,
+        writer_options=writer_options,
+        database_path=database_path
+    ) as watcher:
+        for result in watcher.wait(addresses):
+            if isinstance(result, Exception):
+                print(result)
@@ -0,0 +1,183 @@
+import asyncio
+import collections
+import json
+import os
+import time
+from web3 import Web3
+
+import metrics
+
+
+POLICIES = ("block", "drop-oldest", "spill")
+
+# Active queues keyed by name, one per pair of connected stages
+queues = {}
+
+
+class StageQueue:
+    """
+    Bounded FIFO queue between two pipeline stages, with a policy for when
+    it is full: "block" waits for the consumer, "drop-oldest" discards the
+    oldest queued item and "spill" appends items to segment files on disk,
+    replayed in order once the consumer has drained the queue
+
+    Parameters
+    ----------
+    name : str
+        queue name, labelling its metrics and spill segments
+    maxsize : int
+        maximum number of items held in memory
+    policy : str
+        behaviour when full: "block", "drop-oldest" or "spill"
+    spill_dir : str
+        folder for spill segments (required by the "spill" policy); segments
+        left by a previous run are replayed first
+
+    """
+
+    def __init__(self, name, maxsize=1000, policy="block", spill_dir=None):
+        if policy not in POLICIES:
+            raise ValueError("policy must be one of {}".format(POLICIES))
+        if policy == "spill" and spill_dir is None:
+            raise ValueError("spill policy requires a spill folder")
+        self.name = name
+        self.maxsize = maxsize
+        self.policy = policy
+        self.spill_dir = spill_dir
+        self.dropped = 0
+        self.spilled = 0
+        self._items = collections.deque()
+        self._not_empty = asyncio.Event()
+        self._not_full = asyncio.Event()
+        # Spill segment paths in write order, and the one being appended to
+        self._segments = collections.deque()
+        self._spill_file = None
+        self._spill_count = 0
+        self._spill_lines = 0
+        self._sequence = 0
+        if policy == "spill":
+            os.makedirs(spill_dir, exist_ok=True)
+            prefix = name + "-"
+            for filename in sorted(os.listdir(spill_dir)):
+                if filename.startswith(prefix) and filename.endswith(".spill"):
+                    self._segments.append(os.path.join(spill_dir, filename))
+                    self._sequence = int(filename[len(prefix):-len(".spill")]) + 1
+                    with open(self._segments[-1]) as f:
+                        self._spill_count += sum(1 for _ in f)
+
+    def qsize(self):
+        """
+        Number of items queued, in memory and spilled to disk
+        """
+        return len(self._items) + self._spill_count
+
+    async def put(self, item):
+        """
+        Queue an item, applying the queue policy if it is full
+        """
+        if self.policy == "spill" and (self._segments or len(self._items) >= self.maxsize):
+            # Keep FIFO order: once spilling, spill until the segments drain
+            self._spill(item)
+            self._not_empty.set()
+            return
+        if len(self._items) >= self.maxsize:
+            if self.policy == "drop-oldest":
+                self._items.popleft()
+                self.dropped += 1
+                metrics.inc("monitor_stage_dropped_total", queue=self.name)
+            else:
+                started = time.perf_counter()
+                while len(self._items) >= self.maxsize:
+                    self._not_full.clear()
+                    await self._not_full.wait()
+                metrics.observe("monitor_stage_wait_seconds", time.perf_counter() - started, queue=self.name, side="put")
+        self._items.append(item)
+        self._not_empty.set()
+
+    async def get(self):
+        """
+        Remove and return the oldest item, waiting until one is available
+        """
+        started = time.perf_counter()
+        while not self._items:
+            if self._segments:
+                self._replay()
+                continue
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        metrics.observe("monitor_stage_wait_seconds", time.perf_counter() - started, queue=self.name, side="get")
+        item = self._items.popleft()
+        self._not_full.set()
+        return item
+
+    def _spill(self, item):
+        if self._spill_file is None:
+            path = os.path.join(self.spill_dir, "{}-{:08d}.spill".format(self.name, self._sequence))
+            self._sequence += 1
+            self._segments.append(path)
+            self._spill_file = open(path, "w")
+            self._spill_lines = 0
+        self._spill_file.write(Web3.toJSON(item) + "\n")
+        self._spill_file.flush()
+        self._spill_count += 1
+        self._spill_lines += 1
+        self.spilled += 1
+        metrics.inc("monitor_stage_spilled_total", queue=self.name)
+        # Segments hold at most one queue's worth, so replaying one stays bounded
+        if self._spill_lines >= self.maxsize:
+            self._close_segment()
+
+    def _close_segment(self):
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+
+    def _replay(self):
+        # Load the oldest segment into the (empty) queue and delete it
+        path = self._segments.popleft()
+        if not self._segments:
+            self._close_segment()
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    self._items.append(json.loads(line))
+                self._spill_count -= 1
+        os.remove(path)
+
+    def close(self):
+        """
+        Close the segment being spilled to; spilled items stay on disk to be
+        replayed by the next run
+        """
+        self._close_segment()
+
+
+async def stage(name, source, sink, process):
+    """
+    Run a pipeline stage: take items from the source queue, pass them to the
+    process coroutine and put any non-empty result on the sink queue
+    """
+    while True:
+        item = await source.get()
+        with metrics.timer("monitor_loop_seconds", loop=name):
+            result = await process(item)
+        if result and sink is not None:
+            await sink.put(result)
+
+
+def open_queue(name, **options):
+    """
+    Return the queue of a name, creating it if needed
+    """
+    if name not in queues:
+        queues[name] = StageQueue(name, **options)
+    return queues[name]
+
+
+def close_queues():
+    """
+    Close and forget all active queues
+    """
+    while queues:
+        _, queue = queues.popitem()
+        queue.close()
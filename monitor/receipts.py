@@ -0,0 +1,338 @@
+import asyncio
+import collections
+import aiohttp
+
+from rpc import RPCError, format_receipt
+from scheduler import PollScheduler
+
+
+class BlockReceipts:
+    """
+    Fetch the receipts of every transaction in a block at once, with
+    eth_getBlockReceipts when the node supports it and otherwise with
+    chunked eth_getTransactionReceipt batches. Receipts are cached by block
+    hash, so lookups of other transactions in a fetched block never go back
+    to the node.
+
+    Parameters
+    ----------
+    rpc : AsyncRPC
+        open RPC client to the node
+    cache_size : int
+        number of most recently fetched blocks whose receipts are kept
+    chunk_size : int
+        maximum number of calls per batch request when falling back
+
+    """
+
+    def __init__(self, rpc, cache_size=64, chunk_size=100):
+        self.rpc = rpc
+        self.cache_size = cache_size
+        self.chunk_size = chunk_size
+        # Whether the node serves eth_getBlockReceipts, learned on first use
+        self.supported = None
+        self.cache = collections.OrderedDict()
+
+    async def _fetch(self, block):
+        if self.supported is not False:
+            try:
+                receipts = await self.rpc.request("eth_getBlockReceipts", [block["hash"]])
+                self.supported = True
+                return receipts
+            except RPCError:
+                if self.supported:
+                    raise
+                self.supported = False
+        receipts = await self.rpc.batch(
+            "eth_getTransactionReceipt",
+            [[tx_hash] for tx_hash in block["transactions"]],
+            self.chunk_size
+        )
+        # Missing receipts mean the block is no longer canonical
+        return None if None in receipts else receipts
+
+    async def fetch(self, block):
+        """
+        Return the raw receipts of a block (with its hash and transaction
+        hashes) keyed by lowercase transaction hash, or an empty dict if
+        the block has been reorged out
+        """
+        receipts = self.cache.get(block["hash"])
+        if receipts is not None:
+            self.cache.move_to_end(block["hash"])
+            return receipts
+        if not block["transactions"]:
+            return {}
+        fetched = await self._fetch(block)
+        if fetched is None:
+            return {}
+        receipts = {receipt["transactionHash"].lower(): receipt for receipt in fetched}
+        self.cache[block["hash"]] = receipts
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return receipts
+
+
+class TransactionReplaced(Exception):
+    """
+    Awaited transaction whose nonce was used by another mined transaction
+    """
+
+    def __init__(self, tx_hash, replacement=None):
+        super().__init__("Transaction {} was replaced by {}".format(
+            tx_hash, replacement or "another transaction"
+        ))
+        self.tx_hash = tx_hash
+        self.replacement = replacement
+
+
+class TransactionDropped(Exception):
+    """
+    Awaited transaction no longer known to the node, e.g. evicted from its
+    transaction pool
+    """
+
+    def __init__(self, tx_hash):
+        super().__init__("Transaction {} was dropped from the pool".format(tx_hash))
+        self.tx_hash = tx_hash
+
+
+def nonce_key(tx):
+    """
+    (sender, nonce) of a raw JSON-RPC transaction object
+    """
+    return tx["from"].lower(), int(tx["nonce"], 16)
+
+
+class ReceiptTracker:
+    """
+    Resolve awaited transaction hashes from the blocks that mine them. Each
+    new block is fetched once and the receipts of a block mining awaited
+    hashes are fetched together, so the RPC cost grows with the number of
+    blocks rather than with hashes times polls. Hashes are also looked up
+    once, in a batch, when first awaited, in case they were mined before.
+
+    The (sender, nonce) of each awaited transaction is tracked too: when a
+    different transaction with the same nonce is mined, the awaited one
+    fails at once with TransactionReplaced. Awaited transactions that the
+    node no longer knows on two consecutive checks fail with
+    TransactionDropped, or TransactionReplaced if their nonce has been used.
+
+    Parameters
+    ----------
+    rpc : AsyncRPC
+        open RPC client to the node
+    scheduler : PollScheduler
+        head poll scheduler (default: learned block cadence)
+    timeout : float
+        default seconds to wait for a hash before failing with TimeoutError
+    receipts : BlockReceipts
+        per-block receipt fetcher (default: new fetcher over rpc)
+    recheck_interval : float
+        seconds between checks that awaited transactions not yet mined are
+        still known to the node
+
+    """
+
+    def __init__(self, rpc, scheduler=None, timeout=120, receipts=None, recheck_interval=15):
+        self.rpc = rpc
+        self.receipts = receipts or BlockReceipts(rpc)
+        self.scheduler = scheduler or PollScheduler()
+        self.timeout = timeout
+        self.recheck_interval = recheck_interval
+        self.last_block = None
+        # Awaited hashes -> (future, deadline, timeout), and those not yet
+        # looked up
+        self.awaited = {}
+        self._new = set()
+        # Awaited hashes -> (sender, nonce), and the awaited hashes of each
+        self.keys = {}
+        self.nonces = {}
+        # Awaited hashes the node did not know on the last check
+        self._missing = set()
+        self._rechecked = None
+        # Exception the poller stopped with, failing any later wait
+        self.error = None
+        self.counts = {"blocks": 0, "receipts": 0, "replaced": 0, "dropped": 0}
+
+    def __len__(self):
+        return len(self.awaited)
+
+    def wait(self, tx_hash, timeout=None, sender=None, nonce=None):
+        """
+        Return a future resolved with the formatted receipt of a transaction
+        once mined, or failed with TransactionReplaced, TransactionDropped,
+        or TimeoutError after timeout seconds. Give the sender and nonce if
+        known, so that a replacement is noticed even if the node never
+        returns the transaction itself.
+        """
+        tx_hash = tx_hash.lower()
+        if self.error is not None:
+            future = asyncio.get_running_loop().create_future()
+            future.set_exception(self.error)
+            return future
+        if tx_hash not in self.awaited:
+            loop = asyncio.get_running_loop()
+            timeout = self.timeout if timeout is None else timeout
+            self.awaited[tx_hash] = (loop.create_future(), loop.time() + timeout, timeout)
+            self._new.add(tx_hash)
+        if sender is not None and nonce is not None:
+            self._track_key(tx_hash, (sender.lower(), int(nonce)))
+        return self.awaited[tx_hash][0]
+
+    def abort(self, error):
+        """
+        Fail every awaited transaction, and any awaited later, with the
+        exception that stopped the poller
+        """
+        self.error = error
+        for tx_hash in list(self.awaited):
+            self._fail(tx_hash, error)
+
+    def _pop(self, tx_hash):
+        future, _, _ = self.awaited.pop(tx_hash)
+        self._new.discard(tx_hash)
+        self._missing.discard(tx_hash)
+        key = self.keys.pop(tx_hash, None)
+        if key is not None:
+            self.nonces[key].discard(tx_hash)
+            if not self.nonces[key]:
+                del self.nonces[key]
+        return future
+
+    def _resolve(self, receipt):
+        tx_hash = receipt["transactionHash"].lower()
+        key = self.keys.get(tx_hash)
+        future = self._pop(tx_hash)
+        self.counts["receipts"] += 1
+        if not future.done():
+            future.set_result(format_receipt(receipt))
+        # Others awaited with the same nonce were replaced by this one
+        for other in list(self.nonces.get(key, ())):
+            self.counts["replaced"] += 1
+            self._fail(other, TransactionReplaced(other, receipt["transactionHash"]))
+
+    def _fail(self, tx_hash, error):
+        future = self._pop(tx_hash)
+        if not future.done():
+            future.set_exception(error)
+
+    def _track(self, tx):
+        self._track_key(tx["hash"].lower(), nonce_key(tx))
+
+    def _track_key(self, tx_hash, key):
+        if tx_hash in self.awaited and tx_hash not in self.keys:
+            self.keys[tx_hash] = key
+            self.nonces.setdefault(key, set()).add(tx_hash)
+
+    async def _lookup(self, hashes):
+        receipts = await self.rpc.batch("eth_getTransactionReceipt", [[tx_hash] for tx_hash in hashes])
+        for receipt in receipts:
+            if receipt is not None and receipt["transactionHash"].lower() in self.awaited:
+                self._resolve(receipt)
+
+    async def _lookup_new(self, hashes):
+        await self._lookup(hashes)
+        # Sender and nonce of those not mined yet
+        pending = [tx_hash for tx_hash in hashes if tx_hash in self.awaited]
+        if pending:
+            for tx in await self.rpc.batch("eth_getTransactionByHash", [[tx_hash] for tx_hash in pending]):
+                if tx is not None:
+                    self._track(tx)
+
+    async def _scan(self, number):
+        # Full transactions are only needed to match awaited nonces
+        full = bool(self.nonces)
+        block = await self.rpc.request("eth_getBlockByNumber", [hex(number), full])
+        if block is None:
+            return False
+        self.counts["blocks"] += 1
+        if full:
+            for tx in block["transactions"]:
+                for tx_hash in list(self.nonces.get(nonce_key(tx), ())):
+                    if tx_hash != tx["hash"].lower():
+                        self.counts["replaced"] += 1
+                        self._fail(tx_hash, TransactionReplaced(tx_hash, tx["hash"]))
+            block = dict(block, transactions=[tx["hash"] for tx in block["transactions"]])
+        if any(tx_hash.lower() in self.awaited for tx_hash in block["transactions"]):
+            for tx_hash, receipt in (await self.receipts.fetch(block)).items():
+                if tx_hash in self.awaited:
+                    self._resolve(receipt)
+        return True
+
+    async def _recheck(self):
+        pending = [tx_hash for tx_hash in self.awaited if tx_hash not in self._new]
+        if not pending:
+            return
+        txs = await self.rpc.batch("eth_getTransactionByHash", [[tx_hash] for tx_hash in pending])
+        missing, mined = [], []
+        for tx_hash, tx in zip(pending, txs):
+            if tx is None:
+                # A single miss may be a failed call or a slow propagation
+                if tx_hash in self._missing:
+                    missing.append(tx_hash)
+                self._missing.add(tx_hash)
+                continue
+            self._missing.discard(tx_hash)
+            if tx.get("blockHash") is not None:
+                # Mined in a block scanned before it was awaited
+                mined.append(tx_hash)
+            else:
+                self._track(tx)
+        if mined:
+            await self._lookup(mined)
+        senders = sorted({self.keys[tx_hash][0] for tx_hash in missing if tx_hash in self.keys})
+        counts = await self.rpc.batch("eth_getTransactionCount", [[sender, "latest"] for sender in senders])
+        counts = dict(zip(senders, counts))
+        for tx_hash in missing:
+            sender, nonce = self.keys.get(tx_hash, (None, None))
+            if counts.get(sender) is not None and int(counts[sender], 16) > nonce:
+                self.counts["replaced"] += 1
+                self._fail(tx_hash, TransactionReplaced(tx_hash))
+            else:
+                self.counts["dropped"] += 1
+                self._fail(tx_hash, TransactionDropped(tx_hash))
+
+    def _expire(self):
+        now = asyncio.get_running_loop().time()
+        for tx_hash, (future, deadline, timeout) in list(self.awaited.items()):
+            if now >= deadline or future.cancelled():
+                self._fail(tx_hash, TimeoutError(
+                    "Transaction {} is not in the chain, after {:g} seconds".format(tx_hash, timeout)
+                ))
+
+    async def poll(self):
+        """
+        Scan blocks mined since the last poll, then look up hashes awaited
+        since, resolving every awaited hash found, and periodically check
+        that the others are still known to the node
+        """
+        header = await self.rpc.request("eth_getBlockByNumber", ["latest", False])
+        head = int(header["number"], 16)
+        if self.last_block is None:
+            self.last_block = head
+        self.scheduler.observe(head, int(header["timestamp"], 16))
+        while self.last_block < head and await self._scan(self.last_block + 1):
+            self.last_block += 1
+        # Hashes mined up to the scanned head have receipts by now
+        if self._new:
+            new, self._new = list(self._new), set()
+            await self._lookup_new(new)
+        now = asyncio.get_running_loop().time()
+        if self._rechecked is None:
+            self._rechecked = now
+        elif now - self._rechecked >= self.recheck_interval:
+            self._rechecked = now
+            await self._recheck()
+        self._expire()
+
+    async def run(self):
+        """
+        Poll for new blocks just after each is expected, until cancelled
+        """
+        while True:
+            try:
+                await self.poll()
+            except (RPCError, aiohttp.ClientError, asyncio.TimeoutError):
+                self.scheduler.error()
+            await asyncio.sleep(self.scheduler.delay())
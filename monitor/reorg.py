@@ -0,0 +1,130 @@
+import collections
+
+
+class ReorgTracker:
+    """
+    Bounded ring buffer of the most recent canonical blocks and their contract
+    events, used to detect chain reorganisations, retract events from
+    orphaned blocks and hold events back until they are confirmed
+
+    Parameters
+    ----------
+    depth : int
+        number of recent blocks kept in the buffer (deepest detectable reorg),
+        raised to confirmations + 1 if lower so that no block leaves the
+        buffer before its events are confirmed
+    confirmations : int
+        number of blocks that must be built on top of a block before its
+        events are emitted (0 emits events as soon as they are seen)
+
+    """
+
+    def __init__(self, depth=64, confirmations=0):
+        self.depth = max(depth, confirmations + 1)
+        self.confirmations = confirmations
+        self.blocks = collections.deque()
+        self.index = {}
+        # Events seen before their block header (e.g. log notifications)
+        self._early = collections.OrderedDict()
+
+    @property
+    def tip(self):
+        return self.blocks[-1] if self.blocks else None
+
+    @property
+    def oldest(self):
+        return self.blocks[0]["number"] if self.blocks else None
+
+    def add_block(self, header, emitted=False):
+        """
+        Append a canonical block header on top of the buffer
+        """
+        block = {
+            "number": int(header["number"], 16),
+            "hash": header["hash"],
+            "parentHash": header["parentHash"],
+            "events": self._early.pop(header["hash"], []),
+            "emitted": emitted,
+        }
+        self.blocks.append(block)
+        self.index[block["hash"]] = block
+        while len(self.blocks) > self.depth:
+            self.index.pop(self.blocks.popleft()["hash"], None)
+        return block
+
+    def reset(self):
+        """
+        Forget all tracked blocks and early events
+        """
+        self.blocks.clear()
+        self.index.clear()
+        self._early.clear()
+
+    def rollback(self, ancestor):
+        """
+        Remove all blocks above the common ancestor block number, returning
+        retraction records for events already emitted from them
+        """
+        retractions = []
+        while self.blocks and self.blocks[-1]["number"] > ancestor:
+            block = self.blocks.pop()
+            del self.index[block["hash"]]
+            if block["emitted"]:
+                retractions.extend(retraction(event) for event in block["events"])
+        return retractions
+
+    def add_event(self, event):
+        """
+        Attach a decoded event to its block, returning it for emitting if the
+        block is already confirmed. Events already attached to the block (e.g.
+        seen by both a backfill and a subscription) are ignored.
+        """
+        block_hash = event["blockHash"].hex()
+        block = self.index.get(block_hash)
+        events = block["events"] if block is not None else self._early.get(block_hash, [])
+        if any(e["logIndex"] == event["logIndex"] for e in events):
+            return []
+        if block is None:
+            self._early.setdefault(block_hash, []).append(event)
+            while len(self._early) > self.depth:
+                self._early.popitem(last=False)
+            return []
+        block["events"].append(event)
+        return [event] if block["emitted"] else []
+
+    def retract(self, event):
+        """
+        Remove an event reported as removed by the node, returning its
+        retraction record if it had already been emitted
+        """
+        block_hash = event["blockHash"].hex()
+        block = self.index.get(block_hash)
+        if block is None:
+            events = self._early.get(block_hash, [])
+            events[:] = [e for e in events if e["logIndex"] != event["logIndex"]]
+            return []
+        kept = [e for e in block["events"] if e["logIndex"] != event["logIndex"]]
+        removed = len(kept) != len(block["events"])
+        block["events"] = kept
+        return [retraction(event)] if removed and block["emitted"] else []
+
+    def confirm(self, head):
+        """
+        Mark blocks with enough confirmations at the given head as emitted,
+        returning their events in block order
+        """
+        events = []
+        for block in self.blocks:
+            if block["number"] > head - self.confirmations:
+                break
+            if not block["emitted"]:
+                block["emitted"] = True
+                events.extend(block["events"])
+        return events
+
+
+def retraction(event):
+    """
+    Retraction record for an event from an orphaned block
+    """
+    return dict(event, removed=True)
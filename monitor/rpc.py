@@ -0,0 +1,398 @@
+import asyncio
+import itertools
+import json
+import time
+import aiohttp
+import requests
+from hexbytes import HexBytes
+from web3 import Web3
+
+import metrics
+
+
+# Hex-encoded QUANTITY fields of a transaction object returned by the node
+TRANSACTION_QUANTITIES = (
+    "blockNumber",
+    "chainId",
+    "gas",
+    "gasPrice",
+    "maxFeePerGas",
+    "maxPriorityFeePerGas",
+    "nonce",
+    "transactionIndex",
+    "value",
+    "v",
+)
+
+# Hex-encoded QUANTITY fields of a log object returned by the node
+LOG_QUANTITIES = ("blockNumber", "logIndex", "transactionIndex")
+
+# Hex-encoded QUANTITY fields of a transaction receipt returned by the node
+RECEIPT_QUANTITIES = (
+    "blockNumber",
+    "cumulativeGasUsed",
+    "effectiveGasPrice",
+    "gasUsed",
+    "status",
+    "transactionIndex",
+)
+
+session = requests.Session()
+
+
+class RPCError(Exception):
+    """
+    Error object returned by the node for a JSON-RPC request
+    """
+
+    def __init__(self, error):
+        super().__init__(error.get("message", error))
+        self.code = error.get("code")
+        self.message = error.get("message")
+
+
+class AsyncRPC:
+    """
+    Minimal asynchronous JSON-RPC client over a single keep-alive HTTP
+    connection pool, capping the number of in-flight requests to the node
+    """
+
+    def __init__(self, endpoint_uri, max_concurrency=8, timeout=10):
+        self.endpoint_uri = endpoint_uri
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self._ids = itertools.count()
+        self._session = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def open(self):
+        """
+        Create the shared session; must be called from the running event loop
+        """
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+            timeout=aiohttp.ClientTimeout(total=self.timeout)
+        )
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _post(self, method, payload):
+        async with self._semaphore:
+            started = time.perf_counter()
+            try:
+                async with self._session.post(self.endpoint_uri, json=payload) as response:
+                    response.raise_for_status()
+                    return await response.json(content_type=None)
+            except Exception:
+                metrics.inc("monitor_rpc_errors_total", method=method)
+                raise
+            finally:
+                metrics.observe("monitor_rpc_seconds", time.perf_counter() - started, method=method)
+
+    async def request(self, method, params=None):
+        """
+        Issue a single JSON-RPC request and return its raw result
+        """
+        metrics.inc("monitor_rpc_requests_total", method=method)
+        reply = await self._post(method, {
+            "jsonrpc": "2.0",
+            "method": method,
+            "params": params if params is not None else [],
+            "id": next(self._ids),
+        })
+        if reply.get("error"):
+            metrics.inc("monitor_rpc_errors_total", method=method)
+            raise RPCError(reply["error"])
+        return reply.get("result")
+
+    async def batch(self, method, params, chunk_size=100):
+        """
+        Resolve a list of calls to the same RPC method with concurrent
+        JSON-RPC batch requests of up to chunk_size calls each, returning raw
+        results in the order of params (None for failed calls). Raises
+        RPCError if the node rejects a whole batch.
+        """
+
+        async def send(chunk):
+            ids = [next(self._ids) for _ in chunk]
+            metrics.inc("monitor_rpc_requests_total", len(chunk), method=method)
+            replies = await self._post(method, [
+                {"jsonrpc": "2.0", "method": method, "params": p, "id": i}
+                for i, p in zip(ids, chunk)
+            ])
+            if not isinstance(replies, list):
+                # A node rejecting the whole batch answers with one error object
+                metrics.inc("monitor_rpc_errors_total", len(chunk), method=method)
+                raise RPCError(replies.get("error") or {"message": "invalid batch reply"})
+            results = {reply["id"]: reply.get("result") for reply in replies}
+            return [results.get(i) for i in ids]
+
+        chunks = await asyncio.gather(*(
+            send(params[start:start + chunk_size])
+            for start in range(0, len(params), chunk_size)
+        ))
+        return [result for chunk in chunks for result in chunk]
+
+
+class WSRPC:
+    """
+    Asynchronous JSON-RPC client over a WebSocket connection, supporting the
+    same request/batch interface as AsyncRPC plus eth_subscribe streams
+    """
+
+    def __init__(self, endpoint_uri, timeout=10, heartbeat=30):
+        self.endpoint_uri = endpoint_uri
+        self.timeout = timeout
+        self.heartbeat = heartbeat
+        self._ids = itertools.count()
+        self._session = None
+        self._ws = None
+        self._reader = None
+        self._replies = {}
+        self._subscriptions = {}
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def open(self):
+        """
+        Connect to the node and start dispatching incoming messages
+        """
+        self._session = aiohttp.ClientSession()
+        self._ws = await self._session.ws_connect(
+            self.endpoint_uri,
+            heartbeat=self.heartbeat,
+            max_msg_size=0
+        )
+        self._reader = asyncio.ensure_future(self._read())
+
+    async def close(self):
+        if self._reader is not None:
+            self._reader.cancel()
+            self._reader = None
+        if self._ws is not None:
+            await self._ws.close()
+            self._ws = None
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        self._disconnect()
+
+    def _disconnect(self):
+        # Fail outstanding requests, all still awaited, and wake subscription
+        # consumers
+        for future in self._replies.values():
+            if not future.done():
+                future.set_exception(ConnectionError("WebSocket connection closed"))
+        self._replies = {}
+        for queue in self._subscriptions.values():
+            queue.put_nowait(None)
+        self._subscriptions = {}
+
+    def _dispatch(self, message):
+        if message.get("method") == "eth_subscription":
+            params = message["params"]
+            self.subscription(params["subscription"]).put_nowait(params["result"])
+            return
+        future = self._replies.pop(message.get("id"), None)
+        if future is not None and not future.done():
+            future.set_result(message)
+
+    async def _read(self):
+        try:
+            async for msg in self._ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    break
+                data = json.loads(msg.data)
+                for message in data if isinstance(data, list) else [data]:
+                    self._dispatch(message)
+        finally:
+            self._disconnect()
+
+    def _expect(self, request_id):
+        future = asyncio.get_running_loop().create_future()
+        self._replies[request_id] = future
+        return future
+
+    async def request(self, method, params=None):
+        """
+        Issue a single JSON-RPC request and return its raw result
+        """
+        request_id = next(self._ids)
+        future = self._expect(request_id)
+        metrics.inc("monitor_rpc_requests_total", method=method)
+        with metrics.timer("monitor_rpc_seconds", method=method):
+            try:
+                await self._ws.send_json({
+                    "jsonrpc": "2.0",
+                    "method": method,
+                    "params": params if params is not None else [],
+                    "id": request_id,
+                })
+                reply = await asyncio.wait_for(future, self.timeout)
+            except Exception:
+                metrics.inc("monitor_rpc_errors_total", method=method)
+                raise
+            finally:
+                # Nobody waits for a reply after a failure or cancellation
+                self._replies.pop(request_id, None)
+        if reply.get("error"):
+            metrics.inc("monitor_rpc_errors_total", method=method)
+            raise RPCError(reply["error"])
+        return reply.get("result")
+
+    async def batch(self, method, params, chunk_size=100):
+        """
+        Resolve a list of calls to the same RPC method with JSON-RPC batch
+        messages of up to chunk_size calls each, returning raw results in the
+        order of params (None for failed calls)
+        """
+        results = []
+        for start in range(0, len(params), chunk_size):
+            chunk = params[start:start + chunk_size]
+            ids = [next(self._ids) for _ in chunk]
+            futures = [self._expect(i) for i in ids]
+            metrics.inc("monitor_rpc_requests_total", len(chunk), method=method)
+            with metrics.timer("monitor_rpc_seconds", method=method):
+                try:
+                    await self._ws.send_json([
+                        {"jsonrpc": "2.0", "method": method, "params": p, "id": i}
+                        for i, p in zip(ids, chunk)
+                    ])
+                    replies = await asyncio.wait_for(asyncio.gather(*futures), self.timeout)
+                except Exception:
+                    metrics.inc("monitor_rpc_errors_total", method=method)
+                    raise
+                finally:
+                    for i in ids:
+                        self._replies.pop(i, None)
+            results.extend(reply.get("result") for reply in replies)
+        return results
+
+    def subscription(self, subscription_id):
+        """
+        Queue of notifications for a subscription; a None item signals that
+        the connection was lost
+        """
+        return self._subscriptions.setdefault(subscription_id, asyncio.Queue())
+
+    async def subscribe(self, params):
+        """
+        Start an eth_subscribe stream and return its notification queue
+        """
+        return self.subscription(await self.request("eth_subscribe", params))
+
+
+def batch_request(web3, method, params, chunk_size=100, timeout=10, errors=False):
+    """
+    Resolve a list of calls to the same RPC method with JSON-RPC batch
+    requests of up to chunk_size calls each, raising RPCError if the node
+    rejects a whole batch
+
+    Parameters
+    ----------
+    web3 : Web3
+        connected instance with an HTTP provider
+    method : str
+        the JSON-RPC method to call, e.g. "eth_getTransactionByHash"
+    params : list
+        one parameter list per call
+    chunk_size : int
+        maximum number of calls per HTTP request
+    timeout : float
+        HTTP request timeout in seconds
+    errors : bool
+        return an RPCError for each failed call instead of None
+
+    Returns
+    -------
+    results : list
+        raw results in the same order as params (None for failed calls)
+
+    """
+    results = []
+    for start in range(0, len(params), chunk_size):
+        chunk = params[start:start + chunk_size]
+        payload = [
+            {"jsonrpc": "2.0", "method": method, "params": p, "id": i}
+            for i, p in enumerate(chunk)
+        ]
+        response = session.post(
+            web3.provider.endpoint_uri,
+            json=payload,
+            timeout=timeout
+        )
+        response.raise_for_status()
+        body = response.json()
+        if not isinstance(body, list):
+            # A node rejecting the whole batch answers with one error object
+            raise RPCError(body.get("error") or {"message": "invalid batch reply"})
+        replies = {
+            reply["id"]: RPCError(reply["error"]) if errors and reply.get("error") else reply.get("result")
+            for reply in body
+        }
+        results.extend(replies.get(i) for i in range(len(chunk)))
+    return results
+
+
+def format_transaction(tx):
+    """
+    Convert a raw JSON-RPC transaction object to the field types returned
+    by web3.eth.get_transaction
+    """
+    formatted = dict(tx)
+    for key in TRANSACTION_QUANTITIES:
+        if formatted.get(key) is not None:
+            formatted[key] = int(formatted[key], 16)
+    for key in ("from", "to"):
+        if formatted.get(key) is not None:
+            formatted[key] = Web3.toChecksumAddress(formatted[key])
+    return formatted
+
+
+def format_log(log):
+    """
+    Convert a raw JSON-RPC log object to the field types returned by
+    web3.eth.get_logs, as expected by ContractEvent.processLog
+    """
+    formatted = dict(log)
+    for key in LOG_QUANTITIES:
+        if formatted.get(key) is not None:
+            formatted[key] = int(formatted[key], 16)
+    for key in ("blockHash", "transactionHash"):
+        if formatted.get(key) is not None:
+            formatted[key] = HexBytes(formatted[key])
+    formatted["topics"] = [HexBytes(topic) for topic in formatted["topics"]]
+    formatted["address"] = Web3.toChecksumAddress(formatted["address"])
+    return formatted
+
+
+def format_receipt(receipt):
+    """
+    Convert a raw JSON-RPC transaction receipt to the field types returned
+    by web3.eth.get_transaction_receipt
+    """
+    formatted = dict(receipt)
+    for key in RECEIPT_QUANTITIES:
+        if formatted.get(key) is not None:
+            formatted[key] = int(formatted[key], 16)
+    for key in ("contractAddress", "from", "to"):
+        if formatted.get(key) is not None:
+            formatted[key] = Web3.toChecksumAddress(formatted[key])
+    formatted["logs"] = [format_log(log) for log in formatted.get("logs", [])]
+    return formatted
@@ -0,0 +1,259 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from web3 import Web3
+from web3.middleware import geth_poa_middleware
+
+from events import build_topic_map, decode_log, fetch_log_chunks
+from rpc import AsyncRPC
+from writer import close_writers, open_writer
+
+
+def split_range(from_block, to_block, shard_size):
+    """
+    Split an inclusive block range into consecutive (start, end) shards
+    """
+    return [
+        (start, min(start + shard_size - 1, to_block))
+        for start in range(from_block, to_block + 1, shard_size)
+    ]
+
+
+async def scan_shard(rpc, contract, topics, start, end):
+    """
+    Fetch and decode all contract events in one shard, in block/log order
+    """
+    events = []
+    async for _, logs in fetch_log_chunks(rpc, [contract.address], topics, start, end):
+        for log in logs:
+            event = decode_log(log, topics)
+            if event is not None:
+                events.append(event)
+    return events
+
+
+async def scan(
+        rpc,
+        contract,
+        from_block,
+        to_block,
+        outfile,
+        shard_size=10000,
+        workers=8,
+        report_interval=5,
+        verbose=False
+):
+    """
+    Scan a block range for contract events with a pool of concurrent shard
+    workers, writing events to outfile in (block, log index) order
+
+    Returns
+    -------
+    stats : dict
+        blocks and events scanned, elapsed seconds and resulting rates
+
+    """
+    topics = build_topic_map(contract)
+    shards = split_range(from_block, to_block, shard_size)
+    queue = asyncio.Queue()
+    for index, shard in enumerate(shards):
+        queue.put_nowait((index, shard))
+
+    # Shards complete out of order; hold results until all earlier shards
+    # have been written so the output stays ordered, bounding how far the
+    # workers may run ahead of the writer
+    results = {}
+    ready = asyncio.Event()
+    window = asyncio.Semaphore(workers * 4)
+    stats = {"blocks": 0, "events": 0}
+
+    async def worker():
+        while True:
+            # Take a window slot before a shard so slots always go to the
+            # lowest shards not yet written
+            await window.acquire()
+            if queue.empty():
+                window.release()
+                return
+            index, (start, end) = queue.get_nowait()
+            results[index] = await scan_shard(rpc, contract, topics, start, end)
+            ready.set()
+
+    async def emit():
+        writer = open_writer(outfile)
+        for index, (start, end) in enumerate(shards):
+            while index not in results:
+                ready.clear()
+                await ready.wait()
+            events = results.pop(index)
+            window.release()
+            for event in events:
+                if verbose:
+                    print(Web3.toJSON(event))
+                writer.write(event)
+            stats["blocks"] += end - start + 1
+            stats["events"] += len(events)
+
+    async def report(started):
+        while True:
+            await asyncio.sleep(report_interval)
+            print_stats(stats, time.monotonic() - started)
+
+    started = time.monotonic()
+    reporter = asyncio.ensure_future(report(started))
+    try:
+        async with rpc:
+            await asyncio.gather(emit(), *(worker() for _ in range(workers)))
+    finally:
+        reporter.cancel()
+        await close_writers()
+
+    stats["elapsed"] = time.monotonic() - started
+    return stats
+
+
+def print_stats(stats, elapsed):
+    """
+    Print scan progress with block and event throughput
+    """
+    print("[scan] {} blocks, {} events in {:.1f}s ({:.0f} blocks/s, {:.0f} events/s)".format(
+        stats["blocks"],
+        stats["events"],
+        elapsed,
+        stats["blocks"] / elapsed if elapsed else 0,
+        stats["events"] / elapsed if elapsed else 0
+    ))
+
+
+if __name__ == "__main__":
+    """
+    Script to rebuild a contract event log from the chain history by scanning
+    a block range in shards with a pool of concurrent workers, writing all
+    decoded contract events (Result, PoolBalance, PoolExhausted) in block and
+    log index order and reporting blocks/s and events/s throughput.
+
+    Usage:
+
+        scan.py [-h] -c CONTRACT --abi ABI --config CONFIG [--from-block FROM_BLOCK]
+                [--to-block TO_BLOCK] [-o OUTPUT] [--shard-size SHARD_SIZE]
+                [--workers WORKERS] [-v]
+
+    Required Arguments:
+
+        -c CONTRACT, --contract CONTRACT
+                                contract address to scan
+        --abi ABI               contract ABI or full path to ABI file
+        --config CONFIG         path to network provider RPC server config.json
+
+    Optional Arguments:
+
+        -h, --help              show this help message and exit
+        --from-block FROM_BLOCK
+                                first block to scan, e.g. the contract deployment block (default: 0)
+        --to-block TO_BLOCK     last block to scan (default: latest)
+        -o OUTPUT, --output OUTPUT
+                                path to output event log file (default: ./output/event.log)
+        --shard-size SHARD_SIZE
+                                blocks per shard handed to a worker (default: 10000)
+        --workers WORKERS       number of concurrent shard workers (default: 8)
+        -v, --verbose           additionally log to command line
+
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-c", "--contract",
+        help="contract address to scan",
+        type=str,
+        required=True
+    )
+    parser.add_argument(
+        "--abi",
+        help="contract ABI or full path to ABI file",
+        type=str,
+        required=True
+    )
+    parser.add_argument(
+        "--config",
+        help="path to network provider RPC server config.json",
+        type=str,
+        required=True
+    )
+    parser.add_argument(
+        "--from-block",
+        help="first block to scan, e.g. the contract deployment block (default: 0)",
+        type=int,
+        required=False,
+        default=0
+    )
+    parser.add_argument(
+        "--to-block",
+        help="last block to scan (default: latest)",
+        type=int,
+        required=False
+    )
+    parser.add_argument(
+        "-o", "--output",
+        help="path to output event log file (default: ./output/event.log)",
+        type=str,
+        required=False,
+        default=os.path.join("./output", "event.log")
+    )
+    parser.add_argument(
+        "--shard-size",
+        help="blocks per shard handed to a worker (default: 10000)",
+        type=int,
+        required=False,
+        default=10000
+    )
+    parser.add_argument(
+        "--workers",
+        help="number of concurrent shard workers (default: 8)",
+        type=int,
+        required=False,
+        default=8
+    )
+    parser.add_argument(
+        "-v", "--verbose",
+        help="additionally log to command line",
+        action="store_true"
+    )
+
+    args = parser.parse_args()
+
+    # Load provider config.json
+    if os.path.exists(os.path.normpath(args.config)):
+        with open(os.path.normpath(args.config)) as f:
+            provider = json.loads(f.read())
+    else:
+        raise FileNotFoundError()
+    web3 = Web3(Web3.HTTPProvider(provider["url"] + ":" + str(provider["port"])))
+    web3.middleware_onion.inject(geth_poa_middleware, layer=0)
+
+    # Load contract
+    if os.path.exists(os.path.normpath(args.abi)):
+        with open(os.path.normpath(args.abi)) as f:
+            contract = web3.eth.contract(address=args.contract, abi=f.read())
+    else:
+        contract = web3.eth.contract(address=args.contract, abi=args.abi)
+
+    to_block = args.to_block if args.to_block is not None else web3.eth.block_number
+
+    # Create output path if required
+    outdir = os.path.dirname(args.output)
+    if outdir and not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    stats = asyncio.run(scan(
+        AsyncRPC(web3.provider.endpoint_uri, args.workers),
+        contract,
+        args.from_block,
+        to_block,
+        args.output,
+        args.shard_size,
+        args.workers,
+        verbose=args.verbose
+    ))
+    print_stats(stats, stats["elapsed"])
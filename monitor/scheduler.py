@@ -0,0 +1,133 @@
+import time
+
+
+class PollScheduler:
+    """
+    Poll delay scheduler that learns the chain's block cadence from observed
+    head timestamps. It sleeps until just after the next block is expected,
+    polls tightly (backing off gradually) while a block is overdue, and backs
+    off exponentially on empty polls when no cadence is known (e.g. pending
+    transaction filters) and on node errors.
+
+    Parameters
+    ----------
+    block_time : float
+        initial expected seconds between blocks, before any are observed
+        (None to start from tight polling)
+    min_interval : float
+        shortest delay between polls
+    max_interval : float
+        longest delay between polls
+    margin : float
+        seconds to wait past the expected block time before polling
+    backoff : float
+        factor by which the delay grows with each consecutive empty poll or
+        error
+    alpha : float
+        weight of the latest block interval in its moving average
+
+    """
+
+    def __init__(
+            self,
+            block_time=None,
+            min_interval=0.5,
+            max_interval=15,
+            margin=0.25,
+            backoff=1.5,
+            alpha=0.2
+    ):
+        self.interval = block_time
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.margin = margin
+        self.backoff = backoff
+        self.alpha = alpha
+        self.last_number = None
+        self.last_timestamp = None
+        self.misses = 0
+        self.errors = 0
+        self.counts = {"polls": 0, "empty": 0, "errors": 0, "blocks": 0}
+        self.observed = None
+        self.lag = None
+        self.total_lag = 0.0
+
+    def _backoff(self, count):
+        return min(self.min_interval * self.backoff ** count, self.max_interval)
+
+    def delay(self):
+        """
+        Seconds to sleep before the next poll
+        """
+        if self.errors:
+            return self._backoff(self.errors)
+        if self.interval is None or self.last_timestamp is None:
+            return self._backoff(self.misses)
+        wait = self.last_timestamp + self.interval + self.margin - time.time()
+        if wait > 0:
+            return min(wait, self.max_interval)
+        # Block overdue: poll tightly, easing off the longer it is late
+        return self._backoff(self.misses)
+
+    def observe(self, number, timestamp):
+        """
+        Record a new head block, updating the moving average block interval.
+        Heads at or below the last observed block are ignored.
+        """
+        if self.last_number is not None and number <= self.last_number:
+            return
+        self.counts["polls"] += 1
+        self.misses = 0
+        self.errors = 0
+        if self.last_number is not None:
+            observed = (timestamp - self.last_timestamp) / (number - self.last_number)
+            self.observed = observed
+            if self.interval is None:
+                self.interval = observed
+            else:
+                self.interval += self.alpha * (observed - self.interval)
+        self.last_number = number
+        self.last_timestamp = timestamp
+        self.counts["blocks"] += 1
+        # Seconds between the block timestamp and noticing it
+        self.lag = max(time.time() - timestamp, 0.0)
+        self.total_lag += self.lag
+
+    def active(self):
+        """
+        Record a poll that returned new entries
+        """
+        self.counts["polls"] += 1
+        self.misses = 0
+        self.errors = 0
+
+    def idle(self):
+        """
+        Record a poll that returned nothing new
+        """
+        self.counts["polls"] += 1
+        self.counts["empty"] += 1
+        self.misses += 1
+        self.errors = 0
+
+    def error(self):
+        """
+        Record a failed poll
+        """
+        self.counts["polls"] += 1
+        self.counts["errors"] += 1
+        self.errors += 1
+
+    def stats(self):
+        """
+        Observed against expected block timing and poll counts
+        """
+        blocks = self.counts["blocks"]
+        return dict(
+            self.counts,
+            expected_interval=self.interval,
+            observed_interval=self.observed,
+            detection_lag=self.lag,
+            mean_detection_lag=self.total_lag / blocks if blocks else None,
+            polls_per_block=self.counts["polls"] / blocks if blocks else None,
+        )
@@ -0,0 +1,236 @@
+import argparse
+import gzip
+import json
+import os
+import shutil
+import time
+
+
+# Segments of an output file are kept in a folder named after it
+SEGMENTS_SUFFIX = ".segments"
+INDEX_FILE = "index.json"
+
+
+def segment_folder(outfile):
+    return outfile + SEGMENTS_SUFFIX
+
+
+def segment_name(sequence):
+    return "{:08d}.jsonl".format(sequence)
+
+
+def new_entry(name):
+    """
+    Index entry of an empty segment; "closed" stays None while the segment
+    is being written
+    """
+    return {
+        "name": name,
+        "records": 0,
+        "fromBlock": None,
+        "toBlock": None,
+        "opened": time.time(),
+        "closed": None,
+    }
+
+
+def update_entry(entry, record):
+    """
+    Count a record in its segment's entry, extending the block range
+    """
+    entry["records"] += 1
+    block = record.get("blockNumber")
+    if block is not None:
+        if entry["fromBlock"] is None or block < entry["fromBlock"]:
+            entry["fromBlock"] = block
+        if entry["toBlock"] is None or block > entry["toBlock"]:
+            entry["toBlock"] = block
+
+
+def load_index(folder):
+    """
+    Return the segment index entries in folder, oldest first
+    """
+    path = os.path.join(folder, INDEX_FILE)
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)["segments"]
+
+
+def save_index(folder, entries):
+    """
+    Atomically write the segment index to folder
+    """
+    path = os.path.join(folder, INDEX_FILE)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"segments": entries}, f, indent=1)
+    os.replace(tmp, path)
+
+
+def recover_index(folder):
+    """
+    Reconcile the index with the segment files in folder after a restart or
+    crash: segments missing from the index, or still open in it, are
+    rescanned and entries of deleted segments dropped
+    """
+    entries = {entry["name"].replace(".gz", ""): entry for entry in load_index(folder)}
+    names = sorted({
+        filename.replace(".gz", "") for filename in os.listdir(folder)
+        if filename.endswith((".jsonl", ".jsonl.gz"))
+    })
+    recovered = []
+    for name in names:
+        # A segment may be found both before and after compression
+        filename = name if os.path.exists(os.path.join(folder, name)) else name + ".gz"
+        entry = entries.get(name)
+        if entry is None or entry["closed"] is None or entry["name"] != filename:
+            entry = dict(entry or new_entry(name), name=filename, records=0, fromBlock=None, toBlock=None)
+            with open_segment(folder, filename) as f:
+                for line in f:
+                    if line.strip():
+                        update_entry(entry, json.loads(line))
+        recovered.append(entry)
+    # Only the newest segment can still be open
+    for entry in recovered[:-1]:
+        if entry["closed"] is None:
+            entry["closed"] = time.time()
+    return recovered
+
+
+def compress_segment(folder, name):
+    """
+    Compress a closed segment, returning its new file name
+    """
+    path = os.path.join(folder, name)
+    with open(path, "rb") as src, gzip.open(path + ".gz.tmp", "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.replace(path + ".gz.tmp", path + ".gz")
+    os.remove(path)
+    return name + ".gz"
+
+
+def open_segment(folder, name):
+    """
+    Open a segment for streaming its lines, whether or not it has been
+    compressed since it was indexed
+    """
+    path = os.path.join(folder, name)
+    if not name.endswith(".gz") and not os.path.exists(path):
+        path += ".gz"
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt")
+    return open(path)
+
+
+def read_records(outfile, from_block=None, to_block=None):
+    """
+    Iterate the records of an output file in write order, one segment at a
+    time, yielding only those within [from_block, to_block] if given.
+    Segments outside the range are skipped using the index, and records
+    without a block number are only yielded when no range is given. Plain
+    (unsegmented) output files are read too.
+    """
+    ranged = from_block is not None or to_block is not None
+    folder = segment_folder(outfile)
+    if os.path.isdir(folder):
+        entries = load_index(folder)
+        # Segments created since the index was last written are still read
+        indexed = {entry["name"].replace(".gz", "") for entry in entries}
+        entries += [
+            new_entry(filename) for filename in sorted(os.listdir(folder))
+            if filename.endswith(".jsonl") and filename not in indexed
+        ]
+        sources = [(folder, entry) for entry in entries]
+    else:
+        sources = [(os.path.dirname(outfile), new_entry(os.path.basename(outfile)))]
+
+    for folder, entry in sources:
+        # The block range of the open segment may have grown since indexed
+        if entry["closed"] is not None and ranged:
+            if entry["toBlock"] is None:
+                continue
+            if from_block is not None and entry["toBlock"] < from_block:
+                continue
+            if to_block is not None and entry["fromBlock"] > to_block:
+                continue
+        with open_segment(folder, entry["name"]) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if ranged:
+                    block = record.get("blockNumber")
+                    if block is None:
+                        continue
+                    if from_block is not None and block < from_block:
+                        continue
+                    if to_block is not None and block > to_block:
+                        continue
+                yield record
+
+
+if __name__ == "__main__":
+    """
+    Script to read the records of a monitor output file written as segments
+    (with --segment-size or --segment-interval), or of a plain output file,
+    as JSON lines, optionally only those within a block range, or to print
+    the segment index.
+
+    Usage:
+
+        segments.py [-h] [--from-block FROM_BLOCK] [--to-block TO_BLOCK] [--index] log
+
+    Required Arguments:
+
+        log                     path to output file (e.g., ./output/event.log)
+
+    Optional Arguments:
+
+        -h, --help              show this help message and exit
+        --from-block FROM_BLOCK
+                                only print records from this block number
+        --to-block TO_BLOCK     only print records up to this block number
+        --index                 print the block range and record count of each segment instead
+
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "log",
+        help="path to output file (e.g., ./output/event.log)",
+        type=str
+    )
+    parser.add_argument(
+        "--from-block",
+        help="only print records from this block number",
+        type=int,
+        required=False
+    )
+    parser.add_argument(
+        "--to-block",
+        help="only print records up to this block number",
+        type=int,
+        required=False
+    )
+    parser.add_argument(
+        "--index",
+        help="print the block range and record count of each segment instead",
+        action="store_true"
+    )
+
+    args = parser.parse_args()
+
+    if args.index:
+        for entry in load_index(segment_folder(args.log)):
+            print("{name:<20} {records:>8} records  blocks {fromBlock} - {toBlock}{state}".format(
+                state="" if entry["closed"] is not None else "  (open)",
+                **entry
+            ))
+    else:
+        try:
+            for record in read_records(args.log, args.from_block, args.to_block):
+                print(json.dumps(record))
+        except BrokenPipeError:
+            pass
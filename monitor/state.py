@@ -0,0 +1,215 @@
+import json
+import os
+import time
+from aiohttp import web
+
+
+SNAPSHOT_FILE = "state.json"
+
+# PoolBalance updates kept per contract to restore the balance on retraction
+POOL_HISTORY = 64
+
+
+def new_totals():
+    return {"bets": 0, "wagered": 0, "wins": 0, "payouts": 0}
+
+
+def new_contract():
+    return dict(
+        new_totals(),
+        pool=None,
+        poolHistory=[],
+        exhausted=False,
+        rolls={str(roll): 0 for roll in range(1, 11)},
+        accounts={}
+    )
+
+
+class GameState:
+    """
+    Live aggregate of NumberBet game state per contract, updated
+    incrementally from Result, PoolBalance and PoolExhausted events (and
+    their retractions) and periodically snapshotted to disk
+
+    Parameters
+    ----------
+    snapshot_interval : float
+        minimum seconds between snapshots taken at checkpoints
+
+    """
+
+    def __init__(self, snapshot_interval=60):
+        self.snapshot_interval = snapshot_interval
+        self.contracts = {}
+        # Block of the last snapshot, and the events applied above it
+        self.block = None
+        self.recent = {}
+        self._saved = 0
+        # After loading a snapshot, events the monitor replays that are
+        # already in it are skipped, up to the last block it has events from
+        self._skip_block = None
+        self._skip_end = None
+        self._skip = set()
+
+    def apply(self, event):
+        """
+        Fold a contract event, or retraction of one, into the state
+        """
+        block, index = event["blockNumber"], event["logIndex"]
+        removed = event.get("removed", False)
+        if not removed and self._skip_end is not None:
+            if block > self._skip_end:
+                self._skip_end = None
+                self._skip = set()
+            elif block <= self._skip_block or (block, index) in self._skip:
+                return
+
+        contract = self.contracts.setdefault(event["address"].lower(), new_contract())
+        args = event["args"]
+        sign = -1 if removed else 1
+        if event["event"] == "Result":
+            account = contract["accounts"].setdefault(args["account"].lower(), new_totals())
+            win = args["result"] == "Winner"
+            for totals in (contract, account):
+                totals["bets"] += sign
+                totals["wagered"] += sign * args["bet"]
+                totals["wins"] += sign * win
+                # Winners are paid 10x their bet
+                totals["payouts"] += sign * win * 10 * args["bet"]
+            contract["rolls"][str(args["roll"])] += sign
+        elif event["event"] == "PoolBalance":
+            history = contract["poolHistory"]
+            if removed:
+                history[:] = [entry for entry in history if entry[:2] != [block, index]]
+            else:
+                history.append([block, index, args["amount"]])
+                del history[:-POOL_HISTORY]
+            contract["pool"] = history[-1][2] if history else None
+        elif event["event"] == "PoolExhausted":
+            contract["exhausted"] = not removed
+
+        if removed:
+            self.recent.get(block, set()).discard(index)
+        else:
+            self.recent.setdefault(block, set()).add(index)
+
+    def pool(self, contract):
+        """
+        Current pool balance of a contract, or None if unknown
+        """
+        state = self.contracts.get(contract.lower())
+        return None if state is None else state["pool"]
+
+    def totals(self, contract):
+        """
+        Aggregate bets, wins, payouts, roll distribution and pool status of a
+        contract, or None if unknown
+        """
+        state = self.contracts.get(contract.lower())
+        if state is None:
+            return None
+        return dict(
+            {key: value for key, value in state.items() if key not in ("accounts", "poolHistory")},
+            losses=state["bets"] - state["wins"],
+            accounts=len(state["accounts"])
+        )
+
+    def account(self, contract, account):
+        """
+        Bets, wins, losses, payouts and net winnings of an account on a
+        contract, or None if unknown
+        """
+        state = self.contracts.get(contract.lower())
+        totals = None if state is None else state["accounts"].get(account.lower())
+        if totals is None:
+            return None
+        return dict(
+            totals,
+            losses=totals["bets"] - totals["wins"],
+            net=totals["payouts"] - totals["wagered"]
+        )
+
+    def due(self):
+        """
+        Whether a snapshot should be taken: always before the first one, then
+        every snapshot_interval seconds
+        """
+        return self.block is None or time.monotonic() - self._saved >= self.snapshot_interval
+
+    def save_snapshot(self, outdir, block):
+        """
+        Atomically write the state as of checkpointed block to outdir, along
+        with the events already applied from later blocks
+        """
+        self.recent = {b: indexes for b, indexes in self.recent.items() if b > block}
+        self.block = block
+        path = os.path.join(outdir, SNAPSHOT_FILE)
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({
+                "block": block,
+                "recent": [[b, sorted(indexes)] for b, indexes in self.recent.items()],
+                "contracts": self.contracts,
+            }, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        self._saved = time.monotonic()
+
+    def load_snapshot(self, outdir):
+        """
+        Restore the state from the snapshot in outdir, returning its block or
+        None if there is no snapshot. Events up to the block and those listed
+        as already applied are skipped when the monitor replays them.
+        """
+        path = os.path.join(outdir, SNAPSHOT_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            snapshot = json.load(f)
+        self.block = snapshot["block"]
+        self.contracts = snapshot["contracts"]
+        self.recent = {b: set(indexes) for b, indexes in snapshot["recent"]}
+        self._skip_block = self.block
+        self._skip_end = max([self.block] + list(self.recent))
+        self._skip = {(b, index) for b, indexes in self.recent.items() for index in indexes}
+        self._saved = time.monotonic()
+        return self.block
+
+
+async def serve(state, host="127.0.0.1", port=9101):
+    """
+    Serve game state queries as JSON, returning the runner to clean up on
+    shutdown:
+
+        /state/{contract}                      contract totals and pool status
+        /state/{contract}/pool                 current pool balance
+        /state/{contract}/accounts/{account}   account totals
+
+    """
+
+    def reply(result):
+        if result is None:
+            raise web.HTTPNotFound()
+        return web.json_response(result)
+
+    async def totals(request):
+        return reply(state.totals(request.match_info["contract"]))
+
+    async def pool(request):
+        contract = request.match_info["contract"]
+        if contract.lower() not in state.contracts:
+            raise web.HTTPNotFound()
+        return web.json_response({"pool": state.pool(contract)})
+
+    async def account(request):
+        return reply(state.account(request.match_info["contract"], request.match_info["account"]))
+
+    app = web.Application()
+    app.router.add_get("/state/{contract}", totals)
+    app.router.add_get("/state/{contract}/pool", pool)
+    app.router.add_get("/state/{contract}/accounts/{account}", account)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
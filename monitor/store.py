@@ -0,0 +1,382 @@
+import argparse
+import json
+import os
+import sqlite3
+import time
+from web3 import Web3
+
+from writer import LogWriter, writers
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    block_number INTEGER NOT NULL,
+    block_hash TEXT NOT NULL,
+    log_index INTEGER NOT NULL,
+    tx_hash TEXT NOT NULL,
+    tx_index INTEGER,
+    address TEXT NOT NULL,
+    event TEXT NOT NULL,
+    account TEXT,
+    args TEXT NOT NULL,
+    PRIMARY KEY (block_hash, log_index)
+);
+CREATE INDEX IF NOT EXISTS events_tx_hash ON events (tx_hash);
+CREATE INDEX IF NOT EXISTS events_account ON events (account, block_number, log_index);
+CREATE INDEX IF NOT EXISTS events_block ON events (block_number, log_index);
+CREATE INDEX IF NOT EXISTS events_event ON events (event, block_number, log_index);
+
+CREATE TABLE IF NOT EXISTS transactions (
+    hash TEXT PRIMARY KEY,
+    sender TEXT NOT NULL,
+    recipient TEXT,
+    nonce INTEGER NOT NULL,
+    value TEXT NOT NULL,
+    gas INTEGER NOT NULL,
+    gas_price TEXT,
+    input TEXT NOT NULL,
+    seen REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transactions_sender ON transactions (sender, nonce);
+
+CREATE TABLE IF NOT EXISTS receipts (
+    tx_hash TEXT PRIMARY KEY,
+    block_number INTEGER NOT NULL,
+    block_hash TEXT NOT NULL,
+    tx_index INTEGER NOT NULL,
+    sender TEXT NOT NULL,
+    recipient TEXT,
+    contract_address TEXT,
+    status INTEGER,
+    gas_used INTEGER NOT NULL,
+    effective_gas_price TEXT,
+    logs INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS receipts_sender ON receipts (sender, block_number);
+CREATE INDEX IF NOT EXISTS receipts_block ON receipts (block_number);
+"""
+
+INSERT_EVENT = "INSERT OR IGNORE INTO events VALUES (?,?,?,?,?,?,?,?,?)"
+DELETE_EVENT = "DELETE FROM events WHERE block_hash = ? AND log_index = ?"
+INSERT_TRANSACTION = "INSERT OR IGNORE INTO transactions VALUES (?,?,?,?,?,?,?,?,?)"
+INSERT_RECEIPT = "INSERT OR REPLACE INTO receipts VALUES (?,?,?,?,?,?,?,?,?,?,?)"
+
+# Per-batch durability policy mapped to SQLite synchronous mode under WAL
+SYNCHRONOUS = {"none": "OFF", "flush": "NORMAL", "fsync": "FULL"}
+
+
+def lower(address):
+    return address.lower() if address is not None else None
+
+
+def event_row(record):
+    args = record["args"]
+    return (
+        record["blockNumber"],
+        record["blockHash"],
+        record["logIndex"],
+        record["transactionHash"],
+        record.get("transactionIndex"),
+        record["address"].lower(),
+        record["event"],
+        lower(args.get("account")),
+        json.dumps(args, separators=(",", ":")),
+    )
+
+
+def transaction_row(record):
+    # Amounts may exceed SQLite integers; stored as decimal text
+    return (
+        record["hash"],
+        record["from"].lower(),
+        lower(record.get("to")),
+        record["nonce"],
+        str(record["value"]),
+        record["gas"],
+        None if record.get("gasPrice") is None else str(record["gasPrice"]),
+        record["input"],
+        time.time(),
+    )
+
+
+def receipt_row(record):
+    return (
+        record["transactionHash"],
+        record["blockNumber"],
+        record["blockHash"],
+        record["transactionIndex"],
+        record["from"].lower(),
+        lower(record.get("to")),
+        lower(record.get("contractAddress")),
+        record.get("status"),
+        record["gasUsed"],
+        None if record.get("effectiveGasPrice") is None else str(record["effectiveGasPrice"]),
+        len(record.get("logs", [])),
+    )
+
+
+class DatabaseWriter(LogWriter):
+    """
+    Single writer task for a SQLite database in WAL mode, fed by the same
+    batching queue as the log writers and inserting each batch of events,
+    pending transactions and receipts in one transaction. Retracted events
+    are deleted, and records written again after a restart are ignored.
+
+    Parameters
+    ----------
+    path : str
+        path to the database file
+    batch_size : int
+        maximum number of records inserted per transaction
+    flush_interval : float
+        maximum seconds a queued record waits before its batch is inserted
+    durability : str
+        per-batch durability policy: "none", "flush" or "fsync", mapped to
+        the SQLite synchronous mode
+
+    """
+
+    def __init__(self, path, batch_size=256, flush_interval=1.0, durability="flush"):
+        super().__init__(path, batch_size, flush_interval, durability)
+        self._db = None
+
+    def write_event(self, record):
+        self.write(("events", record))
+
+    def write_transaction(self, record):
+        self.write(("transactions", record))
+
+    def write_receipt(self, record):
+        self.write(("receipts", record))
+
+    def _open(self):
+        self._db = connect(self.outfile)
+        self._db.execute("PRAGMA synchronous = {}".format(SYNCHRONOUS[self.durability]))
+        self._db.executescript(SCHEMA)
+
+    def _close(self):
+        self._db.close()
+
+    def _flush(self):
+        # Every batch is committed as it is written
+        pass
+
+    def _write_batch(self, batch):
+        # Consecutive records for the same statement are inserted together,
+        # keeping retractions in order with the events they retract
+        runs = []
+        for table, record in batch:
+            # Normalise web3 types (HexBytes, AttributeDict) to JSON values
+            record = json.loads(Web3.toJSON(record))
+            if table == "events" and record.get("removed"):
+                statement, row = DELETE_EVENT, (record["blockHash"], record["logIndex"])
+            elif table == "events":
+                statement, row = INSERT_EVENT, event_row(record)
+            elif table == "transactions":
+                statement, row = INSERT_TRANSACTION, transaction_row(record)
+            else:
+                statement, row = INSERT_RECEIPT, receipt_row(record)
+            if not runs or runs[-1][0] != statement:
+                runs.append((statement, []))
+            runs[-1][1].append(row)
+        with self._db:
+            for statement, rows in runs:
+                self._db.executemany(statement, rows)
+
+
+def connect(path):
+    """
+    Open a database in WAL mode, waiting on other writers (e.g. supervisor
+    workers sharing it)
+    """
+    db = sqlite3.connect(path, timeout=30)
+    db.execute("PRAGMA journal_mode = WAL")
+    return db
+
+
+def open_database(path, **options):
+    """
+    Return the writer for a database, creating and starting it if needed
+    """
+    if path not in writers:
+        writers[path] = DatabaseWriter(path, **options)
+        writers[path].start()
+    return writers[path]
+
+
+def query(db, sql, params=()):
+    cursor = db.execute(sql, params)
+    columns = [column[0] for column in cursor.description]
+    for row in cursor:
+        record = dict(zip(columns, row))
+        if "args" in record:
+            record["args"] = json.loads(record["args"])
+        yield record
+
+
+def find_transaction(db, tx_hash):
+    """
+    Pending transaction, receipt and events of a transaction hash
+    """
+    tx_hash = tx_hash.lower()
+    return {
+        "transaction": next(query(db, "SELECT * FROM transactions WHERE hash = ?", (tx_hash,)), None),
+        "receipt": next(query(db, "SELECT * FROM receipts WHERE tx_hash = ?", (tx_hash,)), None),
+        "events": list(query(db, "SELECT * FROM events WHERE tx_hash = ? ORDER BY log_index", (tx_hash,))),
+    }
+
+
+def find_account(db, account, from_block=None, to_block=None, event=None, limit=None):
+    """
+    Events naming an account (e.g. its bets), in block order
+    """
+    sql = "SELECT * FROM events WHERE account = ?"
+    params = [account.lower()]
+    sql, params = _filter(sql, params, from_block, to_block, event)
+    return query(db, sql + " ORDER BY block_number, log_index" + _limit(limit), params)
+
+
+def find_sent(db, account, limit=None):
+    """
+    Pending transactions and receipts of transactions sent by an account
+    """
+    params = (account.lower(),)
+    return {
+        "transactions": list(query(db, "SELECT * FROM transactions WHERE sender = ? ORDER BY nonce" + _limit(limit), params)),
+        "receipts": list(query(db, "SELECT * FROM receipts WHERE sender = ? ORDER BY block_number" + _limit(limit), params)),
+    }
+
+
+def find_blocks(db, from_block=None, to_block=None, event=None, limit=None):
+    """
+    Events over a block range, optionally of one type, in block order
+    """
+    sql, params = _filter("SELECT * FROM events WHERE 1", [], from_block, to_block, event)
+    return query(db, sql + " ORDER BY block_number, log_index" + _limit(limit), params)
+
+
+def _filter(sql, params, from_block, to_block, event):
+    if from_block is not None:
+        sql += " AND block_number >= ?"
+        params.append(from_block)
+    if to_block is not None:
+        sql += " AND block_number <= ?"
+        params.append(to_block)
+    if event is not None:
+        sql += " AND event = ?"
+        params.append(event)
+    return sql, params
+
+
+def _limit(limit):
+    return "" if limit is None else " LIMIT {:d}".format(limit)
+
+
+if __name__ == "__main__":
+    """
+    Script to query the SQLite database written by monitor.py and
+    monitor_tx.py with --db, printing results as JSON lines: everything
+    known about a transaction hash, the events naming an account (with
+    --sent, the transactions it sent), or the events over a block range.
+
+    Usage:
+
+        store.py [-h] (--tx TX | --account ACCOUNT | --blocks) [--from-block FROM_BLOCK]
+                 [--to-block TO_BLOCK] [--event EVENT] [--sent] [--limit LIMIT] [--timing] db
+
+    Required Arguments:
+
+        db                      path to database file
+        --tx TX                 transaction hash to look up
+        --account ACCOUNT       account address to look up
+        --blocks                list events over a block range
+
+    Optional Arguments:
+
+        -h, --help              show this help message and exit
+        --from-block FROM_BLOCK
+                                only include events from this block number
+        --to-block TO_BLOCK     only include events up to this block number
+        --event EVENT           only include events of this type (e.g., Result)
+        --sent                  with --account, list transactions sent by the account instead
+        --limit LIMIT           maximum number of rows returned
+        --timing                print the query time
+
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "db",
+        help="path to database file",
+        type=str
+    )
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument(
+        "--tx",
+        help="transaction hash to look up",
+        type=str
+    )
+    group.add_argument(
+        "--account",
+        help="account address to look up",
+        type=str
+    )
+    group.add_argument(
+        "--blocks",
+        help="list events over a block range",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--from-block",
+        help="only include events from this block number",
+        type=int,
+        required=False
+    )
+    parser.add_argument(
+        "--to-block",
+        help="only include events up to this block number",
+        type=int,
+        required=False
+    )
+    parser.add_argument(
+        "--event",
+        help="only include events of this type (e.g., Result)",
+        type=str,
+        required=False
+    )
+    parser.add_argument(
+        "--sent",
+        help="with --account, list transactions sent by the account instead",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--limit",
+        help="maximum number of rows returned",
+        type=int,
+        required=False
+    )
+    parser.add_argument(
+        "--timing",
+        help="print the query time",
+        action="store_true"
+    )
+
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        parser.error("no database at {}".format(args.db))
+    db = connect(args.db)
+    started = time.perf_counter()
+    if args.tx is not None:
+        results = [find_transaction(db, args.tx)]
+    elif args.account is not None and args.sent:
+        results = [find_sent(db, args.account, args.limit)]
+    elif args.account is not None:
+        results = list(find_account(db, args.account, args.from_block, args.to_block, args.event, args.limit))
+    else:
+        results = list(find_blocks(db, args.from_block, args.to_block, args.event, args.limit))
+    elapsed = time.perf_counter() - started
+    for result in results:
+        print(json.dumps(result))
+    if args.timing:
+        print("{} results in {:.1f} ms".format(len(results), elapsed * 1000))
@@ -0,0 +1,459 @@
+import argparse
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+from web3 import Web3
+
+from checkpoint import load_checkpoint, load_state, save_checkpoint
+from writer import close_writers, open_writer, sync_writers
+
+
+MONITOR_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "monitor.py")
+MERGE_MODES = ("global", "contract")
+
+
+def partition(addresses, workers):
+    """
+    Assign each contract address to a shard by its numeric value, so that a
+    contract keeps its shard (and checkpoint) across restarts and changes to
+    the address list
+    """
+    shards = [[] for _ in range(workers)]
+    for address in addresses:
+        shards[int(address, 16) % workers].append(address)
+    return shards
+
+
+def read_lines(path, position):
+    """
+    Read the complete JSON lines of a file from a byte position, returning
+    the new position and (end offset, record) pairs
+    """
+    if not os.path.exists(path):
+        return position, []
+    with open(path, "rb") as f:
+        f.seek(position)
+        data = f.read()
+    records = []
+    for line in data.splitlines(keepends=True):
+        if not line.endswith(b"\n"):
+            # Partially written by the worker; read again next time
+            break
+        position += len(line)
+        try:
+            records.append((position, json.loads(line)))
+        except ValueError:
+            print("[WARN] Skipping malformed line in {}".format(path))
+    return position, records
+
+
+class Shard:
+    """
+    Monitor worker process watching a subset of the contracts, with its own
+    output folder and checkpoint
+
+    Parameters
+    ----------
+    index : int
+        shard number, naming its output folder
+    addresses : list
+        checksummed contract addresses watched by the worker
+    outdir : str
+        supervisor output folder; the shard writes to outdir/shards/<index>
+    options : list
+        command line arguments passed through to monitor.py
+
+    """
+
+    def __init__(self, index, addresses, outdir, options):
+        self.index = index
+        self.addresses = addresses
+        self.outdir = os.path.join(outdir, "shards", str(index))
+        self.options = options
+        self.process = None
+        self.restarts = 0
+        # monitor.py writes to a subfolder per contract when watching several
+        if len(addresses) == 1:
+            folders = [self.outdir]
+        else:
+            folders = [os.path.join(self.outdir, address) for address in addresses]
+        self.event_logs = [os.path.join(folder, "event.log") for folder in folders]
+        # Transaction logs, merged in arrival order: (path, file name) pairs
+        self.tx_logs = [
+            (os.path.join(folder, name), name)
+            for folder in folders for name in ("pending.log", "latency.log")
+        ]
+
+    @property
+    def checkpoint(self):
+        return load_checkpoint(self.outdir)
+
+    def start(self):
+        os.makedirs(self.outdir, exist_ok=True)
+        self.process = subprocess.Popen(
+            [sys.executable, MONITOR_SCRIPT, "-c"] + self.addresses
+            + ["-o", self.outdir] + self.options
+        )
+
+    def exited(self):
+        return self.process is not None and self.process.poll() is not None
+
+    def terminate(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+
+    def wait(self, timeout=10):
+        if self.process is None:
+            return
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+class Supervisor:
+    """
+    Run a pool of monitor worker processes over a sharded contract list and
+    merge their event logs, ordered by (block, log index), into global or
+    per-contract output logs. Workers that exit are restarted from their own
+    checkpoint without affecting the other shards.
+
+    Events are merged up to the lowest block checkpointed by every worker,
+    as all events up to a worker's checkpoint are already in its output.
+    Pending transactions and inclusion latencies are merged as they arrive.
+    The merged block and the merged offset of every worker log are
+    checkpointed in the output folder.
+
+    Parameters
+    ----------
+    shards : list
+        Shard workers to supervise
+    outdir : str
+        path to folder for the merged output logs
+    mode : str
+        "global" merges into a single event.log, pending.log and latency.log,
+        "contract" into the same files in a subfolder per contract
+    verbose : bool
+        additionally log merged records to command line
+
+    """
+
+    def __init__(self, shards, outdir, mode="global", verbose=False):
+        if mode not in MERGE_MODES:
+            raise ValueError("mode must be one of {}".format(MERGE_MODES))
+        self.shards = shards
+        self.outdir = outdir
+        self.mode = mode
+        self.verbose = verbose
+        state = load_state(outdir)
+        self.block = state.get("block")
+        # Byte offsets of worker logs up to which records have been merged
+        self.offsets = state.get("offsets", {})
+        # Read positions and records read but not yet merged, per worker log
+        self.positions = {}
+        self.buffers = {}
+        for shard in shards:
+            for path in shard.event_logs + [path for path, _ in shard.tx_logs]:
+                self.positions[path] = self.offsets.get(self._key(path), 0)
+                self.buffers[path] = []
+
+    def _key(self, path):
+        return os.path.relpath(path, self.outdir)
+
+    def _sink(self, address, name):
+        if self.mode == "global":
+            return os.path.join(self.outdir, name)
+        folder = os.path.join(self.outdir, address)
+        os.makedirs(folder, exist_ok=True)
+        return os.path.join(folder, name)
+
+    def _read(self, path):
+        self.positions[path], records = read_lines(path, self.positions[path])
+        self.buffers[path].extend(records)
+
+    def recover(self, shard):
+        """
+        Prepare a shard for (re)starting. The worker backfills from its own
+        checkpoint, so events it wrote for later blocks are discarded here
+        rather than merged twice.
+        """
+        checkpoint = shard.checkpoint
+        for path in shard.event_logs:
+            self._read(path)
+            if checkpoint is not None:
+                self.buffers[path] = [
+                    (offset, record) for offset, record in self.buffers[path]
+                    if record["blockNumber"] <= checkpoint
+                ]
+
+    async def merge(self):
+        """
+        Merge worker output up to the lowest block checkpointed by all
+        workers, then checkpoint the merged offsets
+        """
+        checkpoints = [shard.checkpoint for shard in self.shards]
+        watermark = None if None in checkpoints else min(checkpoints)
+
+        events = []
+        for shard in self.shards:
+            for path in shard.event_logs:
+                self._read(path)
+                if watermark is None:
+                    continue
+                buffer = self.buffers[path]
+                count = 0
+                while count < len(buffer) and buffer[count][1]["blockNumber"] <= watermark:
+                    count += 1
+                if count:
+                    events.extend(record for _, record in buffer[:count])
+                    self.offsets[self._key(path)] = buffer[count - 1][0]
+                    del buffer[:count]
+                if not buffer:
+                    self.offsets[self._key(path)] = self.positions[path]
+            for path, name in shard.tx_logs:
+                self._read(path)
+                for _, record in self.buffers[path]:
+                    self._write(record, record["to"], name)
+                self.buffers[path] = []
+                self.offsets[self._key(path)] = self.positions[path]
+
+        # Sort is stable, so a retraction stays after the event it retracts
+        events.sort(key=lambda record: (record["blockNumber"], record["logIndex"]))
+        for record in events:
+            self._write(record, record["address"], "event.log")
+
+        if watermark is not None:
+            await sync_writers()
+            self.block = watermark
+            save_checkpoint(self.outdir, watermark, offsets=self.offsets)
+
+    def _write(self, record, address, name):
+        if self.verbose:
+            print(Web3.toJSON(record))
+        open_writer(self._sink(address, name)).write(record)
+
+    async def run(self, merge_interval=1):
+        """
+        Start all workers and merge their output every merge_interval
+        seconds, restarting any worker that exits, until cancelled
+        """
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, asyncio.current_task().cancel)
+
+        for shard in self.shards:
+            self.recover(shard)
+            shard.start()
+        try:
+            while True:
+                await asyncio.sleep(merge_interval)
+                for shard in self.shards:
+                    if shard.exited():
+                        print("[WARN] Shard {} exited with code {}, restarting from block {}".format(
+                            shard.index, shard.process.returncode, shard.checkpoint
+                        ))
+                        self.recover(shard)
+                        shard.restarts += 1
+                        shard.start()
+                await self.merge()
+        finally:
+            # Let the workers drain their writers, then merge the remainder
+            for shard in self.shards:
+                shard.terminate()
+            for shard in self.shards:
+                shard.wait()
+            await self.merge()
+            await close_writers()
+
+
+def start_supervisor(
+        addresses=None,
+        outdir=None,
+        workers=4,
+        mode="global",
+        options=None,
+        merge_interval=1,
+        verbose=False,
+        metrics_port=None,
+        state_port=None
+):
+    """
+    Partition the contracts across worker processes and supervise them. Each
+    worker serves its metrics and game state on metrics_port and state_port
+    plus its shard number, if given.
+    """
+    shards = []
+    for index, shard in enumerate(partition(addresses, workers)):
+        if not shard:
+            continue
+        shard_options = list(options or [])
+        if metrics_port is not None:
+            shard_options += ["--metrics-port", str(metrics_port + index)]
+        if state_port is not None:
+            shard_options += ["--state-port", str(state_port + index)]
+        shards.append(Shard(index, shard, outdir, shard_options))
+    supervisor = Supervisor(shards, outdir, mode, verbose)
+    try:
+        asyncio.run(supervisor.run(merge_interval))
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        print(e)
+
+
+if __name__ == "__main__":
+    """
+    Script to monitor a large number of contracts with a pool of monitor.py
+    worker processes, each watching a shard of the contracts with its own
+    output folder and checkpoint under "shards/". Worker event logs are
+    merged in (block, log index) order into a global "event.log" (with
+    "pending.log" and "latency.log" merged as written), or into
+    per-contract logs. Workers that exit are restarted
+    from their own checkpoint. Any other monitor.py options (e.g., --ws,
+    --confirmations) are passed through to every worker, except the segment
+    options, as worker logs are merged from plain files.
+
+    Usage:
+
+        supervisor.py [-h] [-c CONTRACT [CONTRACT ...]] [--contract-file CONTRACT_FILE] --abi ABI --config CONFIG
+                      [-o OUTPUT] [--workers WORKERS] [--merge {global,contract}]
+                      [--merge-interval MERGE_INTERVAL] [--metrics-port METRICS_PORT]
+                      [--state-port STATE_PORT] [-v] [monitor.py options]
+
+    Required Arguments:
+
+        --abi ABI               contract ABI or full path to ABI file
+        --config CONFIG         path to network provider RPC server config.json
+
+    Optional Arguments:
+
+        -h, --help              show this help message and exit
+        -c CONTRACT [CONTRACT ...], --contract CONTRACT [CONTRACT ...]
+                                contract address(es) to monitor
+        --contract-file CONTRACT_FILE
+                                path to file listing contract addresses to monitor, one per line
+        -o OUTPUT, --output OUTPUT
+                                path to folder for storing output logs (default: ./output/)
+        --workers WORKERS       number of monitor worker processes (default: 4)
+        --merge {global,contract}
+                                merge worker output into global or per-contract logs (default: global)
+        --merge-interval MERGE_INTERVAL
+                                seconds between merges of worker output (default: 1)
+        --metrics-port METRICS_PORT
+                                serve the metrics of worker N at http://127.0.0.1:METRICS_PORT+N/metrics
+                                (default: disabled)
+        --state-port STATE_PORT
+                                serve the game state of worker N at http://127.0.0.1:STATE_PORT+N/state/
+                                (default: disabled)
+        -v, --verbose           additionally log merged output to command line
+
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-c", "--contract",
+        help="contract address(es) to monitor",
+        type=str,
+        nargs="+",
+        required=False,
+        default=[]
+    )
+    parser.add_argument(
+        "--contract-file",
+        help="path to file listing contract addresses to monitor, one per line",
+        type=str,
+        required=False
+    )
+    parser.add_argument(
+        "--abi",
+        help="contract ABI or full path to ABI file",
+        type=str,
+        required=True
+    )
+    parser.add_argument(
+        "--config",
+        help="path to network provider RPC server config.json",
+        type=str,
+        required=True
+    )
+    parser.add_argument(
+        "-o", "--output",
+        help="path to folder for storing output logs (default: ./output/)",
+        type=str,
+        required=False,
+        default="./output"
+    )
+    parser.add_argument(
+        "--workers",
+        help="number of monitor worker processes (default: 4)",
+        type=int,
+        required=False,
+        default=4
+    )
+    parser.add_argument(
+        "--merge",
+        help="merge worker output into global or per-contract logs (default: global)",
+        choices=MERGE_MODES,
+        required=False,
+        default="global"
+    )
+    parser.add_argument(
+        "--merge-interval",
+        help="seconds between merges of worker output (default: 1)",
+        type=float,
+        required=False,
+        default=1.0
+    )
+    parser.add_argument(
+        "--metrics-port",
+        help="serve the metrics of worker N at http://127.0.0.1:METRICS_PORT+N/metrics (default: disabled)",
+        type=int,
+        required=False
+    )
+    parser.add_argument(
+        "--state-port",
+        help="serve the game state of worker N at http://127.0.0.1:STATE_PORT+N/state/ (default: disabled)",
+        type=int,
+        required=False
+    )
+    parser.add_argument(
+        "-v", "--verbose",
+        help="additionally log merged output to command line",
+        action="store_true"
+    )
+
+    args, options = parser.parse_known_args()
+
+    # Worker logs are tailed as plain files to be merged; --segment-size and
+    # --segment-interval (the only monitor.py options starting so) would
+    # leave them empty
+    if any(option.startswith("--seg") for option in options):
+        parser.error("--segment-size and --segment-interval are not supported for workers")
+
+    addresses = list(args.contract)
+    if args.contract_file is not None:
+        with open(os.path.normpath(args.contract_file)) as f:
+            addresses.extend(line.strip() for line in f if line.strip())
+    if not addresses:
+        parser.error("at least one contract address is required (-c or --contract-file)")
+    addresses = list(dict.fromkeys(Web3.toChecksumAddress(address) for address in addresses))
+
+    # Create output path if required
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+
+    start_supervisor(
+        addresses,
+        args.output,
+        args.workers,
+        args.merge,
+        ["--abi", args.abi, "--config", args.config] + options,
+        args.merge_interval,
+        args.verbose,
+        args.metrics_port,
+        args.state_port
+    )
@@ -0,0 +1,269 @@
+import asyncio
+import os
+import time
+from web3 import Web3
+
+from segments import (
+    compress_segment,
+    new_entry,
+    recover_index,
+    save_index,
+    segment_folder,
+    segment_name,
+    update_entry
+)
+
+
+DURABILITY = ("none", "flush", "fsync")
+
+# Active writers keyed by output file path, one per file
+writers = {}
+
+
+class LogWriter:
+    """
+    Single writer task for one output file, fed by an in-memory queue and
+    appending records as JSON lines in batches
+
+    Parameters
+    ----------
+    outfile : str
+        path to the output file
+    batch_size : int
+        maximum number of records written per batch
+    flush_interval : float
+        maximum seconds a queued record waits before its batch is written
+    durability : str
+        per-batch durability policy: "none" (leave in the file buffer),
+        "flush" (flush to the OS) or "fsync" (flush and sync to disk)
+
+    """
+
+    def __init__(self, outfile, batch_size=256, flush_interval=1.0, durability="flush"):
+        if durability not in DURABILITY:
+            raise ValueError("durability must be one of {}".format(DURABILITY))
+        self.outfile = outfile
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.durability = durability
+        self._queue = None
+        self._task = None
+        self._file = None
+
+    def start(self):
+        """
+        Start the writer task; must be called from the running event loop
+        """
+        self._queue = asyncio.Queue()
+        self._task = asyncio.ensure_future(self._run())
+
+    def write(self, data):
+        """
+        Queue a record for writing
+        """
+        self._queue.put_nowait(data)
+
+    def sync(self):
+        """
+        Return a future resolved once every record queued before it has been
+        written and flushed to the OS (and synced under the "fsync" policy)
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(future)
+        return future
+
+    def qsize(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def close(self):
+        """
+        Drain all queued records to the file and stop the writer task
+        """
+        if self._task is None:
+            return
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+
+    async def _next_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.flush_interval
+        while not self._is_marker(batch[-1]) and len(batch) < self.batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    @staticmethod
+    def _is_marker(item):
+        # Shutdown (None) and sync (future) markers end the current batch
+        return item is None or isinstance(item, asyncio.Future)
+
+    def _open(self):
+        self._file = open(self.outfile, "a+")
+
+    def _close(self):
+        self._file.close()
+
+    def _flush(self):
+        self._file.flush()
+
+    def _write_batch(self, batch):
+        f = self._file
+        f.write("".join(Web3.toJSON(data) + "\n" for data in batch))
+        if self.durability in ("flush", "fsync"):
+            f.flush()
+        if self.durability == "fsync":
+            os.fsync(f.fileno())
+
+    async def _run(self):
+        self._open()
+        try:
+            done = False
+            while not done:
+                batch = await self._next_batch()
+                marker = batch.pop() if self._is_marker(batch[-1]) else False
+                if batch:
+                    self._write_batch(batch)
+                if marker is None:
+                    done = True
+                elif marker is not False:
+                    if self.durability == "none":
+                        self._flush()
+                    if not marker.done():
+                        marker.set_result(None)
+        finally:
+            self._close()
+
+
+class SegmentWriter(LogWriter):
+    """
+    Writer splitting an output file into size- or time-bounded segments in
+    a folder named after it, compressing each segment in the background
+    once closed and keeping an index of the records and block range of every
+    segment. After a restart the newest segment is appended to.
+
+    Parameters
+    ----------
+    outfile : str
+        path to the output file; segments are written to outfile.segments/
+    segment_size : int
+        bytes after which a segment is closed (None for no limit)
+    segment_interval : float
+        seconds after which a segment is closed (None for no limit)
+    **options
+        batching and durability options of LogWriter
+
+    """
+
+    def __init__(self, outfile, segment_size=None, segment_interval=None, **options):
+        super().__init__(outfile, **options)
+        self.segment_size = segment_size
+        self.segment_interval = segment_interval
+        self.folder = segment_folder(outfile)
+        self._index = []
+        self._compressing = set()
+
+    def _open(self):
+        os.makedirs(self.folder, exist_ok=True)
+        self._index = recover_index(self.folder)
+        for entry in self._index:
+            if entry["closed"] is not None and not entry["name"].endswith(".gz"):
+                self._compress(entry)
+        if not self._index or self._index[-1]["closed"] is not None:
+            sequence = int(self._index[-1]["name"].split(".")[0]) + 1 if self._index else 0
+            self._index.append(new_entry(segment_name(sequence)))
+            save_index(self.folder, self._index)
+        self._file = open(os.path.join(self.folder, self._index[-1]["name"]), "a+")
+
+    def _close(self):
+        self._file.close()
+        save_index(self.folder, self._index)
+
+    def _full(self):
+        entry = self._index[-1]
+        if not entry["records"]:
+            return False
+        if self.segment_size is not None and self._file.tell() >= self.segment_size:
+            return True
+        return self.segment_interval is not None and time.time() - entry["opened"] >= self.segment_interval
+
+    def _write_batch(self, batch):
+        # Time-bounded segments may expire between batches
+        if self._full():
+            self._rotate()
+        super()._write_batch(batch)
+        for data in batch:
+            update_entry(self._index[-1], data)
+        if self._full():
+            self._rotate()
+
+    def _rotate(self):
+        self._file.close()
+        entry = self._index[-1]
+        entry["closed"] = time.time()
+        self._compress(entry)
+        sequence = int(entry["name"].split(".")[0]) + 1
+        self._index.append(new_entry(segment_name(sequence)))
+        save_index(self.folder, self._index)
+        self._file = open(os.path.join(self.folder, self._index[-1]["name"]), "a+")
+
+    def _compress(self, entry):
+        future = asyncio.get_running_loop().run_in_executor(
+            None, compress_segment, self.folder, entry["name"]
+        )
+        self._compressing.add(future)
+
+        def done(future):
+            self._compressing.discard(future)
+            if future.exception() is not None:
+                print("[WARN] Failed to compress segment {}: {}".format(entry["name"], future.exception()))
+                return
+            entry["name"] = future.result()
+            save_index(self.folder, self._index)
+
+        future.add_done_callback(done)
+
+    async def close(self):
+        """
+        Drain all queued records, then wait for closed segments to be
+        compressed
+        """
+        await super().close()
+        while self._compressing:
+            await asyncio.gather(*self._compressing, return_exceptions=True)
+
+
+def open_writer(outfile, segment_size=None, segment_interval=None, **options):
+    """
+    Return the writer for an output file, creating and starting it if needed.
+    Output is split into segments if either segment bound is given.
+    """
+    if outfile not in writers:
+        if segment_size is not None or segment_interval is not None:
+            writers[outfile] = SegmentWriter(outfile, segment_size, segment_interval, **options)
+        else:
+            writers[outfile] = LogWriter(outfile, **options)
+        writers[outfile].start()
+    return writers[outfile]
+
+
+async def sync_writers():
+    """
+    Wait until all records queued so far have been written by every writer
+    """
+    await asyncio.gather(*(writer.sync() for writer in writers.values()))
+
+
+async def close_writers():
+    """
+    Drain and stop all active writers
+    """
+    while writers:
+        _, writer = writers.popitem()
+        await writer.close()
@@ -0,0 +1,112 @@
+import argparse
+import json
+import os
+import sys
+import time
+from web3 import Web3
+
+sys.path.append(os.path.join(os.getcwd(), "monitor"))
+from events import build_topic_map, decode_log, event_topic, web3_decoder
+from stub_node import to_raw
+
+
+def load_logs(path):
+    """
+    Load the raw contract logs of all receipts recorded in a transaction log
+    """
+    logs = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                logs.extend(to_raw(json.loads(line)).get("logs", []))
+    return logs
+
+
+def bench(logs, topics, repeat):
+    """
+    Decode the logs repeat times, returning (events, elapsed seconds)
+    """
+    started = time.perf_counter()
+    events = 0
+    for _ in range(repeat):
+        for log in logs:
+            if decode_log(log, topics) is not None:
+                events += 1
+    return events, time.perf_counter() - started
+
+
+if __name__ == "__main__":
+    """
+    Script to benchmark contract event decoding, comparing web3's
+    ContractEvent.processLog with the precomputed topic-to-decoder table on
+    the logs of recorded transaction receipts. Decoded events are checked to
+    be identical on both paths before timing.
+
+    Usage:
+
+        bench_decode.py [-h] --abi ABI [-i INPUT] [--repeat REPEAT]
+
+    Required Arguments:
+
+        --abi ABI               contract ABI or full path to ABI file
+
+    Optional Arguments:
+
+        -h, --help              show this help message and exit
+        -i INPUT, --input INPUT
+                                path to recorded transaction log (default: ./sample_output/transaction.log)
+        --repeat REPEAT         number of passes over the recorded logs (default: 200)
+
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--abi",
+        help="contract ABI or full path to ABI file",
+        type=str,
+        required=True
+    )
+    parser.add_argument(
+        "-i", "--input",
+        help="path to recorded transaction log (default: ./sample_output/transaction.log)",
+        type=str,
+        required=False,
+        default=os.path.join("./sample_output", "transaction.log")
+    )
+    parser.add_argument(
+        "--repeat",
+        help="number of passes over the recorded logs (default: 200)",
+        type=int,
+        required=False,
+        default=200
+    )
+
+    args = parser.parse_args()
+
+    if os.path.exists(os.path.normpath(args.abi)):
+        with open(os.path.normpath(args.abi)) as f:
+            abi = f.read()
+    else:
+        abi = args.abi
+    logs = load_logs(args.input)
+    if not logs:
+        raise ValueError("No logs found in {}".format(args.input))
+    contract = Web3().eth.contract(address=logs[0]["address"], abi=abi)
+
+    fast = build_topic_map(contract)
+    slow = {
+        event_topic(abi): web3_decoder(contract.events[abi["name"]])
+        for abi in contract.abi
+        if abi.get("type") == "event" and not abi.get("anonymous")
+    }
+
+    for log in logs:
+        expected = Web3.toJSON(decode_log(log, slow))
+        if Web3.toJSON(decode_log(log, fast)) != expected:
+            raise AssertionError("Decoded events differ: {}".format(expected))
+
+    for name, topics in (("web3", slow), ("table", fast)):
+        events, elapsed = bench(logs, topics, args.repeat)
+        print("[bench] {:<6} {} events in {:.2f}s ({:.0f} events/s)".format(
+            name, events, elapsed, events / elapsed
+        ))
@@ -0,0 +1,198 @@
+import argparse
+import collections
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import requests
+
+
+STUB_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stub_node.py")
+MONITOR_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "monitor", "monitor.py")
+
+
+def read_records(path):
+    """
+    Read the JSON lines of an output file, if written
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def node_logs(uri, from_block, to_block):
+    """
+    (block number, log index) of every log mined over a block range
+    """
+    logs = requests.post(uri, json={
+        "jsonrpc": "2.0",
+        "method": "eth_getLogs",
+        "params": [{"fromBlock": hex(from_block), "toBlock": hex(to_block)}],
+        "id": 1,
+    }).json()["result"]
+    return {(int(log["blockNumber"], 16), int(log["logIndex"], 16)) for log in logs}
+
+
+def check(outdir, uri):
+    """
+    Check the output of the restarted monitor, returning a list of failures:
+    records written twice, events past the checkpoint and events up to the
+    checkpoint that were never written
+    """
+    failures = []
+    events = read_records(os.path.join(outdir, "event.log"))
+    pending = read_records(os.path.join(outdir, "pending.log"))
+    with open(os.path.join(outdir, "checkpoint.json")) as f:
+        checkpoint = json.load(f)["block"]
+
+    counts = collections.Counter(
+        (event["transactionHash"], event["logIndex"], event.get("removed", False)) for event in events
+    )
+    duplicates = sum(count - 1 for count in counts.values())
+    if duplicates:
+        failures.append("{} events written twice".format(duplicates))
+    counts = collections.Counter(tx["hash"] for tx in pending)
+    duplicates = sum(count - 1 for count in counts.values())
+    if duplicates:
+        failures.append("{} pending transactions written twice".format(duplicates))
+
+    written = set()
+    for event in events:
+        key = (event["blockNumber"], event["logIndex"])
+        if event.get("removed"):
+            written.discard(key)
+        else:
+            written.add(key)
+    beyond = sorted(key for key in written if key[0] > checkpoint)
+    if beyond:
+        failures.append("{} events past checkpoint {}, e.g. {}".format(len(beyond), checkpoint, beyond[0]))
+    if written:
+        missing = sorted(node_logs(uri, min(written)[0], checkpoint) - written)
+        if missing:
+            failures.append("{} events up to checkpoint {} not written, e.g. {}".format(
+                len(missing), checkpoint, missing[0]
+            ))
+    print("[check] {} events, {} pending transactions, checkpoint {}".format(len(events), len(pending), checkpoint))
+    return failures
+
+
+if __name__ == "__main__":
+    """
+    Script to check that a restarted monitor writes every event exactly once.
+    A stub node is started, and the monitor is run against it and stopped
+    with SIGINT several times over the same output folder. The output is
+    then checked for records written twice, and against the node for events
+    past the checkpoint or never written. Exits with code 1 on failure.
+
+    Usage:
+
+        restart_check.py [-h] --abi ABI [--restarts RESTARTS] [--run-time RUN_TIME] [--period PERIOD]
+                         [--port PORT] [--ws-port WS_PORT] [monitor.py options]
+
+    Required Arguments:
+
+        --abi ABI               contract ABI or full path to ABI file
+
+    Optional Arguments:
+
+        -h, --help              show this help message and exit
+        --restarts RESTARTS     number of monitor runs over the same output folder (default: 3)
+        --run-time RUN_TIME     seconds each monitor run lasts before it is stopped (default: 6)
+        --period PERIOD         seconds between stub node blocks (default: 0.5)
+        --port PORT             stub node HTTP JSON-RPC port (default: 18545)
+        --ws-port WS_PORT       stub node WebSocket JSON-RPC port (default: 18546)
+
+    Any other options (e.g., --ws, --confirmations) are passed to monitor.py.
+
+    """
+
+    # Without abbreviations, so that e.g. --ws is passed on to monitor.py
+    parser = argparse.ArgumentParser(allow_abbrev=False)
+    parser.add_argument(
+        "--abi",
+        help="contract ABI or full path to ABI file",
+        type=str,
+        required=True
+    )
+    parser.add_argument(
+        "--restarts",
+        help="number of monitor runs over the same output folder (default: 3)",
+        type=int,
+        required=False,
+        default=3
+    )
+    parser.add_argument(
+        "--run-time",
+        help="seconds each monitor run lasts before it is stopped (default: 6)",
+        type=float,
+        required=False,
+        default=6.0
+    )
+    parser.add_argument(
+        "--period",
+        help="seconds between stub node blocks (default: 0.5)",
+        type=float,
+        required=False,
+        default=0.5
+    )
+    parser.add_argument(
+        "--port",
+        help="stub node HTTP JSON-RPC port (default: 18545)",
+        type=int,
+        required=False,
+        default=18545
+    )
+    parser.add_argument(
+        "--ws-port",
+        help="stub node WebSocket JSON-RPC port (default: 18546)",
+        type=int,
+        required=False,
+        default=18546
+    )
+
+    args, options = parser.parse_known_args()
+
+    contract = "0xa283Ecc3a250B05afB1344b5B1fcd2B152F99268"
+    uri = "http://127.0.0.1:{}".format(args.port)
+    stub = subprocess.Popen([
+        sys.executable, STUB_SCRIPT,
+        "-c", contract,
+        "--port", str(args.port),
+        "--ws-port", str(args.ws_port),
+        "--period", str(args.period),
+    ], stdout=subprocess.DEVNULL)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            config = os.path.join(tmp, "config.json")
+            with open(config, "w") as f:
+                json.dump({"url": "http://127.0.0.1", "port": args.port, "ws_port": args.ws_port}, f)
+            outdir = os.path.join(tmp, "output")
+            time.sleep(1.5)
+
+            for run in range(args.restarts):
+                monitor = subprocess.Popen([
+                    sys.executable, MONITOR_SCRIPT,
+                    "-c", contract,
+                    "--abi", args.abi,
+                    "--config", config,
+                    "-o", outdir,
+                ] + options)
+                time.sleep(args.run_time)
+                monitor.send_signal(signal.SIGINT)
+                if monitor.wait(30) != 0:
+                    raise Exception("Monitor run {} exited with code {}".format(run, monitor.returncode))
+
+            failures = check(outdir, uri)
+    finally:
+        stub.terminate()
+        stub.wait()
+
+    for failure in failures:
+        print("[FAIL] {}".format(failure))
+    if failures:
+        sys.exit(1)
+    print("[PASS] {} restarts".format(args.restarts))
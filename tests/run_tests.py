@@ -9,10 +9,11 @@ from web3 import Web3
 from web3.middleware import geth_poa_middleware
 
 sys.path.append(os.path.join(os.getcwd(), "monitor"))
-from monitor_tx import start_monitor
+from monitor_tx import TxWatcher
 
 
 global web3
+global watcher
 
 
 def build_args_list(args):
@@ -25,6 +26,17 @@ def build_args_list(args):
     return args_list
 
 
+def wait_for_receipts(tx_hashes, nonces):
+    """
+    Wait for the receipts of the test transactions from the shared watcher,
+    given the (sender, nonce) of each so replacements are named, printing
+    any failures
+    """
+    for result in watcher.wait(tx_hashes, nonces=nonces):
+        if isinstance(result, Exception):
+            print(result)
+
+
 def test_single_successful_bet(cmd, script, base_args):
     """
     Execute a single successful bet
@@ -46,10 +58,12 @@ def test_single_successful_bet(cmd, script, base_args):
     stdout, stderr = proc.communicate()
 
     tx_hashes = []
+    nonces = []
     if not stderr:
         result = json.loads(stdout.decode("ascii"))
         tx_hashes.append(result["hash"])
-        start_monitor(web3, tx_hashes, outdir="./output", verbose=True)
+        nonces.append((result["from"], result["nonce"]))
+        wait_for_receipts(tx_hashes, nonces)
     else:
         raise Exception("Unexpected error occurred:\n{}".format(stderr.decode("ascii")))
 
@@ -66,6 +80,7 @@ def test_multiple_successful_bets(cmd, script, base_args):
     print("Expect: {}\nOutput: {}\n".format("success", "transaction receipt for each transaction"))
 
     tx_hashes = []
+    nonces = []
 
     # Transaction 1
     args = base_args
@@ -80,6 +95,7 @@ def test_multiple_successful_bets(cmd, script, base_args):
     if not stderr1:
         result1 = json.loads(stdout1.decode("ascii"))
         tx_hashes.append(result1["hash"])
+        nonces.append((result1["from"], result1["nonce"]))
         nonce1 = result1["nonce"]
     else:
         raise Exception("Unexpected error occurred:\n{}".format(stderr1.decode("ascii")))
@@ -98,10 +114,11 @@ def test_multiple_successful_bets(cmd, script, base_args):
     if not stderr2:
         result2 = json.loads(stdout2.decode("ascii"))
         tx_hashes.append(result2["hash"])
+        nonces.append((result2["from"], result2["nonce"]))
     else:
         raise Exception("Unexpected error occurred:\n{}".format(stderr2.decode("ascii")))
 
-    start_monitor(web3, tx_hashes, outdir="./output", verbose=True)
+    wait_for_receipts(tx_hashes, nonces)
 
 
 def test_insufficient_wallet_balance(cmd, script, base_args):
@@ -189,18 +206,19 @@ def test_replace_bet_success(cmd, script, base_args):
 
     Expect: partial success
     Output:
-        Transaction 1: transaction timeout error string after default 120 seconds
+        Transaction 1: replaced error string naming transaction 2, once it is mined
         Transaction 2: transaction receipt for successful (replacement) transaction
     """
 
     print("\n\n[{}]\n".format(inspect.getframeinfo(inspect.currentframe()).function))
     print("Expect: {}\nOutput:\n\t{}\n\t{}\n".format(
             "partial success",
-            "Transaction 1: (failure) transaction timeout error string after default 120 seconds",
+            "Transaction 1: (failure) replaced by transaction 2 error string, once it is mined",
             "Transaction 2: (success) transaction receipt for successful (replacement) transaction"
     ))
 
     tx_hashes = []
+    nonces = []
 
     # Transaction 1
     args = base_args
@@ -216,6 +234,7 @@ def test_replace_bet_success(cmd, script, base_args):
     if not stderr1:
         result1 = json.loads(stdout1.decode("ascii"))
         tx_hashes.append(result1["hash"])
+        nonces.append((result1["from"], result1["nonce"]))
         nonce1 = result1["nonce"]
         gas1 = result1["gasPrice"]
     else:
@@ -236,10 +255,11 @@ def test_replace_bet_success(cmd, script, base_args):
     if not stderr2:
         result2 = json.loads(stdout2.decode("ascii"))
         tx_hashes.append(result2["hash"])
+        nonces.append((result2["from"], result2["nonce"]))
     else:
         raise Exception("Unexpected error occurred:\n{}".format(stderr2.decode("ascii")))
 
-    start_monitor(web3, tx_hashes, outdir="./output", verbose=True)
+    wait_for_receipts(tx_hashes, nonces)
 
 
 def test_replace_bet_fail(cmd, script, base_args):
@@ -260,6 +280,7 @@ def test_replace_bet_fail(cmd, script, base_args):
     ))
 
     tx_hashes = []
+    nonces = []
 
     # Transaction 1
     args = base_args
@@ -275,6 +296,7 @@ def test_replace_bet_fail(cmd, script, base_args):
     if not stderr1:
         result1 = json.loads(stdout1.decode("ascii"))
         tx_hashes.append(result1["hash"])
+        nonces.append((result1["from"], result1["nonce"]))
         nonce1 = result1["nonce"]
         gas1 = result1["gasPrice"]
     else:
@@ -292,7 +314,7 @@ def test_replace_bet_fail(cmd, script, base_args):
     proc = subprocess.Popen([cmd, script] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     stdout2, stderr2 = proc.communicate()
 
-    start_monitor(web3, tx_hashes, outdir="./output", verbose=True)
+    wait_for_receipts(tx_hashes, nonces)
 
     if not stderr2:
         print(stdout2.decode("ascii"))
@@ -413,8 +435,9 @@ if __name__ == "__main__":
         web3 = Web3(Web3.HTTPProvider(provider["url"] + ":" + str(provider["port"])))
         web3.middleware_onion.inject(geth_poa_middleware, layer=0)
 
-        # Execute suite of tests
-        run_all_tests(cmd, script, base_args)
+        # Execute suite of tests, watching every transaction with one watcher
+        with TxWatcher(web3, "./output", verbose=True) as watcher:
+            run_all_tests(cmd, script, base_args)
 
     except Exception as e:
         print("[ERROR] Exception encountered: {}".format(e))
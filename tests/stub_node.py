@@ -0,0 +1,603 @@
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import os
+import time
+import rlp
+from aiohttp import web, WSMsgType
+from eth_account import Account
+from eth_account._utils.legacy_transactions import Transaction
+from hexbytes import HexBytes
+from web3 import Web3
+
+
+# Fields of recorded web3 output that are hex QUANTITY values on the wire
+QUANTITIES = (
+    "blockNumber",
+    "cumulativeGasUsed",
+    "effectiveGasPrice",
+    "gas",
+    "gasPrice",
+    "gasUsed",
+    "logIndex",
+    "nonce",
+    "status",
+    "transactionIndex",
+    "value",
+    "v",
+)
+
+
+class StubError(Exception):
+    """
+    Error returned to the client like a node rejecting a request
+    """
+
+
+def to_raw(obj):
+    """
+    Convert a recorded web3 object (as written by record_log) back to its
+    raw JSON-RPC representation
+    """
+    if isinstance(obj, list):
+        return [to_raw(item) for item in obj]
+    if not isinstance(obj, dict):
+        return obj
+    raw = {}
+    for key, value in obj.items():
+        if key in QUANTITIES and isinstance(value, int):
+            raw[key] = hex(value)
+        else:
+            raw[key] = to_raw(value)
+    return raw
+
+
+def fake_hash(*parts):
+    """
+    Deterministic 32-byte hex hash for synthetic blocks and transactions
+    """
+    return "0x" + hashlib.sha256(":".join(str(p) for p in parts).encode()).hexdigest()
+
+
+def logs_bloom(logs):
+    """
+    2048-bit logsBloom of a block over the addresses and topics of its logs
+    """
+    bloom = 0
+    for log in logs:
+        for value in [log["address"]] + log["topics"]:
+            digest = Web3.keccak(hexstr=value)
+            for i in (0, 2, 4):
+                bloom |= 1 << (((digest[i] << 8) | digest[i + 1]) & 2047)
+    return "0x{:0512x}".format(bloom)
+
+
+def log_matches(log, criteria):
+    """
+    Test a raw log against eth_getLogs / eth_subscribe filter criteria
+    """
+    address = criteria.get("address")
+    if address is not None:
+        addresses = address if isinstance(address, list) else [address]
+        if log["address"].lower() not in [a.lower() for a in addresses]:
+            return False
+    for position, topic in enumerate(criteria.get("topics") or []):
+        if topic is None:
+            continue
+        options = topic if isinstance(topic, list) else [topic]
+        if position >= len(log["topics"]) or log["topics"][position] not in options:
+            return False
+    return True
+
+
+class StubNode:
+    """
+    Stand-in JSON-RPC node that mines a block every period seconds, replaying
+    recorded NumberBet receipts against the given contract addresses in turn
+    """
+
+    def __init__(
+            self,
+            contracts,
+            receipts,
+            period=2.0,
+            drop_every=0,
+            reorg_every=0,
+            bet_every=1,
+            bets=1,
+            block_receipts=True,
+            replace_every=0,
+            evict_every=0
+    ):
+        self.contracts = contracts
+        self.receipts = receipts
+        self.period = period
+        self.bet_every = bet_every
+        self.bets = bets
+        self.block_receipts = block_receipts
+        self.replace_every = replace_every
+        self.evict_every = evict_every
+        self.drop_every = drop_every
+        self.reorg_every = reorg_every
+        self.blocks = []
+        self.by_hash = {}
+        self.transactions = {}
+        self.evicted = set()
+        # (sender, nonce) -> hash of the live transaction, for signed ones
+        self.nonces = {}
+        self.mined = {}
+        self.filters = {}
+        self.sockets = set()
+        self.subscriptions = {}
+        self.pool = []
+        self._ids = itertools.count(1)
+        self._replay = itertools.cycle(receipts)
+        self._mine_block([])
+
+    def _mine_block(self, pool, salt=""):
+        number = len(self.blocks)
+        parent = self.blocks[-1]["hash"] if self.blocks else "0x" + "00" * 32
+        block_hash = fake_hash("block", number, parent, salt)
+        logs = []
+        hashes = []
+        for index, (tx_hash, receipt) in enumerate(pool):
+            hashes.append(tx_hash)
+            contract = self.transactions[tx_hash]["to"]
+            self.transactions[tx_hash]["blockHash"] = block_hash
+            self.transactions[tx_hash]["blockNumber"] = hex(number)
+            self.transactions[tx_hash]["transactionIndex"] = hex(index)
+            tx_logs = [
+                dict(
+                    log,
+                    address=contract,
+                    blockNumber=hex(number),
+                    blockHash=block_hash,
+                    transactionHash=tx_hash,
+                    transactionIndex=hex(index),
+                    logIndex=hex(len(logs) + i),
+                    removed=False
+                )
+                for i, log in enumerate(receipt["logs"])
+            ]
+            logs.extend(tx_logs)
+            self.mined[tx_hash] = dict(
+                receipt,
+                to=contract,
+                blockNumber=hex(number),
+                blockHash=block_hash,
+                transactionHash=tx_hash,
+                transactionIndex=hex(index),
+                logs=tx_logs
+            )
+        block = {
+            "number": hex(number),
+            "hash": block_hash,
+            "parentHash": parent,
+            "timestamp": hex(int(time.time())),
+            "logsBloom": logs_bloom(logs),
+            "transactions": hashes,
+            "logs": logs,
+        }
+        self.blocks.append(block)
+        self.by_hash[block_hash] = block
+        return block
+
+    def _submit(self, receipt, replaces=None):
+        if replaces is None:
+            tx_hash = fake_hash("tx", len(self.blocks), len(self.pool))
+            nonce = hex(len(self.transactions))
+        else:
+            tx_hash = fake_hash("replacement", replaces)
+            nonce = self.transactions[replaces]["nonce"]
+        self.transactions[tx_hash] = {
+            "hash": tx_hash,
+            "from": receipt["from"],
+            "to": self.contracts[len(self.transactions) % len(self.contracts)],
+            "gas": receipt["gasUsed"],
+            "gasPrice": receipt["effectiveGasPrice"],
+            "nonce": nonce,
+            "value": hex(10 ** 16),
+            "input": "0x10fe7c48" + "00" * 31 + "01",
+            "blockHash": None,
+            "blockNumber": None,
+            "transactionIndex": None,
+            "type": receipt.get("type", "0x0"),
+        }
+        self.pool.append((tx_hash, receipt))
+        return tx_hash
+
+    def _receive(self, raw):
+        """
+        Accept a signed legacy transaction into the pool, mined with the
+        logs of the next replayed bet; a pending transaction with the same
+        sender and nonce is replaced if the gas price is higher
+        """
+        tx = rlp.decode(HexBytes(raw), Transaction)
+        sender = Account.recover_transaction(raw)
+        tx_hash = Web3.keccak(HexBytes(raw)).hex()
+        other = self.transactions.get(self.nonces.get((sender, tx.nonce)))
+        if other is not None:
+            if other["blockHash"] is not None:
+                raise StubError("nonce too low")
+            if int(other["gasPrice"], 16) >= tx.gasPrice:
+                raise StubError("replacement transaction underpriced")
+            self.evicted.add(other["hash"])
+            self.pool = [entry for entry in self.pool if entry[0] != other["hash"]]
+        self.nonces[(sender, tx.nonce)] = tx_hash
+        self.transactions[tx_hash] = {
+            "hash": tx_hash,
+            "from": sender,
+            "to": Web3.toChecksumAddress(tx.to),
+            "gas": hex(tx.gas),
+            "gasPrice": hex(tx.gasPrice),
+            "nonce": hex(tx.nonce),
+            "value": hex(tx.value),
+            "input": HexBytes(tx.data).hex(),
+            "blockHash": None,
+            "blockNumber": None,
+            "transactionIndex": None,
+            "type": "0x0",
+        }
+        self.pool.append((tx_hash, dict(next(self._replay), **{"from": sender})))
+        return tx_hash
+
+    def _nonce(self, address, tag):
+        nonces = [
+            nonce for (sender, nonce), tx_hash in self.nonces.items()
+            if sender.lower() == address.lower()
+            and (tag == "pending" or self.transactions[tx_hash]["blockHash"] is not None)
+        ]
+        return hex(max(nonces) + 1 if nonces else 0)
+
+    async def mine(self):
+        """
+        Announce bets pending replayed transactions every bet_every blocks,
+        then mine them a period later; the blocks between are empty
+        """
+        while True:
+            if len(self.blocks) % self.bet_every == 0:
+                for _ in range(self.bets):
+                    tx_hash = self._submit(next(self._replay))
+                    await self.notify("newPendingTransactions", tx_hash)
+            await asyncio.sleep(self.period / 2)
+            await self.churn()
+            await asyncio.sleep(self.period / 2)
+            pool, self.pool = self.pool, []
+            block = self._mine_block(pool)
+            print("[stub] mined block {} with {} logs at {:.3f}".format(
+                int(block["number"], 16), len(block["logs"]), time.time()
+            ), flush=True)
+            await self.announce(block)
+            number = int(block["number"], 16)
+            if self.reorg_every and number % self.reorg_every == 0:
+                await asyncio.sleep(self.period / 2)
+                await self.reorg(pool)
+            if self.drop_every and number % self.drop_every == 0:
+                print("[stub] dropping {} connections".format(len(self.sockets)), flush=True)
+                for ws in list(self.sockets):
+                    await ws.close()
+
+    async def churn(self):
+        """
+        Replace the last pending transaction with one using the same nonce
+        every replace_every blocks, and evict it from the pool every
+        evict_every blocks
+        """
+        number = len(self.blocks)
+        if self.replace_every and number % self.replace_every == 0 and self.pool:
+            tx_hash, receipt = self.pool.pop()
+            self.evicted.add(tx_hash)
+            replacement = self._submit(receipt, replaces=tx_hash)
+            print("[stub] replaced {} with {}".format(tx_hash[:10], replacement[:10]), flush=True)
+            await self.notify("newPendingTransactions", replacement)
+        if self.evict_every and number % self.evict_every == 0 and self.pool:
+            tx_hash, _ = self.pool.pop()
+            self.evicted.add(tx_hash)
+            print("[stub] evicted {}".format(tx_hash[:10]), flush=True)
+
+    async def announce(self, block):
+        await self.notify("newHeads", {
+            k: v for k, v in block.items() if k not in ("logs", "transactions")
+        })
+        for log in block["logs"]:
+            await self.notify("logs", log)
+
+    async def reorg(self, pool):
+        """
+        Replace the tip with a sibling block holding the same transactions
+        """
+        orphan = self.blocks.pop()
+        for log in orphan["logs"]:
+            await self.notify("logs", dict(log, removed=True))
+        block = self._mine_block(pool, salt="reorg")
+        print("[stub] reorged block {} ({} -> {})".format(
+            int(block["number"], 16), orphan["hash"][:10], block["hash"][:10]
+        ), flush=True)
+        await self.announce(block)
+
+    async def notify(self, kind, result):
+        for sub_id, (ws, params) in list(self.subscriptions.items()):
+            if params[0] != kind or ws.closed:
+                continue
+            if kind == "logs" and not log_matches(result, params[1] if len(params) > 1 else {}):
+                continue
+            await ws.send_json({
+                "jsonrpc": "2.0",
+                "method": "eth_subscription",
+                "params": {"subscription": sub_id, "result": result},
+            })
+
+    def _logs(self, criteria):
+        if criteria.get("blockHash"):
+            blocks = [b for b in self.blocks if b["hash"] == criteria["blockHash"]]
+        else:
+            head = len(self.blocks) - 1
+            start = self._block_number(criteria.get("fromBlock", "latest"), head)
+            end = self._block_number(criteria.get("toBlock", "latest"), head)
+            blocks = self.blocks[start:end + 1]
+        return [log for b in blocks for log in b["logs"] if log_matches(log, criteria)]
+
+    def _block(self, block, full=False):
+        block = {k: v for k, v in block.items() if k != "logs"}
+        if full:
+            block["transactions"] = [self.transactions[tx_hash] for tx_hash in block["transactions"]]
+        return block
+
+    @staticmethod
+    def _block_number(tag, head):
+        if tag in ("latest", "pending"):
+            return head
+        if tag == "earliest":
+            return 0
+        return int(tag, 16)
+
+    def call(self, method, params, ws=None):
+        """
+        Dispatch one JSON-RPC call and return its result
+        """
+        head = len(self.blocks) - 1
+        if method == "eth_blockNumber":
+            return hex(head)
+        if method == "eth_getLogs":
+            return self._logs(params[0])
+        if method == "eth_getTransactionByHash":
+            return None if params[0] in self.evicted else self.transactions.get(params[0])
+        if method == "eth_sendRawTransaction":
+            return self._receive(params[0])
+        if method == "eth_getTransactionCount":
+            return self._nonce(params[0], params[1] if len(params) > 1 else "latest")
+        if method == "eth_gasPrice":
+            return hex(10 ** 9)
+        if method == "eth_estimateGas":
+            return hex(60000)
+        if method == "eth_chainId":
+            return hex(444111)
+        if method == "eth_getTransactionReceipt":
+            return self.mined.get(params[0])
+        if method == "eth_getBlockReceipts" and self.block_receipts:
+            block = self.by_hash.get(params[0])
+            return [self.mined[tx_hash] for tx_hash in block["transactions"]] if block else None
+        if method == "eth_getBlockByHash":
+            block = self.by_hash.get(params[0])
+            return self._block(block, params[1]) if block else None
+        if method == "eth_getBlockByNumber":
+            number = self._block_number(params[0], head)
+            if number > head:
+                return None
+            return self._block(self.blocks[number], params[1])
+        if method == "eth_newPendingTransactionFilter":
+            filter_id = hex(next(self._ids))
+            self.filters[filter_id] = len(self.transactions)
+            return filter_id
+        if method == "eth_getFilterChanges":
+            seen = self.filters[params[0]]
+            self.filters[params[0]] = len(self.transactions)
+            return list(self.transactions)[seen:]
+        if method == "eth_subscribe" and ws is not None:
+            sub_id = hex(next(self._ids))
+            self.subscriptions[sub_id] = (ws, params)
+            return sub_id
+        if method == "eth_unsubscribe":
+            return self.subscriptions.pop(params[0], None) is not None
+        raise KeyError(method)
+
+    def reply(self, request, ws=None):
+        try:
+            result = self.call(request["method"], request.get("params", []), ws)
+            return {"jsonrpc": "2.0", "id": request["id"], "result": result}
+        except KeyError as e:
+            return {
+                "jsonrpc": "2.0",
+                "id": request["id"],
+                "error": {"code": -32601, "message": "unsupported: {}".format(e)},
+            }
+        except StubError as e:
+            return {
+                "jsonrpc": "2.0",
+                "id": request["id"],
+                "error": {"code": -32000, "message": str(e)},
+            }
+
+    def handle(self, data, ws=None):
+        if isinstance(data, list):
+            return [self.reply(request, ws) for request in data]
+        return self.reply(data, ws)
+
+    async def http_handler(self, request):
+        return web.json_response(self.handle(await request.json()))
+
+    async def ws_handler(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.sockets.add(ws)
+        try:
+            async for msg in ws:
+                if msg.type == WSMsgType.TEXT:
+                    await ws.send_json(self.handle(json.loads(msg.data), ws))
+        finally:
+            self.sockets.discard(ws)
+            for sub_id in [k for k, v in self.subscriptions.items() if v[0] is ws]:
+                del self.subscriptions[sub_id]
+        return ws
+
+
+async def serve(node, host, port, ws_port):
+    http_app = web.Application()
+    http_app.router.add_post("/", node.http_handler)
+    ws_app = web.Application()
+    ws_app.router.add_get("/", node.ws_handler)
+    for app, app_port in ((http_app, port), (ws_app, ws_port)):
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, app_port).start()
+    print("[stub] serving http://{0}:{1} and ws://{0}:{2}".format(host, port, ws_port), flush=True)
+    await node.mine()
+
+
+if __name__ == "__main__":
+    """
+    Stand-in JSON-RPC node for exercising the monitor offline. Mines a block
+    every PERIOD seconds, each containing one bet replayed from a recorded
+    transaction.log against each CONTRACT in turn, and serves HTTP and WebSocket JSON-RPC
+    (including eth_subscribe). Optionally drops all WebSocket connections
+    every DROP_EVERY blocks to exercise resubscribe and gap backfill, and
+    reorgs the tip every REORG_EVERY blocks. eth_getBlockReceipts is served
+    unless disabled, to exercise the batched receipt fallback. Pending bets
+    can also be replaced (same nonce) or evicted from the pool before mining.
+    Signed bets sent with eth_sendRawTransaction are mined with the logs of
+    the next replayed bet.
+
+    Usage:
+
+        stub_node.py [-h] -c CONTRACT [CONTRACT ...] [--receipts RECEIPTS] [--host HOST] [--port PORT]
+                     [--ws-port WS_PORT] [--period PERIOD] [--drop-every DROP_EVERY]
+                     [--reorg-every REORG_EVERY] [--bet-every BET_EVERY] [--bets BETS]
+                     [--no-block-receipts] [--replace-every REPLACE_EVERY] [--evict-every EVICT_EVERY]
+
+    Required Arguments:
+
+        -c CONTRACT [CONTRACT ...], --contract CONTRACT [CONTRACT ...]
+                                contract address(es) to attribute replayed logs to
+
+    Optional Arguments:
+
+        -h, --help              show this help message and exit
+        --receipts RECEIPTS     recorded transaction.log to replay (default: sample_output/transaction.log)
+        --host HOST             interface to bind (default: 127.0.0.1)
+        --port PORT             HTTP JSON-RPC port (default: 8545)
+        --ws-port WS_PORT       WebSocket JSON-RPC port (default: 8546)
+        --period PERIOD         seconds between blocks (default: 2)
+        --drop-every DROP_EVERY
+                                drop WebSocket connections every N blocks (default: 0, never)
+        --reorg-every REORG_EVERY
+                                replace the tip with a sibling block every N blocks (default: 0, never)
+        --bet-every BET_EVERY   replay a bet every N blocks, leaving the others empty (default: 1)
+        --bets BETS             number of bets replayed in each block with bets (default: 1)
+        --no-block-receipts     reject eth_getBlockReceipts like nodes without it
+        --replace-every REPLACE_EVERY
+                                replace a pending bet with a same-nonce transaction every N blocks (default: 0, never)
+        --evict-every EVICT_EVERY
+                                evict a pending bet from the pool every N blocks (default: 0, never)
+
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-c", "--contract",
+        help="contract address(es) to attribute replayed logs to",
+        type=str,
+        nargs="+",
+        required=True
+    )
+    parser.add_argument(
+        "--receipts",
+        help="recorded transaction.log to replay (default: sample_output/transaction.log)",
+        type=str,
+        default=os.path.join("sample_output", "transaction.log")
+    )
+    parser.add_argument(
+        "--host",
+        help="interface to bind (default: 127.0.0.1)",
+        type=str,
+        default="127.0.0.1"
+    )
+    parser.add_argument(
+        "--port",
+        help="HTTP JSON-RPC port (default: 8545)",
+        type=int,
+        default=8545
+    )
+    parser.add_argument(
+        "--ws-port",
+        help="WebSocket JSON-RPC port (default: 8546)",
+        type=int,
+        default=8546
+    )
+    parser.add_argument(
+        "--period",
+        help="seconds between blocks (default: 2)",
+        type=float,
+        default=2.0
+    )
+    parser.add_argument(
+        "--drop-every",
+        help="drop WebSocket connections every N blocks (default: 0, never)",
+        type=int,
+        default=0
+    )
+    parser.add_argument(
+        "--reorg-every",
+        help="replace the tip with a sibling block every N blocks (default: 0, never)",
+        type=int,
+        default=0
+    )
+    parser.add_argument(
+        "--bet-every",
+        help="replay a bet every N blocks, leaving the others empty (default: 1)",
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        "--bets",
+        help="number of bets replayed in each block with bets (default: 1)",
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        "--no-block-receipts",
+        help="reject eth_getBlockReceipts like nodes without it",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--replace-every",
+        help="replace a pending bet with a same-nonce transaction every N blocks (default: 0, never)",
+        type=int,
+        default=0
+    )
+    parser.add_argument(
+        "--evict-every",
+        help="evict a pending bet from the pool every N blocks (default: 0, never)",
+        type=int,
+        default=0
+    )
+
+    args = parser.parse_args()
+
+    with open(os.path.normpath(args.receipts)) as f:
+        receipts = [to_raw(json.loads(line)) for line in f if line.strip()]
+
+    node = StubNode(
+        args.contract,
+        receipts,
+        args.period,
+        args.drop_every,
+        args.reorg_every,
+        args.bet_every,
+        args.bets,
+        not args.no_block_receipts,
+        args.replace_every,
+        args.evict_every
+    )
+    asyncio.run(serve(node, args.host, args.port, args.ws_port))
@@ -1,15 +1,30 @@
 import argparse
+import asyncio
+import getpass
+import heapq
+import itertools
 import json
 import os
+import sys
+from eth_keys import keys
 from web3 import Web3
 from web3.logs import STRICT, IGNORE, DISCARD, WARN
 from web3.middleware import construct_sign_and_send_raw_middleware
 from web3.middleware import geth_poa_middleware
 
+sys.path.append(os.path.join(os.getcwd(), "monitor"))
+from receipts import ReceiptTracker
+from rpc import AsyncRPC, RPCError, batch_request
+
 
 global web3
 global provider
 
+# Gas limit of batched bets, covering the costliest placeBet branch: a loss
+# uses about 34.4k gas, a win adds the 10x payout transfer and emptying the
+# pool a selfdestruct. Unused gas is refunded.
+BET_GAS_LIMIT = 100000
+
 
 def send_transaction(account, transaction, func):
     """
@@ -64,6 +79,185 @@ def place_bet(contract, account, guess, amount, nonce=None, gas=None):
     return tx_hash
 
 
+def submit_bets(contract, account, bets, chunk_size=100):
+    """
+    Sign and send many bets from one account, pipelined as JSON-RPC batches
+    of up to chunk_size transactions, yielding one result per bet in order.
+    Nonces are assigned locally from the account's pending count, skipping
+    those given explicitly; an explicit nonce already assigned to an earlier
+    bet is rejected. The nonce of a rejected bet is reused by the next one,
+    and any still unused below an accepted bet once all are sent are filled
+    with 0-value transfers to the account itself, so later bets are not
+    left stuck behind a gap.
+
+    Parameters
+    ----------
+    contract : Contract
+        the NumberBet contract
+    account : dict
+        the account for the sender
+    bets : iterable
+        bet dicts with the "guess" and "bet" (ether) to place, and optionally
+        the "nonce" and "gas" (gas price) to use; bets with an "error" (e.g.
+        unreadable lines) are passed through as failed
+    chunk_size : int
+        maximum number of transactions sent per HTTP request
+
+    Yields
+    ------
+    result : dict
+        the sent transaction, or the bet with the "error" it was rejected with
+
+    """
+    # Derive the signing key once rather than for every signature
+    key = keys.PrivateKey(account["private_key"])
+    gas_price = web3.eth.gas_price
+    next_nonce = first_nonce = web3.eth.get_transaction_count(account["address"], "pending")
+    free = []
+    # Explicit nonces at or above the locally assigned ones, skipped by those
+    reserved = set()
+    # Highest nonce assigned locally to an accepted bet
+    accepted = None
+    bets = iter(bets)
+    while True:
+        chunk = list(itertools.islice(bets, chunk_size))
+        if not chunk:
+            break
+        results = [None] * len(chunk)
+        signed = []
+        for index, bet in enumerate(chunk):
+            if "error" in bet:
+                results[index] = bet
+                continue
+            if "guess" not in bet or "bet" not in bet:
+                results[index] = dict(bet, error="a bet needs a guess and a bet amount")
+                continue
+            tx = {}
+            try:
+                guess = int(bet["guess"])
+                func = contract.functions.placeBet(guess)
+                tx = {
+                    "from": account["address"],
+                    "value": web3.toWei(bet["bet"], "ether"),
+                    "gas": BET_GAS_LIMIT,
+                    "gasPrice": bet.get("gas") or gas_price,
+                    "chainId": provider["chainId"],
+                }
+                if bet.get("nonce") is not None:
+                    nonce = int(bet["nonce"])
+                    if first_nonce <= nonce < next_nonce and nonce not in reserved:
+                        raise ValueError("nonce {} is already assigned to another bet".format(nonce))
+                    if nonce >= next_nonce:
+                        reserved.add(nonce)
+                    tx["nonce"] = nonce
+                elif free:
+                    tx["nonce"] = heapq.heappop(free)
+                else:
+                    while next_nonce in reserved:
+                        next_nonce += 1
+                    tx["nonce"] = next_nonce
+                    next_nonce += 1
+                tx = func.buildTransaction(tx)
+                raw = web3.eth.account.sign_transaction(tx, key).rawTransaction
+            except Exception as e:
+                results[index] = dict(bet, error=str(e))
+                if "nonce" in tx and bet.get("nonce") is None:
+                    heapq.heappush(free, tx["nonce"])
+                continue
+            signed.append((index, bet, tx, raw))
+
+        try:
+            replies = batch_request(
+                web3,
+                "eth_sendRawTransaction",
+                [[web3.toHex(raw)] for _, _, _, raw in signed],
+                chunk_size,
+                errors=True
+            )
+        except RPCError as e:
+            replies = [e] * len(signed)
+        for (index, bet, tx, _), reply in zip(signed, replies):
+            if isinstance(reply, RPCError) or reply is None:
+                results[index] = dict(bet, error=str(reply or "no reply from node"))
+                if bet.get("nonce") is None:
+                    heapq.heappush(free, tx["nonce"])
+            else:
+                results[index] = dict(tx, hash=reply)
+                if bet.get("nonce") is None:
+                    accepted = tx["nonce"] if accepted is None else max(accepted, tx["nonce"])
+        yield from results
+
+    fill_nonces(account, key, [nonce for nonce in free if accepted is not None and nonce < accepted], gas_price)
+
+
+def fill_nonces(account, key, nonces, gas_price):
+    """
+    Fill nonce gaps with 0-value transfers to the account itself, warning
+    about any the node rejects
+    """
+    if not nonces:
+        return
+    raws = []
+    for nonce in sorted(nonces):
+        tx = {
+            "to": account["address"],
+            "value": 0,
+            "gas": 21000,
+            "gasPrice": gas_price,
+            "nonce": nonce,
+            "chainId": provider["chainId"],
+        }
+        raws.append(web3.eth.account.sign_transaction(tx, key).rawTransaction)
+    replies = batch_request(web3, "eth_sendRawTransaction", [[web3.toHex(raw)] for raw in raws], errors=True)
+    for nonce, reply in zip(sorted(nonces), replies):
+        if isinstance(reply, RPCError) or reply is None:
+            print("[WARN] Could not fill nonce {}, later bets wait for it: {}".format(
+                nonce, reply or "no reply from node"
+            ), file=sys.stderr)
+
+
+def read_bets(path):
+    """
+    Iterate the bets in a JSON lines file ("-" for stdin), yielding an
+    "error" for lines that are not a JSON object
+    """
+    f = sys.stdin if path == "-" else open(os.path.normpath(path))
+    try:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                bet = json.loads(line)
+            except ValueError as e:
+                yield {"line": number, "error": "invalid JSON: {}".format(e)}
+                continue
+            if not isinstance(bet, dict):
+                yield {"line": number, "error": "a bet must be a JSON object"}
+                continue
+            yield bet
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def wait_for_receipt(tx_hash, timeout=120):
+    """
+    Wait for a transaction receipt, fetched along with the receipts of the
+    rest of its block in one call
+    """
+
+    async def wait():
+        async with AsyncRPC(web3.provider.endpoint_uri) as rpc:
+            tracker = ReceiptTracker(rpc, timeout=timeout)
+            poller = asyncio.ensure_future(tracker.run())
+            try:
+                return await tracker.wait(tx_hash)
+            finally:
+                poller.cancel()
+
+    return asyncio.run(wait())
+
+
 def build_account(address, keyfile, passphrase=None):
     """
     Build and return account dict
@@ -87,10 +281,14 @@ def build_account(address, keyfile, passphrase=None):
 if __name__ == "__main__":
     """
     Script to submit transactions (bets) against the NumberBet contract for testing.
+    With --batch, the bets in a JSON lines file (or stdin) are submitted in
+    one process, loading the account and contract once, and one JSON result
+    is printed per bet.
 
     Usage:
     
-        submit_bet.py [-h] -a ADDRESS -k KEYFILE [-p PASSPHRASE] -c CONTRACT -b BET -g GUESS [-n NONCE] [-w] --abi ABI --config CONFIG
+        submit_bet.py [-h] -a ADDRESS -k KEYFILE [-p PASSPHRASE] -c CONTRACT (-b BET -g GUESS [-n NONCE] [-w] | --batch BATCH
+                      [--chunk-size CHUNK_SIZE]) --abi ABI --config CONFIG
 
     Required Arguments:
 
@@ -100,8 +298,8 @@ if __name__ == "__main__":
                                 path to account keyfile
         -c CONTRACT, --contract CONTRACT
                                 contract address
-        -b BET, --bet BET       amount of ether to bet
-        -g GUESS, --guess GUESS number to guess (between 1 and 10 inclusive)
+        -b BET, --bet BET       amount of ether to bet (unless --batch)
+        -g GUESS, --guess GUESS number to guess (between 1 and 10 inclusive, unless --batch)
         --abi ABI               contract ABI or full path to .abi file
         --config CONFIG         path to network provider RPC server config.json
 
@@ -113,6 +311,9 @@ if __name__ == "__main__":
         -p PASSPHRASE, --passphrase PASSPHRASE
                                 path to file containing account keyfile passphrase (will prompt if not provided)
         -w, --wait              wait for transaction receipt and show result
+        --batch BATCH           JSON lines file of bets to submit, e.g. {"guess": 1, "bet": 0.01} ("-" for stdin)
+        --chunk-size CHUNK_SIZE
+                                with --batch, maximum number of bets sent per request (default: 100)
 
     """
 
@@ -145,15 +346,15 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "-b", "--bet",
-        help="amount of ether to bet",
+        help="amount of ether to bet (unless --batch)",
         type=float,
-        required=True
+        required=False
     )
     parser.add_argument(
         "-g", "--guess",
-        help="number to guess (between 1 and 10 inclusive)",
+        help="number to guess (between 1 and 10 inclusive, unless --batch)",
         type=int,
-        required=True
+        required=False
     )
     parser.add_argument(
         "--gas",
@@ -185,8 +386,24 @@ if __name__ == "__main__":
         required=True
     )
 
+    parser.add_argument(
+        "--batch",
+        help='JSON lines file of bets to submit, e.g. {"guess": 1, "bet": 0.01} ("-" for stdin)',
+        type=str,
+        required=False
+    )
+    parser.add_argument(
+        "--chunk-size",
+        help="with --batch, maximum number of bets sent per request (default: 100)",
+        type=int,
+        default=100
+    )
+
     args = parser.parse_args()
 
+    if args.batch is None and (args.bet is None or args.guess is None):
+        parser.error("-b/--bet and -g/--guess are required without --batch")
+
     try:
 
         # Load provider config.json
@@ -209,39 +426,44 @@ if __name__ == "__main__":
             abi = args.abi
         contract = web3.eth.contract(address=args.contract, abi=abi)
 
-        # Locally validate bet conditions in script
-        # Commenting out will result in contract reverting invalid transactions (consumes gas)
-        # assert args.guess >= 1 and args.guess <= 10, "Guess must be between 1-10 inclusive."
-        # assert args.bet <= web3.fromWei(web3.eth.get_balance(account["address"]), 'ether'), "Not enough ether in account."
-        # assert 10 * args.bet <= web3.fromWei(web3.eth.get_balance(contract.address), 'ether'), "Insufficient pool balance ({} ETH).".format(web3.fromWei(web3.eth.get_balance(contract.address), 'ether'))
-        # assert args.bet > 0, "Invalid bet amount."
-        # TODO: add nonce assertion check?
-
-        # Submit the transaction (place a bet)
-        result = place_bet(contract, account, args.guess, args.bet, args.nonce, args.gas)
-
-        tx_hash = web3.toHex(result)
-
-        # If transaction successful and wait flag set, parse and show transaction results
-        if args.wait:
-
-            # Wait for transaction receipt
-            tx_receipt = web3.eth.wait_for_transaction_receipt(result)
-
-            # Parse contract events
-            bal = contract.events.PoolBalance().processReceipt(tx_receipt, errors=DISCARD)
-            bal = web3.fromWei(bal[0]['args']['amount'], 'ether')
-            res = contract.events.Result().processReceipt(tx_receipt, errors=DISCARD)
-            print('Result: {}\t(Guess: {}, Roll: {}, Bet: {} ETH)'.format(
-                res[0]['args']['result'],
-                res[0]['args']['guess'],
-                res[0]['args']['roll'],
-                web3.fromWei(res[0]['args']['bet'], 'ether')
-            ))
-            print('Pool Balance: {} ETH'.format(bal))
+        if args.batch is not None:
+            # Submit every bet with the account and contract loaded once
+            for result in submit_bets(contract, account, read_bets(args.batch), args.chunk_size):
+                print(json.dumps(result), flush=True)
+        else:
+            # Locally validate bet conditions in script
+            # Commenting out will result in contract reverting invalid transactions (consumes gas)
+            # assert args.guess >= 1 and args.guess <= 10, "Guess must be between 1-10 inclusive."
+            # assert args.bet <= web3.fromWei(web3.eth.get_balance(account["address"]), 'ether'), "Not enough ether in account."
+            # assert 10 * args.bet <= web3.fromWei(web3.eth.get_balance(contract.address), 'ether'), "Insufficient pool balance ({} ETH).".format(web3.fromWei(web3.eth.get_balance(contract.address), 'ether'))
+            # assert args.bet > 0, "Invalid bet amount."
+            # TODO: add nonce assertion check?
+
+            # Submit the transaction (place a bet)
+            result = place_bet(contract, account, args.guess, args.bet, args.nonce, args.gas)
+
+            tx_hash = web3.toHex(result)
+
+            # If transaction successful and wait flag set, parse and show transaction results
+            if args.wait:
+
+                # Wait for transaction receipt
+                tx_receipt = wait_for_receipt(tx_hash)
+
+                # Parse contract events from the fetched receipt (no further node calls)
+                bal = contract.events.PoolBalance().processReceipt(tx_receipt, errors=DISCARD)
+                bal = web3.fromWei(bal[0]['args']['amount'], 'ether')
+                res = contract.events.Result().processReceipt(tx_receipt, errors=DISCARD)
+                print('Result: {}\t(Guess: {}, Roll: {}, Bet: {} ETH)'.format(
+                    res[0]['args']['result'],
+                    res[0]['args']['guess'],
+                    res[0]['args']['roll'],
+                    web3.fromWei(res[0]['args']['bet'], 'ether')
+                ))
+                print('Pool Balance: {} ETH'.format(bal))
         
-        tx = web3.eth.get_transaction(tx_hash)
-        print(web3.toJSON(tx))
+            tx = web3.eth.get_transaction(tx_hash)
+            print(web3.toJSON(tx))
 
     except Exception as e:
         print("[ERROR] An unexpected exception has occurred: {}".format(e))